@@ -0,0 +1,58 @@
+import math
+import threading
+
+# 推論速度の実績がないデバイスの実時間比（実時間秒/音声秒）の初期値
+DEFAULT_REALTIME_FACTORS = {'cuda': 0.05, 'cpu:int8': 0.5, 'cpu': 1.0}
+
+
+def default_realtime_factor(device):
+    for prefix, value in DEFAULT_REALTIME_FACTORS.items():
+        if device.startswith(prefix):
+            return value
+    return 1.0
+
+
+class Overloaded(Exception):
+    # 受け付けると未処理の音声が上限を超えるときに送る。retry_afterは再送までの目安（秒）
+    def __init__(self, retry_after):
+        super().__init__(f'混雑しています。{retry_after}秒ほど後に再送してください')
+        self.retry_after = retry_after
+
+
+class Admission:
+    # デバイスごとの処理速度（実時間比の移動平均）を覚えておき、未処理の音声の秒数から受け付けの可否と完了までの時間を見積もる。
+    # 未処理の音声の秒数は呼び出し側が渡す（タスクストアから数えるので複数のHTTPワーカーで共有される）。
+    # max_backlogはデバイスごとの未処理の音声の秒数の上限（0で無制限）
+    def __init__(self, max_backlog=0.0, smoothing=0.2):
+        self.max_backlog = max_backlog
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.rates = {}
+
+    def observe(self, device, realtime_factor):
+        # ジョブが終わるたびにそのデバイスの実時間比を移動平均に加える
+        if not realtime_factor or realtime_factor <= 0:
+            return
+        with self.lock:
+            previous = self.rates.get(device)
+            self.rates[device] = realtime_factor if previous is None else \
+                (1 - self.smoothing) * previous + self.smoothing * realtime_factor
+
+    def realtime_factor(self, devices):
+        # 複数のデバイスで分けて処理する場合（device=all）は各デバイスの処理速度の合計で割る
+        with self.lock:
+            throughput = sum(1 / self.rates.get(device, default_realtime_factor(device)) for device in devices)
+        return 1 / throughput if throughput else 1.0
+
+    def estimate(self, devices, audio_seconds):
+        # audio_seconds秒の音声を処理し終えるまでの実時間（秒）
+        return audio_seconds * self.realtime_factor(devices)
+
+    def retry_after(self, devices, backlog, audio_seconds):
+        # backlogはdevices全体の未処理の音声の秒数。受け付けられるならNone、上限を超えるなら未処理の音声が
+        # 上限まで減るまでの秒数を返す。何も待っていないデバイスは上限より長い音声でも受け付ける
+        limit = self.max_backlog * len(devices)
+        if limit <= 0 or backlog <= 0 or backlog + audio_seconds <= limit:
+            return None
+        excess = backlog + audio_seconds - limit
+        return max(1, math.ceil(self.estimate(devices, min(excess, backlog))))
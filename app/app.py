@@ -1,36 +1,298 @@
-import torch
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, request, jsonify, render_template_string, send_file, Response, stream_with_context
 import os
-import subprocess
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
 import uuid
 import json
 import threading
+import time
+import gc
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+import numpy as np
+import hashlib
+from audio import (SAMPLE_RATE, decode_audio, pipeline_input, detect_speech, compact_speech, restore_chunks,
+                   split_at_silence, quietest_cut, StreamDecoder, probe_duration, prepare_media, take_pcm,
+                   discard_pcm)
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client
+from result_cache import ResultCache
+from task_store import TaskStore, FINISHED_STATUSES
+from live import LiveTranscriber
+from storage import StorageJanitor
+from scheduler import Scheduler, duration_class
+from admission import Admission, Overloaded
+from encoder_cache import EncoderCache
+import metrics
+
+# flask-sockがあればマイク音声のライブ文字起こし（WebSocket）を有効にする
+try:
+    from flask_sock import Sock, ConnectionClosed
+except ImportError:
+    Sock = None
 
 app = Flask(__name__)
 
-# タスク管理用の辞書とロック
-tasks = {}
-tasks_lock = threading.Lock()
+# デバイスごとの同時実行ワーカー数
+WORKERS_PER_DEVICE = int(os.environ.get('WORKERS_PER_DEVICE', '1'))
+# 複数ジョブの30秒ウィンドウをまとめて推論するバッチサイズと最大待ち時間（秒）
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '8'))
+BATCH_MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT', '0.2'))
+# キューから取り出す順番。priorityは短い音声・待ち時間の長いジョブ・最近の利用が少ない利用者を優先し、fifoは到着順。
+# agingは1秒待つごとに差し引く音声の秒数、利用量は処理を始めた音声の秒数をFAIR_SHARE_HALF_LIFE_S秒の半減期で数える
+SCHEDULING_POLICY = os.environ.get('SCHEDULING_POLICY', 'priority')
+PRIORITY_AGING = float(os.environ.get('PRIORITY_AGING', '10'))
+FAIR_SHARE_WEIGHT = float(os.environ.get('FAIR_SHARE_WEIGHT', '1'))
+FAIR_SHARE_HALF_LIFE_S = float(os.environ.get('FAIR_SHARE_HALF_LIFE_S', '600'))
+# デバイスごとの終わっていないタスクの音声の秒数の上限。超える受け付けは429とRetry-Afterで断る（0で無制限）
+MAX_BACKLOG_AUDIO_S = float(os.environ.get('MAX_BACKLOG_AUDIO_S', '14400'))
+# 同期リクエストの完了見込みがこの秒数を超える場合は非同期（202とtask_id）で返す（0で切り替えない）。
+# CloudflareTunnelのタイムアウト（100秒）に余裕を持たせた値
+SYNC_TIMEOUT_S = float(os.environ.get('SYNC_TIMEOUT_S', '90'))
+# タスク状態を保存するSQLiteのパスと、完了/失敗したタスクを保持する秒数
+TASK_DB_PATH = os.environ.get('TASK_DB_PATH', os.path.join('transcriptions', 'tasks.db'))
+TASK_TTL_SECONDS = float(os.environ.get('TASK_TTL_SECONDS', '86400'))
+# SSEのイベント履歴を終了イベントの後に残す秒数（再接続の間に終了したタスクもこの間は履歴から受け取れる）
+EVENT_LOG_RETENTION_S = float(os.environ.get('EVENT_LOG_RETENTION_S', '60'))
+# デコード・リサンプリング・VADを行う前処理プロセスの数（0ならワーカーのスレッドで行う）と、
+# デバイスごとに待ち順の先頭から前処理を先に始めておくジョブ数
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', '2'))
+PREFETCH_DEPTH = int(os.environ.get('PREFETCH_DEPTH', '4'))
+# 途中結果を送る単位（秒）。長い音声はこの長さ程度のブロックに無音位置で分けて推論する
+PROGRESS_BLOCK_S = float(os.environ.get('PROGRESS_BLOCK_S', '120'))
+# 推論モードの既定値。chunked: 重なりのあるウィンドウに分けてバッチ推論、sequential: 前のウィンドウの結果を待つ逐次推論
+INFERENCE_MODE = os.environ.get('INFERENCE_MODE', 'chunked')
+CHUNK_LENGTH_S = float(os.environ.get('CHUNK_LENGTH_S', '30'))
+# ウィンドウ両端の重なり（秒）。0ならchunk_length_s/6（transformersの既定）
+STRIDE_LENGTH_S = float(os.environ.get('STRIDE_LENGTH_S', '0'))
+# device=all で1つの音声を複数デバイスに分割するときの1区間の最短秒数と、分割処理を並行させる数
+SHARD_MIN_SECONDS = float(os.environ.get('SHARD_MIN_SECONDS', '60'))
+SHARD_COORDINATORS = int(os.environ.get('SHARD_COORDINATORS', '2'))
+# ストリーミングアップロードで推論に回す区間の長さ（秒）と、データが届かないストリームを打ち切るまでの秒数
+STREAM_SEGMENT_S = float(os.environ.get('STREAM_SEGMENT_S', '30'))
+STREAM_IDLE_TIMEOUT = float(os.environ.get('STREAM_IDLE_TIMEOUT', '300'))
+# ライブ文字起こしで再認識する間隔（新しく届いた音声の秒数）、バッファを切り詰め始める秒数と上限、無通信で切断するまでの秒数
+LIVE_STEP_S = float(os.environ.get('LIVE_STEP_S', '1.0'))
+LIVE_TRIM_S = float(os.environ.get('LIVE_TRIM_S', '15'))
+LIVE_MAX_BUFFER_S = float(os.environ.get('LIVE_MAX_BUFFER_S', '25'))
+LIVE_IDLE_TIMEOUT = float(os.environ.get('LIVE_IDLE_TIMEOUT', '60'))
+# キャッシュするモデルのメモリ上限（MB、0で無制限）と起動時に読み込むデバイス（カンマ区切り）
+MODEL_CACHE_BUDGET_MB = int(os.environ.get('MODEL_CACHE_BUDGET_MB', '0'))
+# 同一メディアの結果キャッシュの容量上限（MB、0で無効）
+RESULT_CACHE_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', '512'))
+# ストレージの掃除の間隔（秒）と、ディレクトリごとの容量上限（MB、0で無制限）・保持する秒数（0で無期限）。
+# uploadsは処理中のタスクが参照していないファイル、temp_chunksは最後のチャンクから経過した時間で判定する
+STORAGE_SWEEP_INTERVAL = float(os.environ.get('STORAGE_SWEEP_INTERVAL', '300'))
+UPLOADS_MAX_MB = int(os.environ.get('UPLOADS_MAX_MB', '0'))
+UPLOADS_MAX_AGE_S = float(os.environ.get('UPLOADS_MAX_AGE_S', '3600'))
+TEMP_CHUNKS_MAX_MB = int(os.environ.get('TEMP_CHUNKS_MAX_MB', '0'))
+TEMP_CHUNKS_MAX_AGE_S = float(os.environ.get('TEMP_CHUNKS_MAX_AGE_S', '86400'))
+TRANSCRIPTIONS_MAX_MB = int(os.environ.get('TRANSCRIPTIONS_MAX_MB', '0'))
+TRANSCRIPTIONS_MAX_AGE_S = float(os.environ.get('TRANSCRIPTIONS_MAX_AGE_S', '2592000'))
+# 無音区間をスキップするVADの既定値（リクエストの vad で上書き可能）
+VAD_DEFAULT = os.environ.get('VAD_DEFAULT', 'false').lower() == 'true'
+PRELOAD_DEVICES = [d.strip() for d in os.environ.get('PRELOAD_DEVICES', '').split(',') if d.strip()]
+# CPUワーカー全体で使うスレッド数。使っているCPUデバイスのワーカー数で等分する
+CPU_THREADS = int(os.environ.get('CPU_THREADS', '0')) or os.cpu_count() or 1
+# 提供するCPUデバイス。cpu:int8を使わないなら外すと、cpuがCPU_THREADSをすべて使える
+CPU_DEVICES = [d.strip() for d in os.environ.get('CPU_DEVICES', 'cpu,cpu:int8').split(',') if d.strip()]
+# マルチプロセス構成（serve.py）での役割。空なら単一プロセス、httpはHTTPワーカー、inferenceはデバイスごとの推論プロセス
+SERVE_ROLE = os.environ.get('SERVE_ROLE', '')
+INFERENCE_DEVICE = os.environ.get('INFERENCE_DEVICE')
+INFERENCE_SOCKET_DIR = os.environ.get('INFERENCE_SOCKET_DIR', 'inference_sockets')
+INFERENCE_AUTHKEY = bytes.fromhex(os.environ.get('INFERENCE_AUTHKEY', ''))
+# 1プロセスで同時に開いておけるSSE（/events）の接続数（0で無制限）。超えた接続には503を返し、ブラウザはポーリングに切り替える。
+# gunicornのgthreadワーカーでは接続ごとにスレッドを1つ使い続けるので、serve.pyはHTTP_THREADSの半分を既定にする
+MAX_EVENT_STREAMS = int(os.environ.get('MAX_EVENT_STREAMS', '0'))
+# 起動時に既定デバイスのモデルをロードして推論を1回通す（/readyzはこれが終わるまで503を返す）
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'true').lower() == 'true'
+
+# タスク管理用のストア（文字起こし本文は transcriptions/<id>.txt に置き、ストアには持たない）
+task_store = TaskStore(TASK_DB_PATH, TASK_TTL_SECONDS)
+
+def create_task(filename, device, file_path=None, duration=None):
+    task_id = str(uuid.uuid4())
+    task_store.create(task_id, {
+        'status': 'queued',
+        'id': None,
+        'error': None,
+        'filename': filename,
+        'device': device,
+        'duration': duration,
+        # 処理中のアップロードを掃除の対象から外すために記録する
+        'upload': os.path.basename(file_path) if file_path else None,
+        'enqueued_at': time.time(),
+        'started_at': None,
+    })
+    return task_id
+
+def update_task(task_id, **fields):
+    if not task_id:
+        return
+    task = task_store.update(task_id, fields)
+    if task is None:
+        return
+    # 状態が変わったらイベントとしても通知する
+    if fields.get('status') in FINISHED_STATUSES:
+        publish(task_id, *finished_event(task))
+    elif 'status' in fields:
+        publish(task_id, fields['status'], {})
+
+def finished_event(task):
+    # 終了イベント。結果の本文はメモリのイベント履歴に持たず、クライアントが /status から取得する
+    if task['status'] == 'completed':
+        return 'completed', {"id": task['id'], "filename": task['filename']}
+    if task['status'] == 'error':
+        return 'error', {"error": task['error'], "filename": task['filename']}
+    return task['status'], {}
+
+def relay_events():
+    # 複数プロセス構成: このHTTPワーカーで購読されているタスクのイベントを、接続ごとではなく
+    # 0.2秒ごとに1回まとめてタスクストアから読み、履歴に入れて待っている接続を起こす
+    while True:
+        time.sleep(0.2)
+        with task_events_lock:
+            positions = {task_id: len(log['events']) for task_id, log in task_events.items()
+                         if not log.get('finished_at')}
+        if not positions:
+            continue
+        try:
+            rows = task_store.events_after(positions)
+        except Exception as e:
+            print(f'イベントの読み込みに失敗しました: {e}')
+            continue
+        with task_events_lock:
+            for task_id, seq, event, data in rows:
+                log = task_events.get(task_id)
+                if log is None or seq != len(log['events']):
+                    # 読んでいる間に履歴が捨てられた
+                    continue
+                log['events'].append((event, data))
+                if event in FINISHED_STATUSES:
+                    log['finished_at'] = time.time()
+                log['cond'].notify_all()
+
+event_streams = [0]
+event_streams_lock = threading.Lock()
+
+def acquire_event_stream():
+    with event_streams_lock:
+        if MAX_EVENT_STREAMS and event_streams[0] >= MAX_EVENT_STREAMS:
+            return False
+        event_streams[0] += 1
+        return True
+
+def release_event_stream():
+    with event_streams_lock:
+        event_streams[0] -= 1
+
+def get_task(task_id):
+    return task_store.get(task_id)
+
+def read_transcription(transcription_id):
+    transcription_path = os.path.join('transcriptions', f'{transcription_id}.txt')
+    with open(transcription_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def translation_path(transcription_id):
+    # translate=bothで一緒に作った英訳
+    return os.path.join('transcriptions', f'{transcription_id}.translation.txt')
+
+def read_translation(transcription_id):
+    if not os.path.exists(translation_path(transcription_id)):
+        return None
+    with open(translation_path(transcription_id), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def evict_tasks():
+    # 期限切れのタスクとそのイベント履歴を定期的に削除する
+    while True:
+        time.sleep(60)
+        try:
+            expired = task_store.evict_expired()
+        except Exception as e:
+            print(f'タスクの削除に失敗しました: {e}')
+            continue
+        cutoff = time.time() - EVENT_LOG_RETENTION_S
+        with task_events_lock:
+            for task_id in expired:
+                task_events.pop(task_id, None)
+            # 終了してしばらくたったタスクのイベント履歴は、タスクのTTLを待たずに捨てる
+            for task_id in [task_id for task_id, log in task_events.items()
+                            if log.get('finished_at') and log['finished_at'] < cutoff]:
+                task_events.pop(task_id)
+        try:
+            task_store.evict_events(cutoff)
+        except Exception as e:
+            print(f'イベント履歴の削除に失敗しました: {e}')
+        expire_streams()
+
+# タスクごとのイベント履歴（Server-Sent Eventsで配信する）
+task_events = {}
+task_events_lock = threading.Lock()
+
+def publish(task_id, event, data):
+    if not task_id:
+        return
+    if SERVE_ROLE == 'http':
+        # /eventsは別のHTTPワーカーに届くことがあるので、イベントもタスクストアに書く
+        task_store.add_event(task_id, event, data)
+        return
+    with task_events_lock:
+        log = task_events.get(task_id)
+        if log is None:
+            log = task_events[task_id] = {'events': [], 'cond': threading.Condition(task_events_lock)}
+        log['events'].append((event, data))
+        if event in FINISHED_STATUSES:
+            log['finished_at'] = time.time()
+        log['cond'].notify_all()
+
+def wait_events(task_id, index, timeout):
+    # index番目以降のイベントを返す。なければtimeout秒まで待つ。
+    # 複数プロセス構成ではrelay_eventsがタスクストアから読んだイベントをこの履歴に入れる
+    with task_events_lock:
+        log = task_events.get(task_id)
+        if log is None:
+            log = task_events[task_id] = {'events': [], 'cond': threading.Condition(task_events_lock)}
+        if len(log['events']) <= index:
+            log['cond'].wait(timeout)
+        return log['events'][index:]
+
 
 def get_available_devices():
-    devices = [('cpu', 'CPU')]
+    # torchの読み込みは重いので、起動後にバックグラウンドで行う
+    import torch
+    devices = [entry for entry in [('cpu', 'CPU'), (CPU_INT8_DEVICE, 'CPU (int8量子化)')] if entry[0] in CPU_DEVICES]
     if torch.cuda.is_available():
         for i in range(torch.cuda.device_count()):
             gpu_name = torch.cuda.get_device_name(i)
             devices.append((f'cuda:{i}', f'GPU {i}: {gpu_name}'))
     return devices
 
-available_devices = get_available_devices()
-default_device = 'cuda:0' if len(available_devices) > 1 else 'cpu'
+# デバイス検出（torchの読み込み）が終わるまでは空。start_runtime() が埋める
+available_devices = []
+default_device = None
+devices_ready = threading.Event()
+startup_state = {'devices': 'detecting', 'model': 'pending', 'error': None,
+                 'started_at': time.time(), 'ready_at': None}
+
+MODEL_ID = "openai/whisper-large-v3-turbo"
+# CPUでLinear層の重みをint8に動的量子化して推論するデバイス
+CPU_INT8_DEVICE = 'cpu:int8'
 
 def initialize_model(device):
+    import torch
+    from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
     torch_dtype = torch.float16 if 'cuda' in device else torch.float32
-    model_id = "openai/whisper-large-v3-turbo"
+    model_id = MODEL_ID
     model = AutoModelForSpeechSeq2Seq.from_pretrained(
         model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
     )
-    model.to(device)
+    if device == CPU_INT8_DEVICE:
+        # 活性は推論時にスケールを求めてint8化する。畳み込みや埋め込みはfp32のまま
+        model = torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        model.to(device)
     processor = AutoProcessor.from_pretrained(model_id)
     pipe = pipeline(
         "automatic-speech-recognition",
@@ -42,7 +304,765 @@ def initialize_model(device):
     )
     return pipe
 
-model_cache = {}
+def pipeline_bytes(pipe):
+    # パイプラインが保持するモデルパラメータのバイト数（量子化された重みはパラメータではないのでstate_dictから数える）
+    model = getattr(pipe, 'model', None)
+    if model is None:
+        return 0
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if hasattr(tensor, 'element_size'):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+def cpu_worker_threads(cpu_devices):
+    # CPU_THREADSをCPUデバイスcpu_devices個分のワーカー（WORKERS_PER_DEVICEずつ）で等分する
+    return max(1, CPU_THREADS // (cpu_devices * WORKERS_PER_DEVICE))
+
+cpu_devices_started = set()
+cpu_devices_lock = threading.Lock()
+
+def start_cpu_device(device):
+    # torch.set_num_threadsはプロセス全体のintra-opスレッド数を変えるので、ワーカーごとではなく
+    # CPUデバイスを使い始めるとき（モデルのロード時）に、使い始めたCPUデバイスの数で分け直す。
+    # CPUデバイスを使わないプロセス（GPUだけで推論する場合など）のスレッド数は変えない。
+    # serve.pyの推論プロセスはデバイス1つだけを持つので、起動時に他のCPUデバイスの推論プロセスの分も割り引く
+    if not device.startswith('cpu'):
+        return
+    with cpu_devices_lock:
+        if device in cpu_devices_started:
+            return
+        cpu_devices_started.add(device)
+        count = len(CPU_DEVICES) if SERVE_ROLE == 'inference' else len(cpu_devices_started)
+    import torch
+    torch.set_num_threads(cpu_worker_threads(count))
+
+def release_memory(device):
+    gc.collect()
+    if device.startswith('cuda'):
+        import torch
+        torch.cuda.empty_cache()
+
+# 処理段階ごとの所要時間と、ジョブごとの推論速度（/metricsで公開する）
+stage_seconds = metrics.Histogram('whisper_stage_seconds', '処理段階ごとの所要時間（秒）', ['stage'])
+realtime_factor = metrics.Histogram('whisper_job_realtime_factor', 'ジョブの推論時間/音声の長さ', ['device', 'mode'],
+                                    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5))
+jobs_total = metrics.Counter('whisper_jobs_total', '終了したジョブ数', ['status'])
+worker_idle_seconds = metrics.Counter('whisper_worker_idle_seconds_total',
+                                      'デバイスのワーカーが推論していなかった時間（queue: ジョブ待ち、preprocess: 前処理待ち）',
+                                      ['device', 'reason'])
+
+def record_stage(stages, stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    stages[stage] = stages.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(stages, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stages, stage, time.perf_counter() - start)
+
+class ModelCache:
+    # デバイスごとのパイプラインキャッシュ。
+    # 同じデバイスへの同時要求は1回のロードを共有し、上限を超えたら使用中でないものをLRUで解放する
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self.cond = threading.Condition()
+        self.entries = OrderedDict()
+        self.loading = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = {}
+        self.sizes = {}
+
+    @contextmanager
+    def acquire(self, device):
+        # 使用中のパイプラインは解放対象にならない
+        pipe = self._get(device)
+        try:
+            yield pipe
+        finally:
+            with self.cond:
+                entry = self.entries.get(device)
+                if entry is not None:
+                    entry['refs'] -= 1
+                    entry['last_used'] = time.time()
+                self.cond.notify_all()
+
+    def _get(self, device):
+        with self.cond:
+            while device in self.loading:
+                self.cond.wait()
+            entry = self.entries.get(device)
+            if entry is not None:
+                self.hits += 1
+                entry['refs'] += 1
+                self.entries.move_to_end(device)
+                return entry['pipe']
+            self.misses += 1
+            self.loading.add(device)
+            victims = self._evict(self._estimate(device))
+        for victim in victims:
+            release_memory(victim)
+
+        try:
+            start_cpu_device(device)
+            start = time.time()
+            pipe = initialize_model(device)
+            load_seconds = time.time() - start
+        except Exception:
+            with self.cond:
+                self.loading.discard(device)
+                self.cond.notify_all()
+            raise
+
+        size = pipeline_bytes(pipe)
+        with self.cond:
+            self.entries[device] = {'pipe': pipe, 'bytes': size, 'refs': 1, 'last_used': time.time()}
+            self.sizes[device] = size
+            self.load_seconds[device] = load_seconds
+            self.loading.discard(device)
+            victims = self._evict(0)
+            self.cond.notify_all()
+        for victim in victims:
+            release_memory(victim)
+        return pipe
+
+    def _estimate(self, device):
+        # 未ロードのデバイスは過去の実績（なければ最大のエントリ）で見積もる
+        if device in self.sizes:
+            return self.sizes[device]
+        return max(self.sizes.values(), default=0)
+
+    def _evict(self, needed):
+        # self.condを保持した状態で呼ぶ。解放したデバイスのリストを返す
+        victims = []
+        if self.budget_bytes <= 0:
+            return victims
+        total = sum(entry['bytes'] for entry in self.entries.values())
+        for device in list(self.entries):
+            if total + needed <= self.budget_bytes:
+                break
+            entry = self.entries[device]
+            if entry['refs'] > 0:
+                continue
+            total -= entry['bytes']
+            del self.entries[device]
+            self.evictions += 1
+            victims.append(device)
+        return victims
+
+    def clear(self):
+        with self.cond:
+            devices = [d for d, entry in self.entries.items() if entry['refs'] == 0]
+            for device in devices:
+                del self.entries[device]
+        for device in devices:
+            release_memory(device)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'budget_bytes': self.budget_bytes,
+                'loading': sorted(self.loading),
+                'loaded': {
+                    device: {
+                        'bytes': entry['bytes'],
+                        'in_use': entry['refs'],
+                        'idle_seconds': 0 if entry['refs'] else time.time() - entry['last_used'],
+                        'load_seconds': self.load_seconds.get(device),
+                    }
+                    for device, entry in self.entries.items()
+                },
+            }
+
+model_cache = ModelCache(MODEL_CACHE_BUDGET_MB * 1024 * 1024)
+
+def warmup_model(device):
+    # 1秒の無音で推論を1回通し、初回リクエストのCUDA初期化などを済ませておく
+    with model_cache.acquire(device) as pipe:
+        pipe(pipeline_input(np.zeros(SAMPLE_RATE, dtype=np.float32)), return_timestamps=True)
+
+def preload_models():
+    for device in PRELOAD_DEVICES:
+        if device == default_device and STARTUP_WARMUP:
+            continue
+        if device not in dict(available_devices):
+            print(f'PRELOAD_DEVICES: 不明なデバイス {device} をスキップします')
+            continue
+        try:
+            warmup_model(device)
+        except Exception as e:
+            print(f'{device} のモデル事前ロードに失敗しました: {e}')
+
+scheduler = Scheduler(SCHEDULING_POLICY, PRIORITY_AGING, FAIR_SHARE_WEIGHT, FAIR_SHARE_HALF_LIFE_S)
+
+# デコードなどの前処理を行うプロセスプール。spawnで起動するので子プロセスはtorchを読み込まない。
+# アップロードを受けるプロセスだけが使う（推論プロセスにはデコード済みの音声が届き、cli.pyは自分のプールを使う）
+PREPROCESS_IN_POOL = PREPROCESS_WORKERS > 0 and SERVE_ROLE in ('', 'http')
+# 最初の前処理で作る。読み込み時に作ると、python app.pyで起動したときにapp.pyを__mp_main__として読み込む
+# spawnの子プロセスもそれぞれプールを作ってしまう
+preprocess_pool = None
+preprocess_pool_lock = threading.Lock()
+
+def start_preprocess(job):
+    global preprocess_pool
+    with preprocess_pool_lock:
+        if preprocess_pool is None:
+            preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+    job['prepared'] = preprocess_pool.submit(prepare_media, job['file_path'], job['vad'])
+
+def job_duration(job):
+    # 準備済みの区間ジョブは実際の長さ、それ以外は受付時に調べた再生時間
+    if 'input_audio' in job:
+        return len(job['input_audio']) / SAMPLE_RATE
+    return job.get('duration') or 0.0
+
+class DeviceQueue:
+    # デバイスごとの待ち行列と固定数のワーカー。取り出す順番はschedulerが決める
+    def __init__(self, device, num_workers):
+        self.device = device
+        self.jobs = deque()
+        self.cond = threading.Condition()
+        # 最後に通知した待ち順（task_id → 待ち順）
+        self.positions = {}
+        self.active = 0
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f'worker-{device}-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        job['duration'] = job_duration(job)
+        job.setdefault('client', '')
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify_all()
+        # 優先度によっては後から来たジョブが先になるので、待ち順が変わったジョブに通知し直す
+        self._publish_positions()
+        self.prefetch()
+
+    def prefetch(self):
+        # 前処理中・前処理済みのジョブがPREFETCH_DEPTH件になるまで、待ち順の先頭から前処理を始めておく。
+        # ワーカーが取り出すときにはデコード済みになっているので、デバイスがffmpegを待たない
+        if not PREPROCESS_IN_POOL:
+            return
+        with self.cond:
+            prefetched = sum(1 for job in self.jobs if 'prepared' in job)
+            for job in scheduler.order(self.jobs):
+                if prefetched >= PREFETCH_DEPTH:
+                    break
+                if 'prepared' not in job and 'input_audio' not in job and job.get('file_path'):
+                    start_preprocess(job)
+                    prefetched += 1
+
+    def remove(self, cancel):
+        # キャンセルされたジョブ（同じcancelイベントを持つ区間ジョブも含む）をキューから外して返す
+        with self.cond:
+            removed = [job for job in self.jobs if job.get('cancel') is cancel]
+            for job in removed:
+                self._discard(job)
+        if removed:
+            self._publish_positions()
+        return removed
+
+    def _publish_positions(self):
+        # 待っているジョブのうち、前回通知したときから待ち順が変わったものにだけ新しい待ち順を通知する
+        with self.cond:
+            positions = {job['task_id']: i + 1 for i, job in enumerate(scheduler.order(self.jobs)) if job['task_id']}
+            changed = [(task_id, position) for task_id, position in positions.items()
+                       if self.positions.get(task_id) != position]
+            self.positions = positions
+        for task_id, position in changed:
+            publish(task_id, 'queue', {"queue_position": position})
+
+    def position(self, task_id):
+        # 1始まりの待ち順。キューにいなければNone
+        with self.cond:
+            for i, job in enumerate(scheduler.order(self.jobs)):
+                if job['task_id'] == task_id:
+                    return i + 1
+        return None
+
+    def audio_ahead(self, task_id):
+        # 待ち順でこのタスクより前にあるジョブの音声の秒数。キューにいなければNone
+        with self.cond:
+            ahead = 0.0
+            for job in scheduler.order(self.jobs):
+                if job['task_id'] == task_id:
+                    return ahead
+                ahead += job['duration']
+        return None
+
+    def process(self, batch):
+        process_batch(self.device, batch)
+
+    def _take_compatible(self, batch):
+        # 先頭ジョブと同じ言語/タスク設定のジョブを優先度の順にキューから取り出す
+        key = batch_key(batch[0])
+        for job in scheduler.order(self.jobs):
+            if len(batch) >= batch[0]['batch_size']:
+                break
+            if batch_key(job) == key:
+                self._discard(job)
+                batch.append(job)
+
+    def _next_batch(self):
+        # self.condを保持した状態で呼ぶ
+        while not self.jobs:
+            self.cond.wait()
+        batch = [self._pop_first()]
+        deadline = time.time() + BATCH_MAX_WAIT
+        while True:
+            self._take_compatible(batch)
+            remaining = deadline - time.time()
+            if len(batch) >= batch[0]['batch_size'] or remaining <= 0:
+                return batch
+            self.cond.wait(remaining)
+
+    def _pop_first(self):
+        # self.condを保持した状態で呼ぶ
+        job = scheduler.order(self.jobs)[0]
+        self._discard(job)
+        return job
+
+    def _discard(self, job):
+        # deque.removeは==で比べるので、音声配列を持つジョブ同士の比較にならないよう同一性で探す
+        for i, queued in enumerate(self.jobs):
+            if queued is job:
+                del self.jobs[i]
+                return
+
+    def _worker_loop(self):
+        while True:
+            idle_start = time.perf_counter()
+            with self.cond:
+                batch = self._next_batch()
+                self.active += len(batch)
+            worker_idle_seconds.inc(time.perf_counter() - idle_start, device=self.device, reason='queue')
+            for job in batch:
+                scheduler.started(job)
+            self._publish_positions()
+            # 取り出した分だけ先読みの枠が空いた
+            self.prefetch()
+            try:
+                self.process(batch)
+            finally:
+                with self.cond:
+                    self.active -= len(batch)
+                for job in batch:
+                    job['done'].set()
+                    # 完了を待つスレッドを持たない呼び出し元（cli.py）向けのフック
+                    if job.get('on_done'):
+                        job['on_done'](job)
+
+class RemoteDeviceQueue(DeviceQueue):
+    # HTTPワーカー側のキュー。デコードとVADはこのプロセスで行い、推論はデバイスを持つ推論プロセスに任せる。
+    # バッチは推論プロセス側で組むので、ここでは1件ずつ取り出して同時にnum_workers件まで送る
+    def __init__(self, device, num_workers, address):
+        self.address = address
+        super().__init__(device, num_workers)
+
+    def process(self, batch):
+        for job in batch:
+            process_remote(self, job)
+
+    def _next_batch(self):
+        while not self.jobs:
+            self.cond.wait()
+        return [self._pop_first()]
+
+def socket_path(device):
+    return os.path.join(INFERENCE_SOCKET_DIR, device.replace(':', '_') + '.sock')
+
+def connect_inference(address, timeout=120):
+    # 推論プロセスがtorchを読み込んでソケットを開くまでは接続できないので、しばらく待つ
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(address, family='AF_UNIX', authkey=INFERENCE_AUTHKEY)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.5)
+
+def remote_call(address, message):
+    with Client(address, family='AF_UNIX', authkey=INFERENCE_AUTHKEY) as conn:
+        conn.send(message)
+        return conn.recv()
+
+def process_remote(queue, job):
+    ready = start_jobs([job])
+    if not ready:
+        return
+    # PCMはpickleせず共有メモリに置き、推論プロセスには名前と長さだけを送る
+    audio = job['input_audio']
+    shm = shared_memory.SharedMemory(create=True, size=max(audio.nbytes, 1))
+    try:
+        np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)[:] = audio
+        with connect_inference(queue.address) as conn:
+            # 推論プロセス側のキューでも利用者ごとの公平な順番になるよう、利用者も送る
+            conn.send({'op': 'transcribe', 'shm': shm.name, 'samples': len(audio), 'timeline': job.get('timeline'),
+                       'client': job['client'], 'options': {name: job[name] for name in parse_options({})}})
+            cancel_sent = False
+            while True:
+                if not conn.poll(0.5):
+                    # キャンセルされたら推論プロセスに伝え、次のブロックの境界で止めてもらう
+                    if cancelled(job) and not cancel_sent:
+                        conn.send({'op': 'cancel'})
+                        cancel_sent = True
+                    continue
+                kind, payload = conn.recv()
+                if kind == 'segment':
+                    publish_segments(job['task_id'], *payload)
+                elif kind == 'error':
+                    raise Exception(payload)
+                elif kind == 'cancelled':
+                    raise JobCancelled()
+                else:
+                    break
+        # 推論プロセス側の待ち時間・モデル取得・推論の時間も段階に加える
+        for stage, seconds in payload['stages'].items():
+            job['stages'][stage] = job['stages'].get(stage, 0.0) + seconds
+        admission.observe(queue.device, payload['inference']['realtime_factor'])
+        complete_job(job, payload['result'], payload['inference'])
+    except Exception as e:
+        if cancelled(job):
+            cancel_job(job)
+        else:
+            fail_job(job, e)
+    finally:
+        shm.close()
+        shm.unlink()
+
+def batch_key(job):
+    # 同じバッチに入れられるのは生成設定と推論モードが一致するジョブのみ
+    return (job['language'], job['translate'], job['mode'], job['chunk_length_s'], job['stride_length_s'],
+            job['batch_size'])
+
+device_queues = {}
+
+def detect_devices():
+    global default_device
+    if SERVE_ROLE == 'http':
+        # serve.pyが書いたデバイス一覧を使う。HTTPワーカーはtorchを読み込まない
+        manifest_path = os.path.join(INFERENCE_SOCKET_DIR, 'devices.json')
+        while not os.path.exists(manifest_path):
+            time.sleep(0.5)
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        available_devices.extend((device_id, name) for device_id, name in manifest['devices'])
+        default_device = manifest['default_device']
+        for device_id, _ in available_devices:
+            device_queues[device_id] = RemoteDeviceQueue(device_id, WORKERS_PER_DEVICE * BATCH_SIZE,
+                                                         socket_path(device_id))
+        return
+    available_devices.extend(get_available_devices())
+    cuda = any(device_id.startswith('cuda') for device_id, _ in available_devices)
+    default_device = 'cuda:0' if cuda else available_devices[0][0]
+    if SERVE_ROLE == 'inference':
+        # 推論プロセスは担当するデバイスのモデルだけを持つ
+        available_devices[:] = [entry for entry in available_devices if entry[0] == INFERENCE_DEVICE]
+        default_device = INFERENCE_DEVICE
+    for device_id, _ in available_devices:
+        device_queues[device_id] = DeviceQueue(device_id, WORKERS_PER_DEVICE)
+
+def wait_remote_ready(device):
+    # 推論プロセスが起動してモデルのウォームアップを終えるまで待つ
+    while True:
+        try:
+            if remote_call(socket_path(device), {'op': 'stats'})['ready']:
+                return
+        except (OSError, EOFError):
+            pass
+        time.sleep(1)
+
+def wait_devices():
+    # デバイス検出前に届いたリクエストは検出が終わるまで待たせる
+    devices_ready.wait()
+
+def start_runtime():
+    # デバイス検出 → 既定デバイスのウォームアップ → PRELOAD_DEVICESの事前ロードの順に行う
+    try:
+        detect_devices()
+        startup_state['devices'] = 'ready'
+    except Exception as e:
+        startup_state.update(devices='error', model='error', error=f'デバイスの検出に失敗しました: {e}')
+        return
+    finally:
+        devices_ready.set()
+    if SERVE_ROLE == 'http':
+        startup_state['model'] = 'loading'
+        wait_remote_ready(default_device)
+    elif STARTUP_WARMUP:
+        startup_state['model'] = 'loading'
+        try:
+            warmup_model(default_device)
+        except Exception as e:
+            startup_state.update(model='error', error=f'{default_device} のモデルロードに失敗しました: {e}')
+            return
+    startup_state.update(model='ready', ready_at=time.time())
+    preload_models()
+
+result_cache = ResultCache(os.path.join('transcriptions', 'cache'), RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+def live_storage_entries():
+    # 処理中のタスクや受信中のストリームが使うアップロードと、まだ残っているタスクの文字起こし結果は消さない
+    uploads = task_store.field_values('upload', unfinished_only=True)
+    with streams_lock:
+        uploads |= {os.path.basename(state['file_path']) for state in streams.values()}
+    return {
+        'uploads': uploads,
+        'transcriptions': {f'{transcription_id}{suffix}' for transcription_id in task_store.field_values('id')
+                           for suffix in ('.txt', '.translation.txt')},
+    }
+
+# transcriptions/ のうち掃除の対象は結果のテキストだけ（tasks.dbと結果キャッシュは別に管理する）
+storage = StorageJanitor({
+    'uploads': {'max_bytes': UPLOADS_MAX_MB * 1024 * 1024, 'max_age': UPLOADS_MAX_AGE_S, 'reason': 'orphan'},
+    'temp_chunks': {'max_bytes': TEMP_CHUNKS_MAX_MB * 1024 * 1024, 'max_age': TEMP_CHUNKS_MAX_AGE_S,
+                    'reason': 'abandoned'},
+    'transcriptions': {'max_bytes': TRANSCRIPTIONS_MAX_MB * 1024 * 1024, 'max_age': TRANSCRIPTIONS_MAX_AGE_S,
+                       'pattern': '*.txt'},
+}, live_storage_entries)
+
+def sweep_storage():
+    # 定期的にストレージを掃除する。消したチャンクアップロードの状態も忘れる
+    while True:
+        try:
+            reclaimed = storage.sweep()
+            with upload_states_lock:
+                for file_id in [file_id for file_id in upload_states if not os.path.isdir(upload_dir(file_id))]:
+                    upload_states.pop(file_id)
+            if reclaimed:
+                print(f'ストレージの掃除で {reclaimed / (1 << 20):.1f}MB を解放しました')
+        except Exception as e:
+            print(f'ストレージの掃除に失敗しました: {e}')
+        time.sleep(STORAGE_SWEEP_INTERVAL)
+
+def parse_options(values):
+    # フォームまたはJSONから文字起こしの設定を取り出す
+    def flag(name, default):
+        return str(values.get(name, str(default))).lower() == 'true'
+
+    def number(name, default, cast, minimum):
+        try:
+            value = cast(values.get(name) or default)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name}が不正です")
+        if value < minimum:
+            raise ValueError(f"{name}は{minimum}以上にしてください")
+        return value
+
+    mode = values.get('mode') or INFERENCE_MODE
+    if mode not in ('chunked', 'sequential'):
+        raise ValueError("modeはchunkedかsequentialを指定してください")
+    chunk_length_s = number('chunk_length_s', CHUNK_LENGTH_S, float, 1)
+    stride_length_s = number('stride_length_s', STRIDE_LENGTH_S, float, 0) or chunk_length_s / 6
+    if stride_length_s * 2 >= chunk_length_s:
+        raise ValueError("stride_length_sはchunk_length_sの半分未満にしてください")
+    # bothは文字起こしと英訳を両方作る（エンコーダーの計算は1回で共有する）
+    translate = str(values.get('translate', 'false')).lower()
+    if translate not in ('true', 'false', 'both'):
+        raise ValueError("translateはtrue、false、bothのいずれかを指定してください")
+    return {
+        'language': values.get('language', 'auto'),
+        'translate': 'both' if translate == 'both' else translate == 'true',
+        'vad': flag('vad', VAD_DEFAULT),
+        'mode': mode,
+        'chunk_length_s': chunk_length_s if mode == 'chunked' else None,
+        'stride_length_s': stride_length_s if mode == 'chunked' else None,
+        'batch_size': number('batch_size', BATCH_SIZE, int, 1),
+    }
+
+def cache_key(kind, digest, options):
+    # kindは'upload'（アップロードされたバイト列）か'pcm'（デコード後の音声）
+    # バッチサイズは結果に影響しないのでキーに含めない
+    key = json.dumps({name: options[name] for name in parse_options({}) if name != 'batch_size'}, sort_keys=True)
+    return f"{kind}-{digest}-{hashlib.sha256(f'{key}:{MODEL_ID}'.encode('utf-8')).hexdigest()[:16]}"
+
+client_decode_saved_bytes = metrics.Counter('whisper_client_decode_saved_bytes_total',
+                                            'ブラウザで16kHzモノラルに変換して送られたアップロードで減ったバイト数', [])
+
+def client_upload_info(values, uploaded_bytes, stages):
+    # ブラウザで16kHzモノラルのWAVに変換してから送られた場合は、元のファイルサイズ（originalSize）と
+    # 変換にかかった秒数（clientDecodeSeconds）が付いてくる。減ったバイト数と合わせてタスクに残す
+    try:
+        original_bytes = int(values.get('originalSize') or 0)
+        decode_seconds = float(values.get('clientDecodeSeconds') or 0)
+    except (TypeError, ValueError):
+        return None
+    if original_bytes <= 0:
+        return None
+    saved_bytes = max(0, original_bytes - uploaded_bytes)
+    client_decode_saved_bytes.inc(saved_bytes)
+    if decode_seconds > 0:
+        record_stage(stages, 'client_decode', decode_seconds)
+    return {'bytes': uploaded_bytes, 'original_bytes': original_bytes, 'saved_bytes': saved_bytes,
+            'client_decode_seconds': decode_seconds}
+
+def save_upload(file, file_path, hasher):
+    # 保存しながらハッシュを計算し、あとで読み直さずに済むようにする
+    with open(file_path, 'wb') as f:
+        while True:
+            block = file.stream.read(1 << 20)
+            if not block:
+                break
+            hasher.update(block)
+            f.write(block)
+
+# このプロセスで待機中・処理中のジョブ（task_id → ジョブ）。キャンセルの受け付けに使う
+active_jobs = {}
+active_jobs_lock = threading.Lock()
+
+def register_job(job):
+    with active_jobs_lock:
+        active_jobs[job['task_id']] = job
+
+def unregister_job(job):
+    with active_jobs_lock:
+        active_jobs.pop(job['task_id'], None)
+
+def media_duration(file_path):
+    # 再生時間がヘッダーにない形式は、128kbps相当としてファイルサイズから見積もる
+    duration = probe_duration(file_path)
+    if duration is None:
+        duration = os.path.getsize(file_path) / (128000 / 8)
+    return duration
+
+# デバイスごとの処理速度の見積もりと受け付けの上限
+admission = Admission(MAX_BACKLOG_AUDIO_S)
+admission_lock = threading.Lock()
+rejections_total = metrics.Counter('whisper_rejected_total', '混雑のため429で断ったリクエスト数', ['endpoint'])
+
+def admission_devices(device):
+    # device=allの区間はcpu:int8以外のデバイスに分かれる
+    if device == 'all':
+        return [device_id for device_id in device_queues if device_id != CPU_INT8_DEVICE]
+    return [device]
+
+def backlog_audio(devices, statuses=None):
+    # devicesに割り当てられた終わっていないタスクの音声の秒数。device=allのタスクは分割先のデバイスで等分する。
+    # タスクストアから数えるので、マルチプロセス構成でもすべてのHTTPワーカーの受け付けを含む
+    outstanding = task_store.outstanding_audio(statuses)
+    shard_devices = admission_devices('all')
+    shared = outstanding.get('all', 0) / max(len(shard_devices), 1)
+    return sum(outstanding.get(device, 0) + (shared if device in shard_devices else 0) for device in devices)
+
+def check_admission(device, duration):
+    # 受け付けるとデバイスの未処理の音声がMAX_BACKLOG_AUDIO_Sを超える場合はOverloadedを送る
+    devices = admission_devices(device)
+    retry_after = admission.retry_after(devices, backlog_audio(devices), duration)
+    if retry_after is not None:
+        raise Overloaded(retry_after)
+
+def overloaded_response(error):
+    rejections_total.inc(endpoint=request.endpoint)
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), 429, {'Retry-After': str(error.retry_after)}
+
+def async_fallback(job, request_started):
+    # 同期リクエストの完了見込みがSYNC_TIMEOUT_Sを超えるなら、プロキシに切られる前に非同期の応答を返す
+    if SYNC_TIMEOUT_S <= 0:
+        return None
+    task = get_task(job['task_id'])
+    if task is None or task['status'] in FINISHED_STATUSES:
+        return None
+    remaining = estimated_remaining(job['task_id'], task)
+    if remaining is None or time.time() - request_started + remaining <= SYNC_TIMEOUT_S:
+        return None
+    return jsonify({"task_id": job['task_id'], "async": True, "eta_seconds": remaining}), 202
+
+def estimated_remaining(task_id, task):
+    # 完了までの残り秒数の見込み。音声の長さがわからないタスク（ストリーミング）はNone
+    duration = task.get('duration')
+    devices = admission_devices(task['device'])
+    if duration is None or not devices:
+        return None
+    if task['status'] == 'processing':
+        return max(0.0, (task['started_at'] or time.time()) + admission.estimate(devices, duration) - time.time())
+    queue = device_queues.get(task['device'])
+    ahead = queue.audio_ahead(task_id) if queue else None
+    if ahead is None:
+        # このプロセスのキューにない（別のHTTPワーカーが受けた、分割待ちなど）場合は待機中のすべてを前とみなす
+        ahead = max(0.0, backlog_audio(devices, ('queued',)) - duration)
+    # 処理中のジョブは平均して半分終わっているとみなす
+    processing = backlog_audio(devices, ('processing',)) / 2
+    return admission.estimate(devices, processing + ahead + duration)
+
+def shard_job(options, audio, **fields):
+    # task_idを持たない区間ジョブ。結果はファイルやタスクに書かれずjob['result']に入り、終わるとdoneがセットされる
+    return {**options, 'task_id': None, 'shard': True, 'input_audio': audio, 'done': threading.Event(),
+            'enqueued_at': time.perf_counter(), 'stages': {}, **fields}
+
+def submit_job(file_path, filename, device, options, upload_digest=None, stages=None, client='', duration=None):
+    # すべての文字起こしはこのキューを経由する
+    # stagesにはアップロードの保存など、ジョブ作成前に計測した段階の時間を渡す
+    # clientは公平に順番を回す単位（APIキーまたは接続元）
+    # 上限を超えて受け付けられない場合はOverloadedを送る（アップロードの後始末は呼び出し元で行う）
+    wait_devices()
+    stages = dict(stages or {})
+    if duration is None:
+        with timed(stages, 'probe'):
+            duration = media_duration(file_path)
+    with admission_lock:
+        check_admission(device, duration)
+        task_id = create_task(filename, device, file_path, duration)
+    job = {
+        'task_id': task_id,
+        'transcription_id': str(uuid.uuid4()),
+        'file_path': file_path,
+        'upload_digest': upload_digest,
+        'done': threading.Event(),
+        'cancel': threading.Event(),
+        'enqueued_at': time.perf_counter(),
+        'stages': stages,
+        'duration': duration,
+        'client': client,
+        **options,
+    }
+    register_job(job)
+    if device == 'all':
+        shard_executor.submit(process_sharded, job)
+    else:
+        device_queues[device].submit(job)
+    return job
+
+def submit_cached(file_path, filename, device, options, upload_digest, stages=None):
+    # アップロード内容が既知ならGPUを使わずに完了済みタスクを作る
+    if not upload_digest:
+        return None
+    result = result_cache.get(cache_key('upload', upload_digest, options))
+    if result is None:
+        return None
+    job = {
+        'task_id': create_task(filename, device, file_path),
+        'transcription_id': str(uuid.uuid4()),
+        'file_path': file_path,
+        'done': threading.Event(),
+        'stages': dict(stages or {}),
+        **options,
+    }
+    update_task(job['task_id'], started_at=time.time())
+    finish_job(job, result)
+    job['done'].set()
+    return job
+
+def wait_job(job):
+    # 同期エンドポイント用: 完了を待ってタスクを取り出す
+    job['done'].wait()
+    with task_events_lock:
+        task_events.pop(job['task_id'], None)
+    # 行は残してTTLで消す（消すと文字起こし結果のファイルが掃除で参照中と扱われなくなる）
+    return get_task(job['task_id'])
 
 # HTML Template
 HTML = '''
@@ -62,9 +1082,13 @@ HTML = '''
             <div class="mb-4">
                 <label for="deviceSelect" class="block text-sm font-medium text-gray-700 mb-2">デバイスを選択</label>
                 <select id="deviceSelect" class="mt-1 block w-full pl-3 pr-10 py-2 text-base border-gray-300 focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm rounded-md">
+                    {% if not available_devices %}
+                    <option value="">デバイスを検出中（既定のデバイスを使用）</option>
+                    {% endif %}
                     {% for device_id, device_name in available_devices %}
                     <option value="{{ device_id }}" {% if device_id == default_device %}selected{% endif %}>{{ device_name }}</option>
                     {% endfor %}
+                    <option value="all">すべてのデバイスで分割処理</option>
                 </select>
             </div>
             <!-- ポーリングオプション -->
@@ -106,6 +1130,41 @@ HTML = '''
                     <span class="ml-2 text-gray-700">英語に翻訳</span>
                 </label>
             </div>
+            <div class="mb-4">
+                <label class="inline-flex items-center">
+                    <input type="checkbox" id="bothCheck" class="form-checkbox h-5 w-5 text-blue-600">
+                    <span class="ml-2 text-gray-700">元の言語の文字起こしと英訳を両方作る（1回の処理で済みます）</span>
+                </label>
+            </div>
+            <!-- 推論モード -->
+            <div class="mb-4">
+                <label for="modeSelect" class="block text-sm font-medium text-gray-700 mb-2">推論モード</label>
+                <select id="modeSelect" class="mt-1 block w-full pl-3 pr-10 py-2 text-base border-gray-300 focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm rounded-md">
+                    <option value="chunked" {% if inference_mode == 'chunked' %}selected{% endif %}>並列（ウィンドウを分割してバッチ推論、高速）</option>
+                    <option value="sequential" {% if inference_mode == 'sequential' %}selected{% endif %}>逐次（前後の文脈を引き継ぐ）</option>
+                </select>
+            </div>
+            <!-- VADオプション -->
+            <div class="mb-4">
+                <label class="inline-flex items-center">
+                    <input type="checkbox" id="vadCheck" class="form-checkbox h-5 w-5 text-blue-600" {% if vad_default %}checked{% endif %}>
+                    <span class="ml-2 text-gray-700">無音区間をスキップする（VAD）</span>
+                </label>
+            </div>
+            <!-- ブラウザでの変換 -->
+            <div class="mb-4">
+                <label class="inline-flex items-center">
+                    <input type="checkbox" id="clientDecodeCheck" class="form-checkbox h-5 w-5 text-blue-600">
+                    <span class="ml-2 text-gray-700">ブラウザで16kHzモノラルの音声に変換してから送る（動画などの送信量を減らす）</span>
+                </label>
+            </div>
+            <!-- ストリーミングアップロード -->
+            <div class="mb-4">
+                <label class="inline-flex items-center">
+                    <input type="checkbox" id="streamUploadCheck" class="form-checkbox h-5 w-5 text-blue-600">
+                    <span class="ml-2 text-gray-700">アップロードしながら文字起こしする（ストリーミング）</span>
+                </label>
+            </div>
             <!-- チャンクアップロード設定 -->
             <div class="mb-4">
                 <label class="inline-flex items-center">
@@ -121,6 +1180,18 @@ HTML = '''
                 文字起こし開始
             </button>
         </form>
+        {% if live_available %}
+        <!-- マイクからのライブ文字起こし（デバイス・言語・翻訳は上の設定を使う） -->
+        <div class="mb-8">
+            <button type="button" id="liveButton" class="w-full bg-red-500 hover:bg-red-700 text-white font-bold py-2 px-4 rounded">
+                マイクでライブ文字起こし
+            </button>
+            <div id="liveResult" class="bg-gray-50 p-4 rounded-lg mt-4" style="display: none;">
+                <p class="mb-2 text-gray-500" data-role="state"></p>
+                <p><span data-role="committed"></span><span data-role="tentative" class="text-gray-400"></span></p>
+            </div>
+        </div>
+        {% endif %}
         <div id="results" class="space-y-4"></div>
     </div>
 
@@ -141,9 +1212,14 @@ HTML = '''
             const deviceSelect = document.getElementById('deviceSelect');
             const languageSelect = document.getElementById('languageSelect');
             const translateCheck = document.getElementById('translateCheck');
+            const bothCheck = document.getElementById('bothCheck');
+            const vadCheck = document.getElementById('vadCheck');
+            const modeSelect = document.getElementById('modeSelect');
             const chunkUploadCheck = document.getElementById('chunkUploadCheck');
             const chunkSizeInput = document.getElementById('chunkSizeInput');
             const pollingCheck = document.getElementById('pollingCheck');
+            const streamUploadCheck = document.getElementById('streamUploadCheck');
+            const clientDecodeCheck = document.getElementById('clientDecodeCheck');
             const resultsDiv = document.getElementById('results');
             const submitButton = document.getElementById('submitButton');
             const formElements = document.querySelectorAll('#uploadForm input, #uploadForm select, #uploadForm button');
@@ -164,6 +1240,13 @@ HTML = '''
             const chunkSize = chunkSizeMB * 1024 * 1024; // バイト単位
 
             const usePolling = pollingCheck.checked;
+            const options = {
+                device: deviceSelect.value,
+                language: languageSelect.value,
+                translate: bothCheck.checked ? 'both' : translateCheck.checked,
+                vad: vadCheck.checked,
+                mode: modeSelect.value
+            };
 
             for (let file of fileInput.files) {
                 const resultDiv = document.createElement('div');
@@ -173,26 +1256,49 @@ HTML = '''
                     <p class="mb-2 text-gray-500">文字起こし中...</p>
                 `;
                 resultsDiv.appendChild(resultDiv);
+                // 完了時に送信量と全体の所要時間を表示する
+                resultDiv.dataset.startedAt = performance.now();
 
                 try {
-                    if (usePolling) {
+                    let fileOptions = options;
+                    if (clientDecodeCheck.checked) {
+                        const converted = await decodeInBrowser(file);
+                        if (converted) {
+                            // サーバーはこのWAVをffmpegを通さずに読む
+                            fileOptions = { ...options, originalSize: file.size, clientDecodeSeconds: converted.seconds };
+                            resultDiv.dataset.originalSize = file.size;
+                            resultDiv.dataset.uploadSize = converted.file.size;
+                            file = converted.file;
+                        }
+                    }
+                    if (streamUploadCheck.checked) {
+                        // 先にタスクを作って進捗の受信を始め、送信中に確定した区間から表示する
+                        const taskId = await startStream(file, fileOptions);
+                        watchTranscription(taskId, file.name, resultDiv);
+                        await streamFile(taskId, file);
+                    } else if (usePolling) {
                         let taskId;
                         if (useChunkUpload) {
-                            const finalResponse = await uploadFileInChunksAsync(file, chunkSize, deviceSelect.value, languageSelect.value, translateCheck.checked);
+                            const finalResponse = await uploadFileInChunksAsync(file, chunkSize, fileOptions);
                             taskId = finalResponse.task_id;
                         } else {
-                            const response = await uploadFileAsync(file, deviceSelect.value, languageSelect.value, translateCheck.checked);
+                            const response = await uploadFileAsync(file, fileOptions);
                             taskId = response.task_id;
                         }
 
-                        // ポーリングを開始
-                        pollTranscription(taskId, file.name, resultDiv);
+                        // 進捗の受信を開始（SSEが使えなければポーリング）
+                        watchTranscription(taskId, file.name, resultDiv);
                     } else {
                         let transcriptionData;
                         if (useChunkUpload) {
-                            transcriptionData = await uploadFileInChunks(file, chunkSize, deviceSelect.value, languageSelect.value, translateCheck.checked);
+                            transcriptionData = await uploadFileInChunks(file, chunkSize, fileOptions);
                         } else {
-                            transcriptionData = await uploadFile(file, deviceSelect.value, languageSelect.value, translateCheck.checked);
+                            transcriptionData = await uploadFile(file, fileOptions);
+                        }
+                        if (transcriptionData.async) {
+                            // 完了まで時間がかかる見込みのため、サーバーが非同期に切り替えた
+                            watchTranscription(transcriptionData.task_id, file.name, resultDiv);
+                            continue;
                         }
 
                         resultDiv.innerHTML = `
@@ -205,6 +1311,8 @@ HTML = '''
                                 ダウンロード
                             </a>
                         `;
+                        showTranslation(resultDiv, transcriptionData);
+                        showUploadStats(resultDiv);
                     }
                 } catch (error) {
                     resultDiv.innerHTML = `
@@ -218,12 +1326,16 @@ HTML = '''
             formElements.forEach(element => element.disabled = false);
         });
 
-        async function uploadFile(file, device, language, translate) {
+        function appendOptions(formData, options) {
+            for (const [name, value] of Object.entries(options)) {
+                formData.append(name, value);
+            }
+        }
+
+        async function uploadFile(file, options) {
             const formData = new FormData();
             formData.append('file', file);
-            formData.append('device', device);
-            formData.append('language', language);
-            formData.append('translate', translate);
+            appendOptions(formData, options);
 
             const response = await fetch('/transcribe', {
                 method: 'POST',
@@ -238,12 +1350,10 @@ HTML = '''
             return await response.json();
         }
 
-        async function uploadFileAsync(file, device, language, translate) {
+        async function uploadFileAsync(file, options) {
             const formData = new FormData();
             formData.append('file', file);
-            formData.append('device', device);
-            formData.append('language', language);
-            formData.append('translate', translate);
+            appendOptions(formData, options);
             formData.append('polling', 'true');
 
             const response = await fetch('/transcribe_async', {
@@ -259,89 +1369,116 @@ HTML = '''
             return await response.json();
         }
 
-        async function uploadFileInChunks(file, chunkSize, device, language, translate) {
-            const totalChunks = Math.ceil(file.size / chunkSize);
-            const fileId = generateUUID();
-
-            for (let chunkIndex = 0; chunkIndex < totalChunks; chunkIndex++) {
-                const start = chunkIndex * chunkSize;
-                const end = Math.min(start + chunkSize, file.size);
-                const chunk = file.slice(start, end);
-
-                const formData = new FormData();
-                formData.append('file', chunk);
-                formData.append('device', device);
-                formData.append('language', language);
-                formData.append('translate', translate);
-                formData.append('fileId', fileId);
-                formData.append('chunkIndex', chunkIndex);
-                formData.append('totalChunks', totalChunks);
-
-                const response = await fetch('/transcribe_chunk', {
-                    method: 'POST',
-                    body: formData
-                });
-
-                if (!response.ok) {
-                    const errorData = await response.json();
-                    throw new Error(errorData.error || 'サーバーエラー');
-                }
+        async function startStream(file, options) {
+            const response = await fetch('/transcribe_stream/start', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ...options, fileName: file.name })
+            });
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || 'サーバーエラー');
             }
+            return (await response.json()).task_id;
+        }
 
-            // 全チャンクがアップロードされた後に、サーバーで再構築と文字起こしを行います
-            const finalResponse = await fetch('/transcribe_finalize', {
+        async function streamFile(taskId, file) {
+            // ファイル本体をそのまま送る（サーバーは受信しながらデコードと推論を進める）
+            const response = await fetch(`/transcribe_stream/${taskId}`, {
                 method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ fileId })
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: file
             });
-
-            if (!finalResponse.ok) {
-                const errorData = await finalResponse.json();
+            if (!response.ok) {
+                const errorData = await response.json();
                 throw new Error(errorData.error || 'サーバーエラー');
             }
-
-            return await finalResponse.json();
         }
 
-        async function uploadFileInChunksAsync(file, chunkSize, device, language, translate) {
+        const PARALLEL_UPLOADS = 4; // 同時に送信するチャンク数
+        const CHUNK_RETRIES = 3;
+
+        async function uploadChunks(file, chunkSize, endpoint, polling) {
             const totalChunks = Math.ceil(file.size / chunkSize);
-            const fileId = generateUUID();
+            // 同じファイルを再送した場合は前回のfileIdを使い、受信済みのチャンクを飛ばす
+            const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}:${chunkSize}`;
+            let fileId = localStorage.getItem(resumeKey);
+            let received = new Set();
+            if (fileId) {
+                const statusResponse = await fetch(`/upload_status/${fileId}`);
+                if (statusResponse.ok) {
+                    const status = await statusResponse.json();
+                    received = new Set(status.received);
+                }
+            } else {
+                fileId = generateUUID();
+                localStorage.setItem(resumeKey, fileId);
+            }
 
+            const pending = [];
             for (let chunkIndex = 0; chunkIndex < totalChunks; chunkIndex++) {
+                if (!received.has(chunkIndex)) {
+                    pending.push(chunkIndex);
+                }
+            }
+
+            async function sendChunk(chunkIndex) {
                 const start = chunkIndex * chunkSize;
                 const end = Math.min(start + chunkSize, file.size);
                 const chunk = file.slice(start, end);
 
                 const formData = new FormData();
                 formData.append('file', chunk);
-                formData.append('device', device);
-                formData.append('language', language);
-                formData.append('translate', translate);
                 formData.append('fileId', fileId);
+                formData.append('fileName', file.name);
                 formData.append('chunkIndex', chunkIndex);
                 formData.append('totalChunks', totalChunks);
-                formData.append('polling', 'true');
-
-                const response = await fetch('/transcribe_chunk_async', {
-                    method: 'POST',
-                    body: formData
-                });
+                formData.append('chunkSize', chunkSize);
+                formData.append('totalSize', file.size);
+                if (polling) {
+                    formData.append('polling', 'true');
+                }
 
-                if (!response.ok) {
-                    const errorData = await response.json();
-                    throw new Error(errorData.error || 'サーバーエラー');
+                for (let attempt = 0; ; attempt++) {
+                    try {
+                        const response = await fetch(endpoint, {
+                            method: 'POST',
+                            body: formData
+                        });
+                        if (response.ok) {
+                            return;
+                        }
+                        const errorData = await response.json();
+                        throw new Error(errorData.error || 'サーバーエラー');
+                    } catch (error) {
+                        if (attempt + 1 >= CHUNK_RETRIES) {
+                            throw error;
+                        }
+                        await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
+                    }
                 }
             }
 
-            // 最終化
-            const finalResponse = await fetch('/transcribe_finalize_async', {
+            // PARALLEL_UPLOADS本の送信ループで未送信のチャンクを順に取り出す
+            const workers = [];
+            for (let i = 0; i < Math.min(PARALLEL_UPLOADS, pending.length); i++) {
+                workers.push((async () => {
+                    while (pending.length > 0) {
+                        await sendChunk(pending.shift());
+                    }
+                })());
+            }
+            await Promise.all(workers);
+            return { fileId, resumeKey };
+        }
+
+        async function finalizeUpload(endpoint, upload, options) {
+            const finalResponse = await fetch(endpoint, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
                 },
-                body: JSON.stringify({ fileId })
+                body: JSON.stringify({ fileId: upload.fileId, ...options })
             });
 
             if (!finalResponse.ok) {
@@ -349,9 +1486,22 @@ HTML = '''
                 throw new Error(errorData.error || 'サーバーエラー');
             }
 
+            localStorage.removeItem(upload.resumeKey);
             return await finalResponse.json();
         }
 
+        async function uploadFileInChunks(file, chunkSize, options) {
+            const upload = await uploadChunks(file, chunkSize, '/transcribe_chunk', false);
+            // 全チャンクがアップロードされた後に、サーバーで文字起こしを行います
+            return await finalizeUpload('/transcribe_finalize', upload, options);
+        }
+
+        async function uploadFileInChunksAsync(file, chunkSize, options) {
+            const upload = await uploadChunks(file, chunkSize, '/transcribe_chunk_async', true);
+            // 最終化
+            return await finalizeUpload('/transcribe_finalize_async', upload, options);
+        }
+
         function generateUUID() { // RFC4122 version 4 compliant UUID
             return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
                 const r = Math.random() * 16 | 0, v = c === 'x' ? r : (r & 0x3 | 0x8);
@@ -374,6 +1524,225 @@ HTML = '''
             });
         }
 
+        function renderCompleted(resultDiv, data) {
+            resultDiv.innerHTML = `
+                <h3 class="font-bold mb-2">${data.filename}</h3>
+                <p class="mb-2">${data.transcription}</p>
+                <button onclick="copyToClipboard(this)" class="bg-green-500 hover:bg-green-700 text-white font-bold py-1 px-2 rounded mr-2">
+                    コピー
+                </button>
+                <a href="/download/${data.id}" class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-1 px-2 rounded">
+                    ダウンロード
+                </a>
+            `;
+            showTranslation(resultDiv, data);
+            showUploadStats(resultDiv);
+        }
+
+        function showTranslation(resultDiv, data) {
+            // translate=bothのときは英訳も並べて表示する
+            if (data.translation == null) {
+                return;
+            }
+            const block = document.createElement('div');
+            block.className = 'mt-4 pt-2 border-t border-gray-200';
+            block.innerHTML = `
+                <h4 class="font-bold mb-2">英訳</h4>
+                <p class="mb-2"></p>
+                <button onclick="copyToClipboard(this)" class="bg-green-500 hover:bg-green-700 text-white font-bold py-1 px-2 rounded mr-2">
+                    コピー
+                </button>
+                <a href="/download/${data.id}?translation=true" class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-1 px-2 rounded">
+                    ダウンロード
+                </a>
+            `;
+            block.querySelector('p').textContent = data.translation;
+            resultDiv.appendChild(block);
+        }
+
+        function showUploadStats(resultDiv) {
+            // ファイルを選んでから結果が出るまでの時間と、ブラウザで変換した場合は減った送信量を表示する
+            const seconds = (performance.now() - Number(resultDiv.dataset.startedAt)) / 1000;
+            let text = `全体の所要時間: ${seconds.toFixed(1)}秒`;
+            if (resultDiv.dataset.originalSize) {
+                const original = Number(resultDiv.dataset.originalSize);
+                const uploaded = Number(resultDiv.dataset.uploadSize);
+                const mb = (bytes) => (bytes / 1024 / 1024).toFixed(1);
+                text += ` / 送信量: ${mb(uploaded)}MB（元のファイル ${mb(original)}MB から ${Math.round((1 - uploaded / original) * 100)}% 削減）`;
+            }
+            const line = document.createElement('p');
+            line.className = 'text-sm text-gray-500 mt-2';
+            line.textContent = text;
+            resultDiv.appendChild(line);
+        }
+
+        async function decodeInBrowser(file) {
+            // ブラウザでデコードして16kHzモノラルに変換し、16bit PCMのWAVにする。
+            // デコードできない形式やメモリに載らない大きさのファイル、変換しても小さくならないファイルはnullを返し、元のファイルを送る
+            const started = performance.now();
+            try {
+                const data = await file.arrayBuffer();
+                // OfflineAudioContextのdecodeAudioDataはそのコンテキストのサンプルレートにリサンプリングする
+                const decoded = await new OfflineAudioContext(1, 1, 16000).decodeAudioData(data);
+                // 1チャンネルの出力先に流してモノラルにミックスする
+                const context = new OfflineAudioContext(1, decoded.length, 16000);
+                const source = context.createBufferSource();
+                source.buffer = decoded;
+                source.connect(context.destination);
+                source.start();
+                const samples = (await context.startRendering()).getChannelData(0);
+                if (44 + samples.length * 2 >= file.size) {
+                    // 元のファイル（ビットレートの低い音声など）の方が小さい
+                    return null;
+                }
+                const converted = new File([encodeWav(samples)], file.name, { type: 'audio/wav', lastModified: file.lastModified });
+                return { file: converted, seconds: (performance.now() - started) / 1000 };
+            } catch (error) {
+                console.warn('ブラウザでの変換に失敗したため元のファイルを送ります', error);
+                return null;
+            }
+        }
+
+        function encodeWav(samples) {
+            const buffer = new ArrayBuffer(44 + samples.length * 2);
+            const view = new DataView(buffer);
+            const writeText = (offset, text) => {
+                for (let i = 0; i < text.length; i++) {
+                    view.setUint8(offset + i, text.charCodeAt(i));
+                }
+            };
+            writeText(0, 'RIFF');
+            view.setUint32(4, 36 + samples.length * 2, true);
+            writeText(8, 'WAVE');
+            writeText(12, 'fmt ');
+            view.setUint32(16, 16, true);
+            view.setUint16(20, 1, true);          // PCM
+            view.setUint16(22, 1, true);          // モノラル
+            view.setUint32(24, 16000, true);
+            view.setUint32(28, 16000 * 2, true);  // バイト/秒
+            view.setUint16(32, 2, true);
+            view.setUint16(34, 16, true);
+            writeText(36, 'data');
+            view.setUint32(40, samples.length * 2, true);
+            for (let i = 0; i < samples.length; i++) {
+                const value = Math.max(-1, Math.min(1, samples[i]));
+                view.setInt16(44 + i * 2, value < 0 ? value * 0x8000 : value * 0x7FFF, true);
+            }
+            return buffer;
+        }
+
+        function renderError(resultDiv, filename, message) {
+            resultDiv.innerHTML = `
+                <h3 class="font-bold mb-2">${filename}</h3>
+                <p class="text-red-500">処理中にエラーが発生しました: ${message}</p>
+            `;
+        }
+
+        function renderCancelled(resultDiv, filename) {
+            resultDiv.innerHTML = `
+                <h3 class="font-bold mb-2">${filename}</h3>
+                <p class="text-gray-500">キャンセルしました</p>
+            `;
+        }
+
+        async function cancelTranscription(taskId, button) {
+            // 待機中なら即座に、処理中なら次のブロックの区切りで止まる（結果はイベントで届く）
+            button.disabled = true;
+            button.textContent = 'キャンセル中...';
+            const response = await fetch(`/tasks/${taskId}`, { method: 'DELETE' });
+            if (!response.ok && response.status !== 409) {
+                button.disabled = false;
+                button.textContent = 'キャンセル';
+            }
+        }
+
+        function formatTime(seconds) {
+            if (seconds === null || seconds === undefined) {
+                return '--:--';
+            }
+            const minutes = Math.floor(seconds / 60);
+            const rest = Math.floor(seconds % 60);
+            return `${String(minutes).padStart(2, '0')}:${String(rest).padStart(2, '0')}`;
+        }
+
+        function formatEta(seconds) {
+            return seconds == null ? '' : `, 残り約${formatTime(seconds)}`;
+        }
+
+        function watchTranscription(taskId, filename, resultDiv) {
+            // SSEで待ち順・進捗・確定したセグメントを受け取る。使えなければポーリングに切り替える
+            if (!window.EventSource) {
+                pollTranscription(taskId, filename, resultDiv);
+                return;
+            }
+
+            resultDiv.innerHTML = `
+                <h3 class="font-bold mb-2">${filename}</h3>
+                <p class="mb-2 text-gray-500" data-role="state">待機中...</p>
+                <button data-role="cancel" class="bg-gray-500 hover:bg-gray-700 text-white font-bold py-1 px-2 rounded mb-2">
+                    キャンセル
+                </button>
+                <div class="text-sm text-gray-700 space-y-1" data-role="segments"></div>
+            `;
+            const cancelButton = resultDiv.querySelector('[data-role="cancel"]');
+            cancelButton.addEventListener('click', () => cancelTranscription(taskId, cancelButton));
+            const stateText = resultDiv.querySelector('[data-role="state"]');
+            const segmentsDiv = resultDiv.querySelector('[data-role="segments"]');
+            const source = new EventSource(`/events/${taskId}`);
+            let finished = false;
+
+            source.addEventListener('queue', (e) => {
+                const data = JSON.parse(e.data);
+                stateText.textContent = `待機中... (${data.queue_position}番目)`;
+            });
+            source.addEventListener('processing', () => {
+                stateText.textContent = '文字起こし中...';
+            });
+            source.addEventListener('progress', (e) => {
+                const data = JSON.parse(e.data);
+                stateText.textContent = `文字起こし中... ${data.percent}%`;
+            });
+            source.addEventListener('segment', (e) => {
+                const data = JSON.parse(e.data);
+                for (const segment of data.segments) {
+                    const line = document.createElement('p');
+                    line.textContent = `[${formatTime(segment.start)}] ${segment.text}`;
+                    segmentsDiv.appendChild(line);
+                }
+            });
+            source.addEventListener('completed', async () => {
+                // イベントには結果の本文が入らないので /status から取得する
+                finished = true;
+                source.close();
+                try {
+                    const response = await fetch(`/status/${taskId}`);
+                    if (!response.ok) {
+                        throw new Error('サーバーエラー');
+                    }
+                    renderCompleted(resultDiv, await response.json());
+                } catch (error) {
+                    renderError(resultDiv, filename, error.message);
+                }
+            });
+            source.addEventListener('cancelled', () => {
+                finished = true;
+                source.close();
+                renderCancelled(resultDiv, filename);
+            });
+            source.addEventListener('error', (e) => {
+                // サーバーから送られたerrorイベントと接続エラーの両方がここに来る
+                if (e.data) {
+                    finished = true;
+                    source.close();
+                    const data = JSON.parse(e.data);
+                    renderError(resultDiv, data.filename, data.error);
+                } else if (!finished && source.readyState === EventSource.CLOSED) {
+                    // 再接続もできない場合はポーリングに切り替える
+                    pollTranscription(taskId, filename, resultDiv);
+                }
+            });
+        }
+
         async function pollTranscription(taskId, filename, resultDiv) {
             resultDiv.innerHTML = `
                 <h3 class="font-bold mb-2">${filename}</h3>
@@ -390,24 +1759,25 @@ HTML = '''
                     }
 
                     const data = await response.json();
-                    if (data.status === 'completed') {
-                        clearInterval(intervalId);
+                    if (data.status === 'queued') {
                         resultDiv.innerHTML = `
-                            <h3 class="font-bold mb-2">${data.filename}</h3>
-                            <p class="mb-2">${data.transcription}</p>
-                            <button onclick="copyToClipboard(this)" class="bg-green-500 hover:bg-green-700 text-white font-bold py-1 px-2 rounded mr-2">
-                                コピー
-                            </button>
-                            <a href="/download/${data.id}" class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-1 px-2 rounded">
-                                ダウンロード
-                            </a>
+                            <h3 class="font-bold mb-2">${filename}</h3>
+                            <p class="mb-2 text-gray-500">待機中... (${data.queue_position ?? "-"}番目, ${Math.round(data.wait_time)}秒経過${formatEta(data.eta_seconds)})</p>
                         `;
-                    } else if (data.status === 'error') {
-                        clearInterval(intervalId);
+                    } else if (data.status === 'processing') {
                         resultDiv.innerHTML = `
-                            <h3 class="font-bold mb-2">${data.filename}</h3>
-                            <p class="text-red-500">処理中にエラーが発生しました: ${data.error}</p>
+                            <h3 class="font-bold mb-2">${filename}</h3>
+                            <p class="mb-2 text-gray-500">文字起こし中...${formatEta(data.eta_seconds)}</p>
                         `;
+                    } else if (data.status === 'completed') {
+                        clearInterval(intervalId);
+                        renderCompleted(resultDiv, data);
+                    } else if (data.status === 'error') {
+                        clearInterval(intervalId);
+                        renderError(resultDiv, data.filename, data.error);
+                    } else if (data.status === 'cancelled') {
+                        clearInterval(intervalId);
+                        renderCancelled(resultDiv, data.filename);
                     }
                 } catch (error) {
                     clearInterval(intervalId);
@@ -418,6 +1788,130 @@ HTML = '''
                 }
             }, pollInterval);
         }
+
+        // マイク音声を16kHzモノラルのPCM16に変換し、100msごとにWebSocketで送る
+        const LIVE_SAMPLE_RATE = 16000;
+        const LIVE_FRAME_SAMPLES = 1600;
+        const LIVE_WORKLET = `
+            class PcmCapture extends AudioWorkletProcessor {
+                process(inputs) {
+                    if (inputs[0].length > 0) {
+                        this.port.postMessage(inputs[0][0].slice());
+                    }
+                    return true;
+                }
+            }
+            registerProcessor('pcm-capture', PcmCapture);
+        `;
+        let liveSession = null;
+
+        const liveButton = document.getElementById('liveButton');
+        if (liveButton) {
+            liveButton.addEventListener('click', () => {
+                if (liveSession) {
+                    stopLive();
+                } else {
+                    startLive().catch((error) => {
+                        stopLive();
+                        document.querySelector('#liveResult [data-role="state"]').textContent = `エラー: ${error.message}`;
+                    });
+                }
+            });
+        }
+
+        async function startLive() {
+            const liveResult = document.getElementById('liveResult');
+            const stateText = liveResult.querySelector('[data-role="state"]');
+            const committedText = liveResult.querySelector('[data-role="committed"]');
+            const tentativeText = liveResult.querySelector('[data-role="tentative"]');
+            liveResult.style.display = 'block';
+            committedText.textContent = '';
+            tentativeText.textContent = '';
+            stateText.textContent = 'マイクを準備中...';
+            liveButton.textContent = '停止';
+            liveSession = {};
+
+            const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+            const context = new AudioContext();
+            liveSession.stream = stream;
+            liveSession.context = context;
+            await context.audioWorklet.addModule(URL.createObjectURL(new Blob([LIVE_WORKLET], { type: 'application/javascript' })));
+
+            const params = new URLSearchParams({
+                device: document.getElementById('deviceSelect').value,
+                language: document.getElementById('languageSelect').value,
+                translate: document.getElementById('translateCheck').checked
+            });
+            const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+            const ws = new WebSocket(`${protocol}//${location.host}/live?${params}`);
+            ws.binaryType = 'arraybuffer';
+            liveSession.ws = ws;
+            ws.onopen = () => {
+                stateText.textContent = '録音中...';
+            };
+            ws.onmessage = (e) => {
+                const data = JSON.parse(e.data);
+                if (data.type === 'error') {
+                    stateText.textContent = `エラー: ${data.error}`;
+                    return;
+                }
+                committedText.textContent += data.committed.map(word => word.text).join('');
+                tentativeText.textContent = data.tentative.map(word => word.text).join('');
+                if (data.type === 'final') {
+                    stateText.textContent = `終了しました（${formatTime(data.audio_seconds)}）`;
+                    ws.close();
+                }
+            };
+            ws.onclose = () => {
+                if (liveSession && liveSession.ws === ws) {
+                    stopLive();
+                }
+            };
+
+            // AudioContextのサンプリング周波数から16kHzへ線形補間で間引く
+            const ratio = context.sampleRate / LIVE_SAMPLE_RATE;
+            let position = 0;
+            let pending = [];
+            const node = new AudioWorkletNode(context, 'pcm-capture');
+            node.port.onmessage = (e) => {
+                const input = e.data;
+                for (; position < input.length - 1; position += ratio) {
+                    const index = Math.floor(position);
+                    const fraction = position - index;
+                    pending.push(input[index] * (1 - fraction) + input[index + 1] * fraction);
+                }
+                position -= input.length;
+                if (pending.length >= LIVE_FRAME_SAMPLES && ws.readyState === WebSocket.OPEN) {
+                    const pcm = new Int16Array(pending.length);
+                    for (let i = 0; i < pending.length; i++) {
+                        pcm[i] = Math.max(-32768, Math.min(32767, Math.round(pending[i] * 32768)));
+                    }
+                    ws.send(pcm.buffer);
+                    pending = [];
+                }
+            };
+            context.createMediaStreamSource(stream).connect(node);
+        }
+
+        function stopLive() {
+            // 録音を止めてサーバーに終了を伝える（最終結果を受け取ったら接続を閉じる）
+            const session = liveSession;
+            liveSession = null;
+            liveButton.textContent = 'マイクでライブ文字起こし';
+            if (!session) {
+                return;
+            }
+            if (session.stream) {
+                session.stream.getTracks().forEach(track => track.stop());
+            }
+            if (session.context) {
+                session.context.close();
+            }
+            if (session.ws && session.ws.readyState === WebSocket.OPEN) {
+                document.querySelector('#liveResult [data-role="state"]').textContent = '確定中...';
+                session.ws.send(JSON.stringify({ type: 'stop' }));
+            }
+        }
     </script>
 </body>
 </html>
@@ -425,66 +1919,758 @@ HTML = '''
 
 @app.route('/')
 def index():
-    return render_template_string(HTML, available_devices=available_devices, default_device=default_device)
+    return render_template_string(HTML, available_devices=available_devices, default_device=default_device,
+                                  vad_default=VAD_DEFAULT, inference_mode=INFERENCE_MODE,
+                                  live_available=Sock is not None)
+
+def build_generate_kwargs(language, translate):
+    generate_kwargs = {}
+    if language != 'auto':
+        generate_kwargs['language'] = language
+    if translate:
+        generate_kwargs['task'] = 'translate'
+    return generate_kwargs
+
+def finish_job(job, result):
+    if job.get('shard'):
+        # 分割された一部分の結果は親ジョブがまとめる
+        job['result'] = result
+        return
+
+    # 文字起こし結果をファイルに保存
+    with timed(job['stages'], 'write'):
+        transcription_path = os.path.join('transcriptions', f"{job['transcription_id']}.txt")
+        with open(transcription_path, 'w', encoding='utf-8') as f:
+            f.write(result["text"])
+        if job['translate'] == 'both':
+            with open(translation_path(job['transcription_id']), 'w', encoding='utf-8') as f:
+                f.write(result.get('translation', {}).get('text', ''))
+
+    # タスクステータスの更新
+    jobs_total.inc(status='completed')
+    storage.discard(job.get('file_path'))
+    unregister_job(job)
+    update_task(job['task_id'], status='completed', id=job['transcription_id'], stages=job['stages'])
+
+def fail_job(job, error):
+    job['error'] = str(error)
+    if not job.get('shard'):
+        jobs_total.inc(status='error')
+        # デコード前に失敗した場合もアップロードを残さない
+        storage.discard(job.get('file_path'))
+        unregister_job(job)
+    update_task(job['task_id'], status='error', error=str(error), stages=job.get('stages'))
+
+class JobCancelled(Exception):
+    pass
+
+def cancelled(job):
+    return job.get('cancel') is not None and job['cancel'].is_set()
+
+def cancel_job(job):
+    # キャンセルされたジョブを終わらせる。区間ジョブは印を付けるだけで、親ジョブがまとめて扱う
+    job['cancelled'] = True
+    if job.get('prepared'):
+        # 始まっていない前処理は取り消し、始まっていれば終わったところで共有メモリのPCMを捨てる
+        prepared = job.pop('prepared')
+        if not prepared.cancel():
+            prepared.add_done_callback(discard_prepared)
+    if job.get('shard'):
+        return
+    jobs_total.inc(status='cancelled')
+    storage.discard(job.get('file_path'))
+    unregister_job(job)
+    update_task(job['task_id'], status='cancelled', stages=job.get('stages'))
+
+def empty_result(job):
+    # 発話がなかったときの結果
+    if job['translate'] == 'both':
+        return {'text': '', 'chunks': [], 'translation': {'text': '', 'chunks': []}}
+    return {'text': '', 'chunks': []}
+
+def store_result(job, result):
+    if job.get('shard'):
+        return
+    if job['translate'] == 'both' and 'translation' not in result:
+        # 英訳のない結果をtranslate=bothのキーで覚えると、後のリクエストに空の英訳を返してしまう
+        return
+    entry = {'text': result['text'], 'chunks': result.get('chunks', [])}
+    if 'translation' in result:
+        entry['translation'] = result['translation']
+    result_cache.put(cache_key('pcm', job['pcm_digest'], job), entry)
+    if job.get('upload_digest'):
+        result_cache.put(cache_key('upload', job['upload_digest'], job), entry)
+
+# デバイス・モードごとの推論速度（実時間秒/音声秒）の移動平均
+inference_rates = {}
+inference_rates_lock = threading.Lock()
+
+def inference_report(device, job, audio_seconds, seconds_per_audio_second):
+    # 逐次モードの実績があれば、それに対する速度比も返す
+    with inference_rates_lock:
+        key = (device, job['mode'])
+        previous = inference_rates.get(key)
+        inference_rates[key] = seconds_per_audio_second if previous is None else 0.8 * previous + 0.2 * seconds_per_audio_second
+        sequential = inference_rates.get((device, 'sequential'))
+    return {
+        'mode': job['mode'],
+        'chunk_length_s': job['chunk_length_s'],
+        'stride_length_s': job['stride_length_s'],
+        'batch_size': job['batch_size'] if job['mode'] == 'chunked' else 1,
+        'audio_seconds': audio_seconds,
+        'inference_seconds': audio_seconds * seconds_per_audio_second,
+        'realtime_factor': seconds_per_audio_second,
+        'speedup_vs_sequential': sequential / seconds_per_audio_second if sequential and seconds_per_audio_second else None,
+    }
+
+def apply_vad(job):
+    # 発話区間だけを推論に回し、あとでタイムスタンプを元の時刻に戻せるよう対応表を残す
+    audio = job['audio']
+    with timed(job['stages'], 'vad'):
+        compacted, timeline = compact_speech(audio, detect_speech(audio))
+    job['input_audio'] = compacted
+    job['timeline'] = timeline
+    job['vad_stats'] = {
+        'total_seconds': len(audio) / SAMPLE_RATE,
+        'removed_seconds': (len(audio) - len(compacted)) / SAMPLE_RATE,
+    }
+
+def discard_prepared(future):
+    if not future.cancelled() and future.exception() is None:
+        discard_pcm(future.result())
+
+def receive_prepared(job):
+    # 前処理プロセスの結果を受け取る。まだ終わっていなければ待ち、その時間をデバイスが前処理を待った時間として記録する
+    wait_start = time.perf_counter()
+    prepared = job.pop('prepared').result()
+    waited = time.perf_counter() - wait_start
+    record_stage(job['stages'], 'decode', prepared['decode_seconds'])
+    if job['vad']:
+        record_stage(job['stages'], 'vad', prepared['vad_seconds'])
+    record_stage(job['stages'], 'preprocess_wait', waited)
+    preprocess_seconds = prepared['decode_seconds'] + prepared['vad_seconds']
+    update_task(job['task_id'], preprocess={
+        'preprocess_seconds': preprocess_seconds,
+        # 推論の順番が来る前に済んでいた分と、デバイスが待った分
+        'prefetched_seconds': max(0.0, preprocess_seconds - waited),
+        'device_idle_seconds': waited,
+    })
+    job['pcm_digest'] = prepared['pcm_digest']
+    job['input_audio'] = take_pcm(prepared)
+    if job['vad']:
+        job['timeline'] = prepared['timeline']
+        job['vad_stats'] = {
+            'total_seconds': prepared['audio_seconds'],
+            'removed_seconds': prepared['audio_seconds'] - prepared['samples'] / SAMPLE_RATE,
+        }
+
+def prepare_job(job):
+    # デコード、結果キャッシュの確認、VADを行う。推論が必要ならTrueを返す
+    if PREPROCESS_IN_POOL:
+        # 先読みされていないジョブ（device=allなど）も前処理プロセスでデコードする
+        if 'prepared' not in job:
+            start_preprocess(job)
+        receive_prepared(job)
+    else:
+        # ffmpegの出力をパイプで受け取り、一時WAVを経由せずメモリ上で扱う
+        with timed(job['stages'], 'decode'):
+            job['audio'] = decode_audio(job['file_path'])
+    # デコード済みなのでアップロードファイルはもう不要
+    storage.discard(job['file_path'])
+    # 再エンコードされた同一音声もヒットするようデコード後のPCMでも引く
+    with timed(job['stages'], 'cache_lookup'):
+        if 'pcm_digest' not in job:
+            job['pcm_digest'] = hashlib.sha256(job['audio']).hexdigest()
+        cached = result_cache.get(cache_key('pcm', job['pcm_digest'], job))
+    if cached is not None:
+        finish_job(job, cached)
+        return False
+    if 'input_audio' not in job:
+        job['input_audio'] = job['audio']
+        if job['vad']:
+            apply_vad(job)
+    if job['vad'] and len(job['input_audio']) == 0:
+        # 発話がなければ推論しない（無音からの幻覚的な出力も防げる）
+        update_task(job['task_id'], vad={**job['vad_stats'], 'estimated_saved_seconds': None})
+        finish_job(job, empty_result(job))
+        store_result(job, empty_result(job))
+        return False
+    update_task(job['task_id'], stages=job['stages'])
+    return True
+
+def start_jobs(jobs):
+    # 処理中にしてデコード等の準備を行い、推論が必要なジョブを返す
+    for job in [job for job in jobs if cancelled(job)]:
+        # 待っている間にキャンセルされた
+        cancel_job(job)
+    jobs = [job for job in jobs if not job.get('cancelled')]
+    for job in jobs:
+        if 'enqueued_at' in job:
+            record_stage(job['stages'], 'queue', time.perf_counter() - job.pop('enqueued_at'))
+        update_task(job['task_id'], status='processing', started_at=time.time())
+
+    ready = []
+    for job in jobs:
+        if 'input_audio' in job:
+            # device=allで分割された区間などは準備済み
+            ready.append(job)
+            continue
+        try:
+            if prepare_job(job):
+                ready.append(job)
+        except Exception as e:
+            fail_job(job, e)
+    # デコード中にキャンセルされたものは推論しない
+    for job in [job for job in ready if cancelled(job)]:
+        cancel_job(job)
+    return [job for job in ready if not job.get('cancelled')]
+
+def complete_job(job, result, inference):
+    if job.get('vad_stats'):
+        # 除いた区間にかかったはずの推論時間を見積もる
+        saved = job['vad_stats']['removed_seconds'] * inference['realtime_factor']
+        update_task(job['task_id'], vad={**job['vad_stats'], 'estimated_saved_seconds': saved})
+    job['inference'] = inference
+    update_task(job['task_id'], inference=inference)
+    finish_job(job, result)
+    with timed(job['stages'], 'cache_store'):
+        store_result(job, result)
+
+def process_batch(device, jobs):
+    # 同じデバイス・同じ生成設定のジョブをまとめて処理する
+    # 準備（前処理の結果の受け取りなど）の間はデバイスが推論していない
+    prepare_start = time.perf_counter()
+    ready = start_jobs(jobs)
+    worker_idle_seconds.inc(time.perf_counter() - prepare_start, device=device, reason='preprocess')
+    if not ready:
+        return
 
-def process_transcription(file_path, device, language, translate, transcription_id, task_id=None):
     try:
-        # ファイルが動画かどうかをチェック
-        if file_path.lower().endswith(('.mp4', '.mkv', '.avi', '.mov')):
-            # FFmpegを使用してWAVに変換
-            output_wav_path = os.path.join('uploads', f'{uuid.uuid4()}.wav')
-            ffmpeg_result = subprocess.run(['ffmpeg', '-y', '-i', file_path, '-acodec', 'pcm_s16le', '-ar', '16000', output_wav_path],
-                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if ffmpeg_result.returncode != 0:
-                raise Exception("FFmpegによる音声抽出に失敗しました")
-            processing_path = output_wav_path
+        first = ready[0]
+        both = first['translate'] == 'both'
+        if first['mode'] == 'chunked':
+            # 重なりのあるウィンドウに分割し、ジョブをまたいでbatch_size単位で推論して境界で結合する
+            call_kwargs = {'chunk_length_s': first['chunk_length_s'], 'stride_length_s': first['stride_length_s'],
+                           'batch_size': first['batch_size']}
         else:
-            processing_path = file_path
+            # 逐次モード: 前のウィンドウの結果を次のウィンドウの文脈に使う
+            call_kwargs = {}
+
+        # 長い音声は無音位置でPROGRESS_BLOCK_S程度のブロックに分け、ブロックごとに途中結果を通知する。
+        # ブロックはすべて1つのジェネレータで渡すので、ウィンドウのバッチはブロックやジョブをまたいで組まれる。
+        # キャンセルされたジョブの残りのブロックはパイプラインに渡さない（キャンセルはブロックの境界で効く）
+        blocks = []
+        for job in ready:
+            job['partial'] = {'text': [], 'chunks': []}
+            if both:
+                job['partial']['translation'] = {'text': [], 'chunks': []}
+            audio = job['input_audio']
+            spans = split_at_silence(audio, max(1, round(len(audio) / SAMPLE_RATE / PROGRESS_BLOCK_S)))
+            for i, (start, end) in enumerate(spans):
+                blocks.append((job, start, end, i == len(spans) - 1))
 
         # モデルの初期化または取得
-        if device not in model_cache:
-            model_cache[device] = initialize_model(device)
-        pipe = model_cache[device]
-
-        # 生成キーワードの準備
-        generate_kwargs = {}
-        if language != 'auto':
-            generate_kwargs['language'] = language
-        if translate:
-            generate_kwargs['task'] = 'translate'
-
-        # Whisper Turboを使用して文字起こし
-        result = pipe(processing_path, return_timestamps=True, generate_kwargs=generate_kwargs)
-
-        # 文字起こし結果をファイルに保存
-        transcription_path = os.path.join('transcriptions', f'{transcription_id}.txt')
-        with open(transcription_path, 'w', encoding='utf-8') as f:
-            f.write(result["text"])
-
-        # タスクステータスの更新
-        if task_id:
-            with tasks_lock:
-                tasks[task_id]['status'] = 'completed'
-                tasks[task_id]['transcription'] = result["text"]
-                tasks[task_id]['id'] = transcription_id
-                tasks[task_id]['filename'] = os.path.basename(file_path)
+        load_start = time.perf_counter()
+        with model_cache.acquire(device) as pipe:
+            for job in ready:
+                record_stage(job['stages'], 'model_load', time.perf_counter() - load_start)
+            # ジェネレータを渡すと結果は入力順に1件ずつ返る
+            inference_start = time.time()
+            processed_seconds = 0.0
+            fed = deque()
+            encoder_stats = {'computed': 0, 'reused': 0}
+
+            def feed():
+                for block in blocks:
+                    if cancelled(block[0]):
+                        continue
+                    fed.append(block)
+                    yield block[0]['input_audio'][block[1]:block[2]]
+
+            if both:
+                outputs = transcribe_and_translate(pipe, feed(), first['language'], call_kwargs, encoder_stats)
+            else:
+                outputs = pipe((pipeline_input(audio) for audio in feed()), return_timestamps=True,
+                               generate_kwargs=build_generate_kwargs(first['language'], first['translate']),
+                               **call_kwargs)
+            for block_result in outputs:
+                job, start, end, last = fed.popleft()
+                processed_seconds += (end - start) / SAMPLE_RATE
+                if cancelled(job):
+                    continue
+                chunks = offset_chunks(block_result.get('chunks', []), start / SAMPLE_RATE)
+                if job.get('timeline'):
+                    chunks = restore_chunks(chunks, job['timeline'])
+                job['partial']['text'].append(block_result['text'])
+                job['partial']['chunks'].extend(chunks)
+                if both:
+                    translation_chunks = offset_chunks(block_result['translation']['chunks'], start / SAMPLE_RATE)
+                    if job.get('timeline'):
+                        translation_chunks = restore_chunks(translation_chunks, job['timeline'])
+                    job['partial']['translation']['text'].append(block_result['translation']['text'])
+                    job['partial']['translation']['chunks'].extend(translation_chunks)
+                publish_segments(job['task_id'], chunks, end / max(len(job['input_audio']), 1))
+                if job.get('on_block'):
+                    job['on_block'](chunks, end / max(len(job['input_audio']), 1))
+                if not last:
+                    continue
+
+                result = {'text': ''.join(job['partial']['text']), 'chunks': job['partial']['chunks']}
+                if both:
+                    result['translation'] = {'text': ''.join(job['partial']['translation']['text']),
+                                             'chunks': job['partial']['translation']['chunks']}
+                audio_seconds = len(job['input_audio']) / SAMPLE_RATE
+                # ここまでの推論速度（実時間秒/音声秒）
+                record_stage(job['stages'], 'inference', time.time() - inference_start)
+                seconds_per_audio_second = (time.time() - inference_start) / max(processed_seconds, 1e-6)
+                realtime_factor.observe(seconds_per_audio_second, device=device, mode=job['mode'])
+                admission.observe(device, seconds_per_audio_second)
+                inference = inference_report(device, job, audio_seconds, seconds_per_audio_second)
+                if both:
+                    # バッチ全体でエンコーダーを計算した/使い回したウィンドウ数
+                    inference['encoder_windows'] = dict(encoder_stats)
+                complete_job(job, result, inference)
+                job['finished'] = True
+        # 最後のブロックまで終わらなかったのはキャンセルされたジョブ
+        for job in ready:
+            if not job.get('finished'):
+                cancel_job(job)
+    except Exception as e:
+        for job in ready:
+            if job.get('finished'):
+                continue
+            if cancelled(job):
+                cancel_job(job)
+            else:
+                fail_job(job, e)
+        # 追加のクリーンアップが必要な場合はここに記述
 
-        # クリーンアップ
-        os.remove(file_path)
-        if processing_path != file_path:
-            os.remove(processing_path)
+def transcribe_and_translate(pipe, inputs, language, call_kwargs, stats):
+    # translate=both: ブロックごとにtask=transcribeとtask=translateで2回デコードする。
+    # 2回とも同じウィンドウ分割・同じバッチになるので、2回目はエンコーダーの出力をそのまま使い回せる。
+    # デコードの指定がブロックごとに変わるので、ウィンドウのバッチはブロックをまたがない
+    cache = EncoderCache.attach(pipe) if hasattr(pipe, 'model') else None
+    for audio in inputs:
+        with cache.sharing() if cache else nullcontext() as shared:
+            transcription = pipe(pipeline_input(audio), return_timestamps=True,
+                                 generate_kwargs=build_generate_kwargs(language, False), **call_kwargs)
+            translation = pipe(pipeline_input(audio), return_timestamps=True,
+                               generate_kwargs=build_generate_kwargs(language, True), **call_kwargs)
+        if shared:
+            stats['computed'] += shared['computed']
+            stats['reused'] += shared['reused']
+        yield {**transcription, 'translation': {'text': translation['text'], 'chunks': translation.get('chunks', [])}}
+
+def offset_chunks(chunks, offset):
+    # ブロック内の時刻に開始位置を足して音声全体の時刻にする
+    shifted = []
+    for chunk in chunks:
+        start, end = chunk['timestamp']
+        shifted.append({**chunk, 'timestamp': (None if start is None else start + offset,
+                                               None if end is None else end + offset)})
+    return shifted
+
+def publish_segments(task_id, chunks, fraction):
+    publish(task_id, 'segment', {"segments": [
+        {"start": chunk['timestamp'][0], "end": chunk['timestamp'][1], "text": chunk['text']} for chunk in chunks
+    ]})
+    publish(task_id, 'progress', {"percent": round(min(fraction, 1.0) * 100, 1)})
+
+shard_executor = ThreadPoolExecutor(max_workers=SHARD_COORDINATORS, thread_name_prefix='shard')
+
+def shard_slots():
+    # 空いているデバイスのワーカー枠をデバイスが交互になるよう並べる。空きがなければ全デバイスを使う
+    # cpu:int8はcpuと同じコアを使うので分割先にしない
+    queues = [queue for queue in device_queues.values() if queue.device != CPU_INT8_DEVICE]
+    idle = [queue for queue in queues if not queue.jobs and queue.active == 0]
+    targets = idle or queues
+    slots = []
+    for i in range(max(len(queue.workers) for queue in targets)):
+        slots.extend(queue.device for queue in targets if i < len(queue.workers))
+    return slots
+
+def process_sharded(job):
+    # 1つの音声を無音位置で区切り、各デバイス（GPUがなければ複数のCPUワーカー）で同時に推論して結合する
+    started = time.time()
+    record_stage(job['stages'], 'queue', time.perf_counter() - job.pop('enqueued_at'))
+    if cancelled(job):
+        cancel_job(job)
+        job['done'].set()
+        return
+    update_task(job['task_id'], status='processing', started_at=started)
+    try:
+        if not prepare_job(job):
+            return
+        audio = job['input_audio']
+        slots = shard_slots()
+        count = max(1, min(len(slots), int(len(audio) / SAMPLE_RATE // SHARD_MIN_SECONDS)))
+        options = {name: job[name] for name in parse_options({})}
+        shards = []
+        for slot, (start, end) in zip(slots, split_at_silence(audio, count)):
+            # 区間ジョブは親ジョブのキャンセルと利用者を引き継ぐ
+            shard = shard_job(options, audio[start:end], device=slot, offset=start / SAMPLE_RATE, end=end,
+                              cancel=job['cancel'], client=job['client'])
+            device_queues[slot].submit(shard)
+            shards.append(shard)
+        # 区間の開始時刻を足して元の時間軸に並べ直す。前から順に終わった区間の結果を通知する
+        chunks = []
+        translation_chunks = []
+        shard_start = time.perf_counter()
+        for shard in shards:
+            shard['done'].wait()
+            if cancelled(job):
+                raise JobCancelled()
+            if shard.get('error'):
+                raise Exception(shard['error'])
+            shard_chunks = offset_chunks(shard['result'].get('chunks', []), shard['offset'])
+            if job.get('timeline'):
+                shard_chunks = restore_chunks(shard_chunks, job['timeline'])
+            chunks.extend(shard_chunks)
+            if job['translate'] == 'both':
+                translated = offset_chunks(shard['result']['translation']['chunks'], shard['offset'])
+                if job.get('timeline'):
+                    translated = restore_chunks(translated, job['timeline'])
+                translation_chunks.extend(translated)
+            publish_segments(job['task_id'], shard_chunks, shard['end'] / max(len(audio), 1))
+        result = {'text': ''.join(shard['result']['text'] for shard in shards), 'chunks': chunks}
+        if job['translate'] == 'both':
+            result['translation'] = {'text': ''.join(shard['result']['translation']['text'] for shard in shards),
+                                     'chunks': translation_chunks}
+        # 区間ごとの推論時間は各デバイスの段階として記録済みなので、親ジョブは待ち時間全体を記録する
+        record_stage(job['stages'], 'shard_wait', time.perf_counter() - shard_start)
+
+        wall_seconds = time.time() - started
+        audio_seconds = len(audio) / SAMPLE_RATE
+        inference = {
+            'mode': job['mode'],
+            'shards': len(shards),
+            'devices': sorted({shard['device'] for shard in shards}),
+            'audio_seconds': audio_seconds,
+            'wall_seconds': wall_seconds,
+            'realtime_factor': wall_seconds / max(audio_seconds, 1e-6),
+        }
+        if job['translate'] == 'both':
+            inference['encoder_windows'] = {name: sum(shard['inference']['encoder_windows'][name] for shard in shards)
+                                            for name in ('computed', 'reused')}
+        update_task(job['task_id'], inference=inference)
+        realtime_factor.observe(wall_seconds / max(audio_seconds, 1e-6), device='all', mode=job['mode'])
+        if job.get('vad_stats'):
+            saved = job['vad_stats']['removed_seconds'] * wall_seconds / max(audio_seconds, 1e-6)
+            update_task(job['task_id'], vad={**job['vad_stats'], 'estimated_saved_seconds': saved})
+        finish_job(job, result)
+        with timed(job['stages'], 'cache_store'):
+            store_result(job, result)
+    except Exception as e:
+        if cancelled(job):
+            cancel_job(job)
+        else:
+            fail_job(job, e)
+    finally:
+        job['done'].set()
+
+# 受信中のストリーミングアップロード（task_id → 状態）
+streams = {}
+streams_lock = threading.Lock()
+
+def start_stream(filename, device, options, client=''):
+    # ffmpegを起動して、届いたバイト列をそのままデコードに回す。受信したファイルはキャッシュ用にディスクにも残す
+    file_path = os.path.join('uploads', f"{uuid.uuid4()}_{filename}")
+    job = {
+        'task_id': create_task(filename, device, file_path),
+        'transcription_id': str(uuid.uuid4()),
+        'device': device,
+        'done': threading.Event(),
+        'cancel': threading.Event(),
+        'client': client,
+        'stages': {},
+        **options,
+    }
+    state = {
+        'job': job,
+        'decoder': StreamDecoder(),
+        'file_path': file_path,
+        'file': open(file_path, 'wb'),
+        'hasher': hashlib.sha256(),
+        'next_chunk': 0,
+        'pending': {},
+        # 本体を受信中のチャンク番号と、ffmpegに流しているリクエストがあるか（流すのは一度に1つだけ）
+        'receiving': set(),
+        'feeding': False,
+        'closed': False,
+        'closed_event': threading.Event(),
+        'aborted': False,
+        # lockは状態の確認・更新だけに使い、受信中は持たない。feed_lockはファイルとffmpegへの書き込みを閉じる処理と排他にする
+        'lock': threading.Lock(),
+        'feed_lock': threading.Lock(),
+        'last_activity': time.time(),
+        'started': time.perf_counter(),
+    }
+    with streams_lock:
+        streams[job['task_id']] = state
+    register_job(job)
+    threading.Thread(target=process_stream, args=(state,), name=f"stream-{job['task_id'][:8]}", daemon=True).start()
+    return job
+
+def feed_stream(state, data):
+    # state['feeding']を立てたリクエストだけが呼ぶ。state['lock']は持たない。
+    # 受信が打ち切られていればFalseを返す
+    with state['feed_lock']:
+        if state['closed']:
+            return False
+        state['file'].write(data)
+        state['hasher'].update(data)
+        state['decoder'].write(data)
+    state['last_activity'] = time.time()
+    return True
+
+def close_stream(state, aborted=False):
+    # state['lock']を保持した状態で呼ぶ。EOFを受けてデコーダーが残りを出し切る
+    if state['closed']:
+        return
+    with state['feed_lock']:
+        state['aborted'] = aborted
+        state['closed'] = True
+        state['file'].close()
+        state['decoder'].close()
+    state['upload_seconds'] = time.perf_counter() - state['started']
+    state['closed_event'].set()
+    with streams_lock:
+        streams.pop(state['job']['task_id'], None)
+
+def expire_streams():
+    with streams_lock:
+        idle = [state for state in streams.values() if time.time() - state['last_activity'] > STREAM_IDLE_TIMEOUT]
+    for state in idle:
+        with state['lock']:
+            close_stream(state, aborted=True)
+
+def stream_segment(job, audio, offset, slot):
+    # 区間ジョブとしてデバイスのキューに入れる。VADは区間ごとに行い、時刻は区間内で元に戻る
+    options = {name: job[name] for name in parse_options({})}
+    segment = shard_job(options, audio, device=slot, offset=offset / SAMPLE_RATE, end=offset + len(audio),
+                        cancel=job['cancel'], client=job['client'])
+    if job['vad']:
+        compacted, timeline = compact_speech(audio, detect_speech(audio))
+        segment['input_audio'] = compacted
+        segment['timeline'] = timeline
+        job['vad_removed'] = job.get('vad_removed', 0) + (len(audio) - len(compacted)) / SAMPLE_RATE
+    if len(segment['input_audio']) == 0:
+        segment['result'] = empty_result(job)
+        segment['done'].set()
+    else:
+        device_queues[slot].submit(segment)
+    return segment
+
+def process_stream(state):
+    # 受信と並行してデコードし、STREAM_SEGMENT_S秒ごとに無音位置で区切って推論に回す。
+    # 終わった区間から順に途中結果を通知し、最後にまとめる
+    job = state['job']
+    started = time.time()
+    update_task(job['task_id'], status='processing', started_at=started)
+    slots = shard_slots() if job['device'] == 'all' else [job['device']]
+    segments = []
+    collected = {'chunks': [], 'text': [], 'translation_chunks': [], 'translation_text': [], 'next': 0}
+    pcm_hasher = hashlib.sha256()
+    total = [0]
+
+    def submit(audio):
+        segments.append(stream_segment(job, audio, total[0], slots[len(segments) % len(slots)]))
+        total[0] += len(audio)
+
+    def collect(wait):
+        # 先頭から順に、終わった区間の結果を通知する
+        while collected['next'] < len(segments):
+            segment = segments[collected['next']]
+            if not wait and not segment['done'].is_set():
+                return
+            segment['done'].wait()
+            if cancelled(job):
+                raise JobCancelled()
+            if segment.get('error'):
+                raise Exception(segment['error'])
+            chunks = offset_chunks(segment['result'].get('chunks', []), segment['offset'])
+            collected['chunks'].extend(chunks)
+            collected['text'].append(segment['result']['text'])
+            if job['translate'] == 'both':
+                translation = segment['result']['translation']
+                collected['translation_chunks'].extend(offset_chunks(translation['chunks'], segment['offset']))
+                collected['translation_text'].append(translation['text'])
+            if 'first_segment_seconds' not in job:
+                job['first_segment_seconds'] = time.time() - started
+            publish(job['task_id'], 'segment', {"segments": [
+                {"start": chunk['timestamp'][0], "end": chunk['timestamp'][1], "text": chunk['text']}
+                for chunk in chunks
+            ]})
+            collected['next'] += 1
 
+    try:
+        segment_length = int(STREAM_SEGMENT_S * SAMPLE_RATE)
+        search = 10 * SAMPLE_RATE
+        pending = np.zeros(0, dtype=np.float32)
+        decode_error = None
+        try:
+            for block in state['decoder'].blocks():
+                pcm_hasher.update(block)
+                pending = np.concatenate([pending, block])
+                while len(pending) >= segment_length + search:
+                    cut = quietest_cut(pending, segment_length)
+                    submit(pending[:cut])
+                    pending = pending[cut:]
+                collect(wait=False)
+            state['decoder'].wait()
+        except Exception as e:
+            decode_error = e
+        # ffmpegが先に終了した場合も、受信が終わるまで待ってから続ける
+        state['closed_event'].wait()
+        upload_info = client_upload_info(job.get('client_decode') or {}, os.path.getsize(state['file_path']),
+                                         job['stages'])
+        if upload_info:
+            update_task(job['task_id'], client_upload=upload_info)
+        if cancelled(job):
+            raise JobCancelled()
+        if state['aborted']:
+            raise Exception('アップロードが途中で止まったため中断しました')
+        if (decode_error is not None or total[0] + len(pending) == 0) and not segments:
+            # 末尾にインデックスがあるMP4などはパイプから読めないので、受信済みのファイルからデコードし直す
+            with timed(job['stages'], 'decode'):
+                pending = decode_audio(state['file_path'])
+            pcm_hasher = hashlib.sha256(pending)
+            while len(pending) >= segment_length + search:
+                cut = quietest_cut(pending, segment_length)
+                submit(pending[:cut])
+                pending = pending[cut:]
+        elif decode_error is not None:
+            raise decode_error
+        if len(pending):
+            submit(pending)
+        storage.discard(state['file_path'])
+
+        wait_start = time.perf_counter()
+        collect(wait=True)
+        record_stage(job['stages'], 'upload', state['upload_seconds'])
+        record_stage(job['stages'], 'stream_wait', time.perf_counter() - wait_start)
+        result = {'text': ''.join(collected['text']), 'chunks': collected['chunks']}
+        if job['translate'] == 'both':
+            result['translation'] = {'text': ''.join(collected['translation_text']),
+                                     'chunks': collected['translation_chunks']}
+
+        wall_seconds = time.time() - started
+        audio_seconds = total[0] / SAMPLE_RATE
+        inference = {
+            'mode': job['mode'],
+            'streaming': True,
+            'segments': len(segments),
+            'devices': sorted({segment['device'] for segment in segments}),
+            'audio_seconds': audio_seconds,
+            'wall_seconds': wall_seconds,
+            'upload_seconds': state['upload_seconds'],
+            # アップロード完了から結果が出るまでの時間（受信と推論が重なるほど短くなる）
+            'after_upload_seconds': wall_seconds - state['upload_seconds'],
+            'first_segment_seconds': job.get('first_segment_seconds'),
+            'realtime_factor': wall_seconds / max(audio_seconds, 1e-6),
+        }
+        if job['translate'] == 'both':
+            inference['encoder_windows'] = {
+                name: sum(segment['inference']['encoder_windows'][name] for segment in segments if 'inference' in segment)
+                for name in ('computed', 'reused')}
+        if job['vad']:
+            job['vad_stats'] = {'total_seconds': audio_seconds, 'removed_seconds': job.get('vad_removed', 0)}
+        job['pcm_digest'] = pcm_hasher.hexdigest()
+        job['upload_digest'] = state['hasher'].hexdigest()
+        realtime_factor.observe(inference['realtime_factor'], device=job['device'], mode=job['mode'])
+        complete_job(job, result, inference)
     except Exception as e:
-        if task_id:
-            with tasks_lock:
-                tasks[task_id]['status'] = 'error'
-                tasks[task_id]['error'] = str(e)
-                tasks[task_id]['filename'] = os.path.basename(file_path)
-        # 追加のクリーンアップが必要な場合はここに記述
+        if cancelled(job):
+            cancel_job(job)
+        else:
+            fail_job(job, e)
+        storage.discard(state['file_path'])
+    finally:
+        job['done'].set()
+
+# ライブ文字起こし。マイク音声はキューを通さず、デバイスのキャッシュ済みパイプラインで直接認識する
+def recognize_words(device, audio, generate_kwargs):
+    # 語ごとのタイムスタンプ付きで認識し、(開始秒, 終了秒, テキスト)のリストを返す
+    if SERVE_ROLE == 'http':
+        return remote_words(device, audio, generate_kwargs)
+    with model_cache.acquire(device) as pipe:
+        result = pipe(pipeline_input(audio), return_timestamps='word', generate_kwargs=generate_kwargs)
+    return [(chunk['timestamp'][0] or 0.0, chunk['timestamp'][1], chunk['text']) for chunk in result.get('chunks', [])]
+
+def remote_words(device, audio, generate_kwargs):
+    shm = shared_memory.SharedMemory(create=True, size=max(audio.nbytes, 1))
+    try:
+        np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)[:] = audio
+        kind, payload = remote_call(socket_path(device), {'op': 'words', 'shm': shm.name, 'samples': len(audio),
+                                                          'generate_kwargs': generate_kwargs})
+    finally:
+        shm.close()
+        shm.unlink()
+    if kind == 'error':
+        raise Exception(payload)
+    return payload
+
+def live_message(kind, session, agreed, tentative, decode_seconds=None):
+    words = lambda items: [{'start': start, 'end': end, 'text': text} for start, end, text in items]
+    return json.dumps({
+        'type': kind,
+        'committed': words(agreed),
+        'tentative': words(tentative),
+        'committed_until': session.agreement.committed_until,
+        'audio_seconds': session.audio_seconds,
+        'buffer_seconds': session.buffer_seconds,
+        'decode_seconds': decode_seconds,
+    }, ensure_ascii=False)
+
+def process_transcription(file_path, device, language, translate, transcription_id, task_id=None, **options):
+    # 単一ファイルの文字起こし（キューを経由しない直接呼び出し用）
+    job = {
+        'task_id': task_id,
+        'transcription_id': transcription_id,
+        'file_path': file_path,
+        'stages': {},
+        **parse_options(options),
+        'language': language,
+        'translate': translate,
+    }
+    process_batch(device, [job])
+
+def result_payload(task):
+    # 同期エンドポイントの応答
+    return {
+        "transcription": read_transcription(task['id']),
+        "translation": read_translation(task['id']),
+        "id": task['id'],
+        "vad": task.get('vad'),
+        "inference": task.get('inference'),
+        "preprocess": task.get('preprocess'),
+        "client_upload": task.get('client_upload'),
+    }
+
+def failure_response(task):
+    # 同期エンドポイントで完了しなかったタスクの応答
+    if task['status'] == 'cancelled':
+        return jsonify({"error": "文字起こしはキャンセルされました"}), 409
+    return jsonify({"error": f"文字起こし中にエラーが発生しました: {task['error']}"}), 500
+
+def client_id():
+    # 公平に順番を回す単位。APIキーがあればそのハッシュ、なければ接続元のアドレス
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return 'addr:' + (request.remote_addr or '')
+
+def parse_device(value):
+    wait_devices()
+    device = value or default_device
+    if device != 'all' and device not in device_queues:
+        return None
+    return device
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
     # 同期的な文字起こし
+    request_started = time.time()
     if 'file' not in request.files:
         return jsonify({"error": "ファイルがありません"}), 400
     file = request.files['file']
@@ -493,51 +2679,304 @@ def transcribe():
 
     polling = request.form.get('polling', 'false').lower() == 'true'
 
-    device = request.form.get('device', default_device)
-    language = request.form.get('language', 'auto')
-    translate = request.form.get('translate', 'false').lower() == 'true'
+    device = parse_device(request.form.get('device'))
+    if device is None:
+        return jsonify({"error": "無効なデバイスです"}), 400
+    try:
+        options = parse_options(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        # 既に上限を超えていれば保存する前に断る
+        check_admission(device, 0)
+    except Overloaded as e:
+        return overloaded_response(e)
 
     # アップロードされたファイルを保存
     uploads_dir = 'uploads'
     os.makedirs(uploads_dir, exist_ok=True)
     filename = f"{uuid.uuid4()}_{file.filename}"
     file_path = os.path.join(uploads_dir, filename)
-    file.save(file_path)
+    hasher = hashlib.sha256()
+    stages = {}
+    with timed(stages, 'upload'):
+        save_upload(file, file_path, hasher)
+    upload_digest = hasher.hexdigest()
+    upload_info = client_upload_info(request.form, os.path.getsize(file_path), stages)
 
+    try:
+        job = (submit_cached(file_path, file.filename, device, options, upload_digest, stages)
+               or submit_job(file_path, file.filename, device, options, upload_digest, stages, client_id()))
+    except Overloaded as e:
+        storage.discard(file_path)
+        return overloaded_response(e)
+    if upload_info:
+        update_task(job['task_id'], client_upload=upload_info)
     if polling:
         # 非同期処理
-        transcription_id = str(uuid.uuid4())
-        task_id = str(uuid.uuid4())
-        with tasks_lock:
-            tasks[task_id] = {
-                'status': 'processing',
-                'transcription': None,
-                'id': None,
-                'error': None,
-                'filename': file.filename
-            }
-
-        thread = threading.Thread(target=process_transcription, args=(file_path, device, language, translate, transcription_id, task_id))
-        thread.start()
-
-        return jsonify({"task_id": task_id}), 202
+        return jsonify({"task_id": job['task_id']}), 202
     else:
-        # 同期的な処理
-        try:
-            transcription_id = str(uuid.uuid4())
-            process_transcription(file_path, device, language, translate, transcription_id)
-            transcription_path = os.path.join('transcriptions', f'{transcription_id}.txt')
-            with open(transcription_path, 'r', encoding='utf-8') as f:
-                transcription_text = f.read()
-            return jsonify({"transcription": transcription_text, "id": transcription_id})
-        except Exception as e:
-            return jsonify({"error": f"文字起こし中にエラーが発生しました: {str(e)}"}), 500
+        # 同期的な処理（キューの順番を待つ）。完了見込みがプロキシのタイムアウトを超えるなら非同期に切り替える
+        fallback = async_fallback(job, request_started)
+        if fallback is not None:
+            return fallback
+        task = wait_job(job)
+        if task['status'] != 'completed':
+            return failure_response(task)
+        return jsonify(result_payload(task))
 
 @app.route('/transcribe_async', methods=['POST'])
 def transcribe_async():
     # ポーリング有効時の非同期文字起こし
     return transcribe()
 
+@app.route('/transcribe_stream/start', methods=['POST'])
+def transcribe_stream_start():
+    # ストリーミングアップロードの開始。返したtask_idの /events を購読しながら本体を送る
+    data = request.get_json(silent=True) or request.form
+    device = parse_device(data.get('device'))
+    if device is None:
+        return jsonify({"error": "無効なデバイスです"}), 400
+    try:
+        options = parse_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        # 長さは受信するまでわからないので、既に上限を超えているかだけを見る
+        check_admission(device, 0)
+    except Overloaded as e:
+        return overloaded_response(e)
+    filename = os.path.basename(data.get('fileName') or 'stream')
+    os.makedirs('uploads', exist_ok=True)
+    job = start_stream(filename, device, options, client_id())
+    # 受信したバイト数は受信が終わるまでわからないので、元のサイズなどは受信後にまとめる
+    job['client_decode'] = {name: data.get(name) for name in ('originalSize', 'clientDecodeSeconds')}
+    return jsonify({"task_id": job['task_id']}), 202
+
+@app.route('/transcribe_stream/<task_id>', methods=['POST'])
+def transcribe_stream(task_id):
+    # リクエスト本体をそのままffmpegに流す。chunkIndexを付けると分割して送れる（順不同で届いても順に流す）。
+    # 最後の送信（chunkIndexなし、またはlast=true）でwait=trueなら結果を返す
+    with streams_lock:
+        state = streams.get(task_id)
+    if state is None:
+        if get_task(task_id) is None:
+            return jsonify({"error": "タスクが見つかりません"}), 404
+        return jsonify({"error": "このストリームは受信を終了しているか、別のワーカーで受信中です"}), 409
+    chunk_index = request.args.get('chunkIndex')
+    last = chunk_index is None or request.args.get('last', 'false').lower() == 'true'
+    wait = request.args.get('wait', 'false').lower() == 'true'
+    try:
+        chunk_index = 0 if chunk_index is None else int(chunk_index)
+    except ValueError:
+        return jsonify({"error": "chunkIndexが不正です"}), 400
+
+    # 受信中はstate['lock']を持たないので、遅いクライアントがいても他のチャンク、キャンセル、期限切れの処理は待たない
+    with state['lock']:
+        if state['closed']:
+            return jsonify({"error": "このストリームは受信を終了しています"}), 409
+        if (chunk_index < state['next_chunk'] or chunk_index in state['pending']
+                or chunk_index in state['receiving']):
+            return jsonify({"error": "このチャンクは受信済みです"}), 400
+        if last:
+            state['last_chunk'] = chunk_index
+        state['receiving'].add(chunk_index)
+        # 順番どおりのチャンクは読みながら流す
+        streaming = chunk_index == state['next_chunk'] and not state['feeding']
+        if streaming:
+            state['feeding'] = True
+    try:
+        if streaming:
+            fed = True
+            while fed:
+                block = request.stream.read(1 << 20)
+                if not block:
+                    break
+                fed = feed_stream(state, block)
+            data = None
+        else:
+            data = request.stream.read()
+    except Exception:
+        # 途中まで流したチャンクは取り消せないので受信を打ち切る
+        with state['lock']:
+            state['receiving'].discard(chunk_index)
+            if streaming:
+                state['feeding'] = False
+                close_stream(state, aborted=True)
+        raise
+
+    feeding = streaming
+    with state['lock']:
+        state['receiving'].discard(chunk_index)
+        if streaming:
+            state['next_chunk'] += 1
+        else:
+            state['pending'][chunk_index] = data
+            state['last_activity'] = time.time()
+            # 流しているリクエストがなければ、先に届いていた分をこのリクエストが流す
+            if not state['feeding'] and chunk_index == state['next_chunk']:
+                state['feeding'] = feeding = True
+    # 先に届いていた後続のチャンクを順に流す
+    while feeding:
+        with state['lock']:
+            data = state['pending'].pop(state['next_chunk'], None)
+            if data is None or state['closed']:
+                state['feeding'] = feeding = False
+                if state.get('last_chunk') is not None and state['next_chunk'] > state['last_chunk']:
+                    close_stream(state)
+                break
+            state['next_chunk'] += 1
+        feed_stream(state, data)
+    with state['lock']:
+        # 最後まで届いていて別のリクエストがまだ流している途中なら、そちらが受信を終えるのを待つ
+        complete = state.get('last_chunk') is not None and all(
+            index < state['next_chunk'] or index in state['pending'] or index in state['receiving']
+            for index in range(state['last_chunk'] + 1))
+    if complete:
+        state['closed_event'].wait()
+    if state['aborted']:
+        return jsonify({"error": "このストリームは受信を打ち切られました"}), 409
+
+    job = state['job']
+    if not state['closed']:
+        return jsonify({"message": f"チャンク {chunk_index + 1} を受信しました", "task_id": task_id}), 200
+    if not wait:
+        return jsonify({"task_id": task_id}), 202
+    task = wait_job(job)
+    if task['status'] != 'completed':
+        return failure_response(task)
+    return jsonify(result_payload(task))
+
+def live(ws):
+    # ブラウザからは16kHzモノラルのPCM16（リトルエンディアン）をバイナリで送り、終わったら {"type": "stop"} を送る。
+    # 認識のたびに新しく確定した語（committed）と未確定の語（tentative）を返す
+    device = parse_device(request.args.get('device'))
+    if device is None:
+        ws.send(json.dumps({'type': 'error', 'error': '無効なデバイスが指定されました'}, ensure_ascii=False))
+        return
+    if device == 'all':
+        device = default_device
+    generate_kwargs = build_generate_kwargs(request.args.get('language', 'auto'),
+                                            request.args.get('translate', 'false').lower() == 'true')
+    session = LiveTranscriber(lambda audio: recognize_words(device, audio, generate_kwargs),
+                              LIVE_STEP_S, LIVE_TRIM_S, LIVE_MAX_BUFFER_S)
+    stages = {}
+    try:
+        stopped = False
+        while not stopped:
+            message = ws.receive(timeout=LIVE_IDLE_TIMEOUT)
+            if message is None:
+                break
+            # 認識している間に届いたフレームをまとめて取り込み、最新の音声まで含めて認識する
+            while message is not None:
+                if isinstance(message, str):
+                    stopped = json.loads(message).get('type') == 'stop'
+                    if stopped:
+                        break
+                else:
+                    session.feed(np.frombuffer(message, dtype='<i2').astype(np.float32) / 32768.0)
+                message = ws.receive(timeout=0)
+            if not stopped and session.ready():
+                start = time.perf_counter()
+                agreed, tentative = session.step()
+                decode_seconds = time.perf_counter() - start
+                record_stage(stages, 'live_decode', decode_seconds)
+                ws.send(live_message('update', session, agreed, tentative, decode_seconds))
+        ws.send(live_message('final', session, session.finish(), []))
+    except ConnectionClosed:
+        pass
+    except Exception as e:
+        ws.send(json.dumps({'type': 'error', 'error': str(e)}, ensure_ascii=False))
+
+if Sock is not None:
+    Sock(app).route('/live')(live)
+
+# チャンクアップロードの状態。チャンクは temp_chunks/<fileId>/data の該当オフセットに直接書き込む
+upload_states = {}
+upload_states_lock = threading.Lock()
+
+def upload_dir(file_id):
+    return os.path.join('temp_chunks', file_id)
+
+def load_upload_state(file_id, meta=None):
+    # メモリ上になければディスクのmeta.json/receivedから復元する（再起動後の再開用）
+    with upload_states_lock:
+        state = upload_states.get(file_id)
+        if state is not None:
+            return state
+        temp_dir = upload_dir(file_id)
+        meta_path = os.path.join(temp_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            received = set()
+            received_path = os.path.join(temp_dir, 'received')
+            if os.path.exists(received_path):
+                with open(received_path, 'r') as f:
+                    received = {int(line) for line in f if line.strip()}
+        elif meta is not None:
+            os.makedirs(temp_dir, exist_ok=True)
+            # 別のHTTPワーカーが同時に作成していても書き込み済みの内容を消さないよう追記モードで開く
+            with open(os.path.join(temp_dir, 'data'), 'ab') as f:
+                # 全体サイズ分を先に確保しておく
+                if hasattr(os, 'posix_fallocate') and meta['total_size'] > 0:
+                    os.posix_fallocate(f.fileno(), 0, meta['total_size'])
+                else:
+                    f.truncate(meta['total_size'])
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+            received = set()
+        else:
+            return None
+        state = {
+            'meta': meta,
+            'received': received,
+            'lock': threading.Lock(),
+            # 先頭から連続して届いた範囲だけを逐次ハッシュする（再起動で失われた場合は使わない）
+            'hasher': hashlib.sha256() if not received else None,
+            'hashed_chunks': 0,
+            'hash_lock': threading.Lock(),
+        }
+        upload_states[file_id] = state
+        return state
+
+def refresh_received(file_id, state):
+    # 複数プロセス構成では別のHTTPワーカーが受け取ったチャンクもあるのでディスクの記録を読み直す
+    received_path = os.path.join(upload_dir(file_id), 'received')
+    if not os.path.exists(received_path):
+        return
+    with open(received_path, 'r') as f:
+        received = {int(line) for line in f if line.strip()}
+    with state['lock']:
+        state['received'] |= received
+    advance_upload_hash(file_id, state)
+
+def chunk_range(meta, chunk_index):
+    start = chunk_index * meta['chunk_size']
+    return start, min(start + meta['chunk_size'], meta['total_size'])
+
+def advance_upload_hash(file_id, state):
+    # 連続して受信済みになった部分を書き込み直後（ページキャッシュ上）に読んでハッシュへ加える
+    with state['hash_lock']:
+        if state['hasher'] is None:
+            return
+        with open(os.path.join(upload_dir(file_id), 'data'), 'rb') as f:
+            while True:
+                with state['lock']:
+                    if state['hashed_chunks'] not in state['received']:
+                        return
+                start, end = chunk_range(state['meta'], state['hashed_chunks'])
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    block = f.read(min(remaining, 1 << 20))
+                    if not block:
+                        break
+                    state['hasher'].update(block)
+                    remaining -= len(block)
+                state['hashed_chunks'] += 1
+
 @app.route('/transcribe_chunk', methods=['POST'])
 def transcribe_chunk():
     # 同期的なチャンクアップロード処理
@@ -547,50 +2986,75 @@ def transcribe_chunk():
     if chunk.filename == '':
         return jsonify({"error": "ファイルが選択されていません"}), 400
 
-    device = request.form.get('device', default_device)
-    language = request.form.get('language', 'auto')
-    translate = request.form.get('translate', 'false').lower() == 'true'
     file_id = request.form.get('fileId')
     chunk_index = int(request.form.get('chunkIndex', 0))
     total_chunks = int(request.form.get('totalChunks', 1))
+    chunk_size = int(request.form.get('chunkSize', 0))
+    total_size = int(request.form.get('totalSize', -1))
 
     if not file_id:
         return jsonify({"error": "fileIdが提供されていません"}), 400
-
-    # チャンクを保存
-    temp_dir = os.path.join('temp_chunks', file_id)
-    os.makedirs(temp_dir, exist_ok=True)
-    chunk_filename = os.path.join(temp_dir, f'chunk_{chunk_index}')
-    chunk.save(chunk_filename)
+    if os.path.basename(file_id) != file_id:
+        return jsonify({"error": "fileIdが不正です"}), 400
+    if chunk_size <= 0 or total_size < 0:
+        return jsonify({"error": "chunkSizeとtotalSizeが必要です"}), 400
+    if not 0 <= chunk_index < total_chunks:
+        return jsonify({"error": "chunkIndexが範囲外です"}), 400
+
+    state = load_upload_state(file_id, {
+        'total_size': total_size,
+        'chunk_size': chunk_size,
+        'total_chunks': total_chunks,
+        'filename': request.form.get('fileName', f'{file_id}_reconstructed'),
+    })
+    meta = state['meta']
+    if (meta['total_size'], meta['chunk_size'], meta['total_chunks']) != (total_size, chunk_size, total_chunks):
+        return jsonify({"error": "アップロード情報が以前のチャンクと一致しません"}), 400
+
+    # チャンクを最終ファイルの該当オフセットへ直接書き込む
+    start, end = chunk_range(meta, chunk_index)
+    written = 0
+    write_start = time.perf_counter()
+    with open(os.path.join(upload_dir(file_id), 'data'), 'r+b') as f:
+        f.seek(start)
+        while True:
+            block = chunk.stream.read(1 << 20)
+            if not block:
+                break
+            if written + len(block) > end - start:
+                return jsonify({"error": "チャンクのサイズが不正です"}), 400
+            f.write(block)
+            written += len(block)
+    if written != end - start:
+        return jsonify({"error": "チャンクのサイズが不正です"}), 400
+    stage_seconds.observe(time.perf_counter() - write_start, stage='chunk_write')
+
+    with state['lock']:
+        if chunk_index not in state['received']:
+            state['received'].add(chunk_index)
+            with open(os.path.join(upload_dir(file_id), 'received'), 'a') as f:
+                f.write(f'{chunk_index}\n')
+    advance_upload_hash(file_id, state)
 
     return jsonify({"message": f"チャンク {chunk_index + 1}/{total_chunks} を受信しました"}), 200
 
 @app.route('/transcribe_chunk_async', methods=['POST'])
 def transcribe_chunk_async():
     # 非同期的なチャンクアップロード処理
-    if 'file' not in request.files:
-        return jsonify({"error": "ファイルがありません"}), 400
-    chunk = request.files['file']
-    if chunk.filename == '':
-        return jsonify({"error": "ファイルが選択されていません"}), 400
-
-    device = request.form.get('device', default_device)
-    language = request.form.get('language', 'auto')
-    translate = request.form.get('translate', 'false').lower() == 'true'
-    file_id = request.form.get('fileId')
-    chunk_index = int(request.form.get('chunkIndex', 0))
-    total_chunks = int(request.form.get('totalChunks', 1))
-
-    if not file_id:
-        return jsonify({"error": "fileIdが提供されていません"}), 400
-
-    # チャンクを保存
-    temp_dir = os.path.join('temp_chunks', file_id)
-    os.makedirs(temp_dir, exist_ok=True)
-    chunk_filename = os.path.join(temp_dir, f'chunk_{chunk_index}')
-    chunk.save(chunk_filename)
-
-    return jsonify({"message": f"チャンク {chunk_index + 1}/{total_chunks} を受信しました"}), 200
+    return transcribe_chunk()
+
+@app.route('/upload_status/<file_id>')
+def upload_status(file_id):
+    # 再開用: 受信済みのチャンク番号を返す
+    if os.path.basename(file_id) != file_id:
+        return jsonify({"error": "fileIdが不正です"}), 400
+    state = load_upload_state(file_id)
+    if state is None:
+        return jsonify({"received": [], "totalChunks": None})
+    refresh_received(file_id, state)
+    with state['lock']:
+        received = sorted(state['received'])
+    return jsonify({"received": received, "totalChunks": state['meta']['total_chunks']})
 
 @app.route('/transcribe_finalize', methods=['POST'])
 def transcribe_finalize():
@@ -603,125 +3067,440 @@ def transcribe_finalize_async():
     return transcribe_finalize_helper(async_mode=True)
 
 def transcribe_finalize_helper(async_mode=False):
+    request_started = time.time()
     data = request.get_json()
     if not data or 'fileId' not in data:
         return jsonify({"error": "fileIdが提供されていません"}), 400
 
     file_id = data['fileId']
-    temp_dir = os.path.join('temp_chunks', file_id)
-    if not os.path.exists(temp_dir):
+    if os.path.basename(file_id) != file_id:
+        return jsonify({"error": "fileIdが不正です"}), 400
+    state = load_upload_state(file_id)
+    if state is None:
         return jsonify({"error": "チャンクが見つかりません"}), 400
 
     try:
-        # チャンクを番号順に並べて結合
-        chunk_files = sorted([f for f in os.listdir(temp_dir) if f.startswith('chunk_')], key=lambda x: int(x.split('_')[1]))
-        if not chunk_files:
-            return jsonify({"error": "チャンクがありません"}), 400
-
-        reconstructed_file_path = os.path.join('uploads', f'{file_id}_reconstructed')
-        with open(reconstructed_file_path, 'wb') as outfile:
-            for chunk_file in chunk_files:
-                chunk_path = os.path.join(temp_dir, chunk_file)
-                with open(chunk_path, 'rb') as infile:
-                    outfile.write(infile.read())
-
-        # 拡張子から動画かどうかを判定
-        is_video = False
-        if reconstructed_file_path.lower().endswith(('.mp4', '.mkv', '.avi', '.mov')):
-            is_video = True
-
-        if is_video:
-            # FFmpegを使用してWAVに変換
-            output_wav_path = os.path.join('uploads', f'{uuid.uuid4()}.wav')
-            ffmpeg_result = subprocess.run(['ffmpeg', '-y', '-i', reconstructed_file_path, '-acodec', 'pcm_s16le', '-ar', '16000', output_wav_path],
-                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if ffmpeg_result.returncode != 0:
-                return jsonify({"error": "FFmpegによる音声抽出に失敗しました"}), 500
-            processing_path = output_wav_path
-        else:
-            processing_path = reconstructed_file_path
+        device = parse_device(data.get('device'))
+        if device is None:
+            return jsonify({"error": "無効なデバイスです"}), 400
+        try:
+            options = parse_options(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        meta = state['meta']
+        refresh_received(file_id, state)
+        with state['lock']:
+            missing = [i for i in range(meta['total_chunks']) if i not in state['received']]
+            if not missing:
+                # 同じfileIdの最終化が重なると、両方がデータを移動してジョブを二重に登録してしまう
+                if state.get('finalizing'):
+                    return jsonify({"error": "このアップロードは最終化の処理中です"}), 409
+                state['finalizing'] = True
+        if missing:
+            return jsonify({"error": "チャンクがそろっていません", "missing": missing}), 400
+
+        stages = {}
+        temp_dir = upload_dir(file_id)
+        moved = False
+        try:
+            upload_info = client_upload_info(data, meta['total_size'], stages)
+            with timed(stages, 'probe'):
+                duration = media_duration(os.path.join(temp_dir, 'data'))
+            try:
+                # 断る場合はチャンクを残しておき、Retry-Afterの後に同じfileIdで最終化し直せるようにする
+                check_admission(device, duration)
+            except Overloaded as e:
+                return overloaded_response(e)
+
+            with timed(stages, 'reassembly'):
+                with state['hash_lock']:
+                    complete = state['hasher'] is not None and state['hashed_chunks'] == meta['total_chunks']
+                    upload_digest = state['hasher'].hexdigest() if complete else None
+
+                # チャンクは書き込み済みなので、ファイルを移動するだけで再構築は不要
+                reconstructed_file_path = os.path.join('uploads', f'{file_id}_reconstructed')
+                os.replace(os.path.join(temp_dir, 'data'), reconstructed_file_path)
+                moved = True
+                with upload_states_lock:
+                    upload_states.pop(file_id, None)
+                for name in ('meta.json', 'received'):
+                    if os.path.exists(os.path.join(temp_dir, name)):
+                        os.remove(os.path.join(temp_dir, name))
+                os.rmdir(temp_dir)
+        finally:
+            if not moved:
+                # 移動する前に断った・失敗した場合は同じfileIdで最終化し直せるようにする
+                with state['lock']:
+                    state['finalizing'] = False
+
+        # 音声の抽出はワーカー側のデコード処理で行う
+        filename = meta['filename']
+        try:
+            job = (submit_cached(reconstructed_file_path, filename, device, options, upload_digest, stages)
+                   or submit_job(reconstructed_file_path, filename, device, options, upload_digest, stages,
+                                 client_id(), duration))
+        except Overloaded as e:
+            # 確認してから受け付けるまでの間に他のリクエストで上限に達した
+            storage.discard(reconstructed_file_path)
+            return overloaded_response(e)
+        if upload_info:
+            update_task(job['task_id'], client_upload=upload_info)
 
         if async_mode:
             # 非同期処理
-            transcription_id = str(uuid.uuid4())
-            task_id = str(uuid.uuid4())
-            with tasks_lock:
-                tasks[task_id] = {
-                    'status': 'processing',
-                    'transcription': None,
-                    'id': None,
-                    'error': None,
-                    'filename': f'{file_id}_reconstructed'
-                }
-
-            device = request.form.get('device', default_device)
-            language = request.form.get('language', 'auto')
-            translate = request.form.get('translate', 'false').lower() == 'true'
-
-            thread = threading.Thread(target=process_transcription, args=(processing_path, device, language, translate, transcription_id, task_id))
-            thread.start()
-
-            # チャンクの一時ファイルを削除
-            for chunk_file in chunk_files:
-                os.remove(os.path.join(temp_dir, chunk_file))
-            os.rmdir(temp_dir)
-
-            return jsonify({"task_id": task_id}), 202
+            return jsonify({"task_id": job['task_id']}), 202
         else:
-            # 同期処理
-            transcription_id = str(uuid.uuid4())
-            process_transcription(processing_path, device=request.form.get('device', default_device),
-                                  language=request.form.get('language', 'auto'),
-                                  translate=request.form.get('translate', 'false').lower() == 'true',
-                                  transcription_id=transcription_id)
-            # チャンクの一時ファイルを削除
-            for chunk_file in chunk_files:
-                os.remove(os.path.join(temp_dir, chunk_file))
-            os.rmdir(temp_dir)
-
-            # 文字起こし結果を読み取って返す
-            transcription_path = os.path.join('transcriptions', f'{transcription_id}.txt')
-            with open(transcription_path, 'r', encoding='utf-8') as f:
-                transcription_text = f.read()
-            return jsonify({"transcription": transcription_text, "id": transcription_id})
+            # 同期処理。完了見込みがプロキシのタイムアウトを超えるなら非同期に切り替える
+            fallback = async_fallback(job, request_started)
+            if fallback is not None:
+                return fallback
+            task = wait_job(job)
+            if task['status'] != 'completed':
+                return failure_response(task)
+            return jsonify(result_payload(task))
     except Exception as e:
         return jsonify({"error": f"文字起こし中にエラーが発生しました: {str(e)}"}), 500
 
+def eta_fields(task_id, task):
+    # 完了までの残り秒数と完了予定時刻（UNIX時刻）の見込み
+    remaining = estimated_remaining(task_id, task)
+    return {
+        "eta_seconds": remaining,
+        "estimated_completion": None if remaining is None else time.time() + remaining,
+    }
+
 @app.route('/status/<task_id>')
 def status(task_id):
-    with tasks_lock:
-        task = tasks.get(task_id)
-        if not task:
-            return jsonify({"error": "タスクが見つかりません"}), 404
-
-        if task['status'] == 'completed':
-            return jsonify({
-                "status": "completed",
-                "transcription": task['transcription'],
-                "id": task['id'],
-                "filename": task['filename']
-            })
-        elif task['status'] == 'error':
-            return jsonify({
-                "status": "error",
-                "error": task['error'],
-                "filename": task['filename']
-            })
-        else:
-            return jsonify({
-                "status": "processing",
-                "filename": task['filename']
-            })
+    task = get_task(task_id)
+    if not task:
+        return jsonify({"error": "タスクが見つかりません"}), 404
+
+    # キューでの待ち時間（開始済みなら確定値）
+    wait_time = (task['started_at'] or time.time()) - task['enqueued_at']
+
+    if task['status'] == 'completed':
+        return jsonify({
+            "status": "completed",
+            "transcription": read_transcription(task['id']),
+            "translation": read_translation(task['id']),
+            "id": task['id'],
+            "filename": task['filename'],
+            "wait_time": wait_time,
+            "vad": task.get('vad'),
+            "inference": task.get('inference'),
+            "preprocess": task.get('preprocess'),
+            "client_upload": task.get('client_upload'),
+            "stages": task.get('stages')
+        })
+    elif task['status'] == 'error':
+        return jsonify({
+            "status": "error",
+            "error": task['error'],
+            "filename": task['filename'],
+            "wait_time": wait_time,
+            "stages": task.get('stages')
+        })
+    elif task['status'] == 'cancelled':
+        return jsonify({
+            "status": "cancelled",
+            "filename": task['filename'],
+            "wait_time": wait_time,
+            "stages": task.get('stages')
+        })
+    elif task['status'] == 'queued':
+        return jsonify({
+            "status": "queued",
+            "queue_position": device_queues[task['device']].position(task_id) if task['device'] in device_queues else None,
+            "filename": task['filename'],
+            "duration": task.get('duration'),
+            "duration_class": duration_class(task.get('duration')),
+            "wait_time": wait_time,
+            **eta_fields(task_id, task)
+        })
+    else:
+        return jsonify({
+            "status": "processing",
+            "filename": task['filename'],
+            "wait_time": wait_time,
+            "preprocess": task.get('preprocess'),
+            "stages": task.get('stages'),
+            **eta_fields(task_id, task)
+        })
+
+def request_cancel(task_id):
+    # このプロセスにあるジョブをキャンセルする。キューから外せたらTrue、処理中でブロックの境界で止まるならFalse、
+    # このプロセスにジョブがなければNoneを返す
+    with active_jobs_lock:
+        job = active_jobs.get(task_id)
+    if job is None:
+        return None
+    job['cancel'].set()
+    removed = []
+    for queue in device_queues.values():
+        removed.extend(queue.remove(job['cancel']))
+    for item in removed:
+        cancel_job(item)
+        item['done'].set()
+    with streams_lock:
+        state = streams.get(task_id)
+    if state is not None:
+        # 受信中のストリームは受信を打ち切る
+        with state['lock']:
+            close_stream(state, aborted=True)
+    return any(item is job for item in removed)
+
+def watch_cancellations():
+    # 複数プロセス構成では、別のHTTPワーカーが受けたキャンセルをタスクストア経由で知る
+    while True:
+        time.sleep(1)
+        with active_jobs_lock:
+            task_ids = list(active_jobs)
+        for task_id in task_ids:
+            try:
+                task = get_task(task_id)
+            except Exception as e:
+                print(f'キャンセルの確認に失敗しました: {e}')
+                break
+            if task and task.get('cancel_requested'):
+                request_cancel(task_id)
+
+@app.route('/tasks/<task_id>', methods=['DELETE'])
+def cancel_task(task_id):
+    # 待機中のジョブはキューから外し、処理中のジョブは次のブロック（PROGRESS_BLOCK_S）の境界で止めてデバイスを空ける
+    task = get_task(task_id)
+    if task is None:
+        return jsonify({"error": "タスクが見つかりません"}), 404
+    if task['status'] in FINISHED_STATUSES:
+        return jsonify({"error": "このタスクは既に終了しています", "status": task['status']}), 409
+    removed = request_cancel(task_id)
+    if removed:
+        return jsonify({"task_id": task_id, "status": "cancelled"})
+    if removed is None:
+        if SERVE_ROLE == 'http':
+            # 別のHTTPワーカーが持っているジョブは、そのワーカーがタスクストアを見て止める
+            task_store.update(task_id, {'cancel_requested': True})
+            return jsonify({"task_id": task_id, "status": "cancelling"}), 202
+        task = get_task(task_id)
+        if task is not None and task['status'] not in FINISHED_STATUSES:
+            # 処理するジョブが残っていない（前回のプロセスが残したタスクなど）
+            update_task(task_id, status='cancelled')
+            return jsonify({"task_id": task_id, "status": "cancelled"})
+        # 確認している間に終わった
+        return jsonify({"error": "このタスクは既に終了しています"}), 409
+    return jsonify({"task_id": task_id, "status": "cancelling"}), 202
+
+@app.route('/events/<task_id>')
+def events(task_id):
+    # 待ち順・進捗・確定したセグメントをServer-Sent Eventsで送る
+    task = get_task(task_id)
+    if task is None:
+        return jsonify({"error": "タスクが見つかりません"}), 404
+    if not acquire_event_stream():
+        # 接続がスレッドを使い切って他のリクエストに応答できなくならないよう断る。ブラウザはポーリングに切り替える
+        return jsonify({"error": "同時に開けるイベントストリームの上限に達しています。/status をポーリングしてください"}), 503
+    try:
+        index = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        index = 0
+
+    def stream():
+        nonlocal index
+        yield 'retry: 3000\n\n'
+        if task['status'] in FINISHED_STATUSES:
+            # 終了済みのタスクは終了イベントだけを送る
+            event, data = finished_event(task)
+            yield f'id: {index}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+            return
+        while True:
+            pending = wait_events(task_id, index, timeout=15)
+            if not pending:
+                current = get_task(task_id)
+                if current is not None and current['status'] in FINISHED_STATUSES:
+                    # 終了済みでイベント履歴がもう捨てられている。終了イベントだけをタスクの状態から送る
+                    with task_events_lock:
+                        task_events.pop(task_id, None)
+                    event, data = finished_event(current)
+                    yield f'id: {index}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+                    return
+                # プロキシに切られないよう定期的にコメントを送る
+                yield ': keepalive\n\n'
+                continue
+            for event, data in pending:
+                yield f'id: {index}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+                index += 1
+                if event in FINISHED_STATUSES:
+                    return
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # 切断を含め、応答が閉じられたら枠を返す
+    response.call_on_close(release_event_stream)
+    return response
+
+def inference_stats():
+    # 推論プロセスがHTTPワーカーに返す状態
+    return {
+        'ready': startup_state['model'] == 'ready',
+        'models': model_cache.stats(),
+        'peak_memory': local_memory_samples(),
+    }
+
+def remote_stats():
+    stats = {}
+    for device in device_queues:
+        try:
+            stats[device] = remote_call(socket_path(device), {'op': 'stats'})
+        except (OSError, EOFError):
+            stats[device] = None
+    return stats
+
+def model_stats():
+    # マルチプロセス構成では各推論プロセスのモデルキャッシュをまとめる
+    if SERVE_ROLE != 'http':
+        return model_cache.stats()
+    merged = {'hits': 0, 'misses': 0, 'evictions': 0, 'budget_bytes': model_cache.budget_bytes, 'loading': [],
+              'loaded': {}}
+    for stats in remote_stats().values():
+        if stats is None:
+            continue
+        for name in ('hits', 'misses', 'evictions'):
+            merged[name] += stats['models'][name]
+        merged['loading'].extend(stats['models']['loading'])
+        merged['loaded'].update(stats['models']['loaded'])
+    return merged
+
+@app.route('/models')
+def models():
+    # モデルキャッシュの状態（ヒット/ミス、ロード時間、メモリ使用量）
+    return jsonify(model_stats())
+
+@app.route('/cache')
+def cache_stats():
+    # 結果キャッシュのヒット/ミス数と使用量
+    return jsonify(result_cache.stats())
+
+@app.route('/storage')
+def storage_stats():
+    # ディレクトリごとの使用量と、掃除で解放した容量
+    return jsonify(storage.stats())
+
+def local_memory_samples():
+    # デバイスごとのtorchのピークメモリ使用量（CUDAのみ計測できる）
+    samples = []
+    for device in device_queues:
+        if device.startswith('cuda'):
+            import torch
+            samples.append(({'device': device}, torch.cuda.max_memory_allocated(torch.device(device))))
+    return samples
+
+def device_memory_samples():
+    if SERVE_ROLE != 'http':
+        return local_memory_samples()
+    # HTTPワーカーはCUDAを初期化しないので推論プロセスに問い合わせる
+    return [sample for stats in remote_stats().values() if stats for sample in stats['peak_memory']]
+
+def queued_audio_samples(queues):
+    samples = []
+    for queue in queues:
+        with queue.cond:
+            durations = [job['duration'] for job in queue.jobs]
+        for name in ('short', 'medium', 'long'):
+            samples.append(({'device': queue.device, 'class': name},
+                            sum(duration for duration in durations if duration_class(duration) == name)))
+    return samples
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Prometheusのテキスト形式で各種メトリクスを返す
+    queues = list(device_queues.values())
+    cache = model_stats()
+    results = result_cache.stats()
+    task_counts = task_store.counts()
+    disk = storage.stats()
+    text = metrics.render(
+        stage_seconds.render(),
+        realtime_factor.render(),
+        jobs_total.render(),
+        metrics.gauge('whisper_queue_depth', 'デバイスごとの待機中ジョブ数',
+                      [({'device': queue.device}, len(queue.jobs)) for queue in queues]),
+        metrics.gauge('whisper_active_jobs', 'デバイスごとの処理中ジョブ数',
+                      [({'device': queue.device}, queue.active) for queue in queues]),
+        metrics.gauge('whisper_queued_audio_seconds', 'デバイスと長さの分類ごとの待機中の音声の秒数',
+                      queued_audio_samples(queues)),
+        metrics.gauge('whisper_backlog_audio_seconds', 'デバイスごとの終わっていないタスクの音声の秒数（受け付けの上限と比べる値）',
+                      [({'device': queue.device}, backlog_audio([queue.device])) for queue in queues]),
+        metrics.gauge('whisper_estimated_realtime_factor', '完了時刻の見積もりに使うデバイスごとの実時間比',
+                      [({'device': queue.device}, admission.realtime_factor([queue.device])) for queue in queues]),
+        rejections_total.render(),
+        client_decode_saved_bytes.render(),
+        metrics.gauge('whisper_tasks', '状態ごとのタスク数',
+                      [({'status': status}, count) for status, count in sorted(task_counts.items())]),
+        metrics.gauge('whisper_model_loaded_bytes', 'ロード済みモデルのメモリ使用量',
+                      [({'device': device}, entry['bytes']) for device, entry in cache['loaded'].items()]),
+        metrics.gauge('whisper_model_in_use', 'モデルを使用中のワーカー数',
+                      [({'device': device}, entry['in_use']) for device, entry in cache['loaded'].items()]),
+        metrics.gauge('whisper_model_load_seconds', '直近のモデルロード時間',
+                      [({'device': device}, entry['load_seconds']) for device, entry in cache['loaded'].items()
+                       if entry['load_seconds'] is not None]),
+        metrics.gauge('whisper_model_cache_events_total', 'モデルキャッシュのヒット/ミス/解放の累計',
+                      [({'event': name}, cache[name]) for name in ('hits', 'misses', 'evictions')], kind='counter'),
+        metrics.gauge('whisper_result_cache_events_total', '結果キャッシュのヒット/ミス/削除の累計',
+                      [({'event': name}, results[name]) for name in ('hits', 'misses', 'evictions')], kind='counter'),
+        metrics.gauge('whisper_result_cache_bytes', '結果キャッシュの使用量', [({}, results['bytes'])]),
+        metrics.gauge('whisper_torch_peak_memory_bytes', 'デバイスごとのtorchのピークメモリ使用量',
+                      device_memory_samples()),
+        metrics.gauge('whisper_storage_bytes', 'ディレクトリごとの使用量（直近の掃除時点）',
+                      [({'directory': name}, usage['bytes']) for name, usage in sorted(disk['directories'].items())]),
+        metrics.gauge('whisper_storage_entries', 'ディレクトリごとの掃除の対象のエントリ数',
+                      [({'directory': name}, usage['entries']) for name, usage in sorted(disk['directories'].items())]),
+        metrics.gauge('whisper_storage_reclaimed_bytes_total', '掃除とジョブ終了時の削除で解放した容量の累計',
+                      [({'directory': item['directory'], 'reason': item['reason']}, item['bytes'])
+                       for item in disk['reclaimed']], kind='counter'),
+        metrics.gauge('whisper_disk_free_bytes', '作業ディレクトリのディスクの空き容量', [({}, disk['disk']['free_bytes'])]),
+    )
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz')
+def healthz():
+    # プロセスが応答できるか（モデルの準備状況は見ない）
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    # 既定デバイスのモデルがロード・ウォームアップ済みで推論を受けられるか
+    state = {**startup_state, "default_device": default_device,
+             "available_devices": [device_id for device_id, _ in available_devices]}
+    if startup_state['model'] == 'ready':
+        return jsonify({"status": "ready", **state})
+    return jsonify({"status": "starting" if startup_state['error'] is None else "error", **state}), 503
 
 @app.route('/download/<transcription_id>')
 def download(transcription_id):
-    transcription_path = os.path.join('transcriptions', f'{transcription_id}.txt')
+    # translation=trueならtranslate=bothで作った英訳を返す
+    if request.args.get('translation', 'false').lower() == 'true':
+        transcription_path = translation_path(transcription_id)
+    else:
+        transcription_path = os.path.join('transcriptions', f'{transcription_id}.txt')
     if not os.path.exists(transcription_path):
         return jsonify({"error": "ファイルが見つかりません"}), 404
     return send_file(transcription_path, as_attachment=True)
 
+# serve.py（launcher）はデバイス検出だけに、cli.pyは自分でデバイスを検出して使うのでスレッドを起動しない。
+# python app.pyで起動した場合、前処理プロセスはこのファイルを__mp_main__として読み込むので、そこでも起動しない
+if __name__ != '__mp_main__':
+    if SERVE_ROLE in ('', 'http'):
+        threading.Thread(target=evict_tasks, name='task-eviction', daemon=True).start()
+        threading.Thread(target=sweep_storage, name='storage-janitor', daemon=True).start()
+    if SERVE_ROLE == 'http':
+        threading.Thread(target=watch_cancellations, name='cancellations', daemon=True).start()
+        threading.Thread(target=relay_events, name='event-relay', daemon=True).start()
+    if SERVE_ROLE in ('', 'http', 'inference'):
+        threading.Thread(target=start_runtime, name='startup', daemon=True).start()
+
 if __name__ == '__main__':
     os.makedirs('uploads', exist_ok=True)
     os.makedirs('transcriptions', exist_ok=True)
     os.makedirs('temp_chunks', exist_ok=True)
+    task_store.fail_unfinished('サーバーの再起動により処理が中断されました')
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,348 @@
+import bisect
+import hashlib
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Whisperの入力形式（16kHzモノラルfloat32）
+SAMPLE_RATE = 16000
+READ_BLOCK = 1 << 20
+# ffmpegの情報表示にある再生時間（HH:MM:SS.xx）
+DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def ffmpeg_decode_command(source='pipe:0'):
+    # 映像/字幕/データストリームは無視し、音声だけをf32le 16kHzモノラルで標準出力に流す
+    return ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+            '-i', source, '-vn', '-sn', '-dn',
+            '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 'f32le', 'pipe:1']
+
+
+def _drain(stream, tail):
+    # stderrが詰まるとffmpegが止まるので別スレッドで読み捨て、末尾だけ残す
+    for line in iter(stream.readline, b''):
+        tail.append(line)
+    stream.close()
+
+
+def read_pcm(stdout):
+    # 標準出力をブロック単位で読み、倍々に広げるバッファへ直接書き込む（結合コピーなし）
+    buf = bytearray(READ_BLOCK * 8)
+    size = 0
+    view = memoryview(buf)
+    while True:
+        if size + READ_BLOCK > len(buf):
+            view.release()
+            buf.extend(bytes(len(buf)))
+            view = memoryview(buf)
+        n = stdout.readinto(view[size:size + READ_BLOCK])
+        if not n:
+            break
+        size += n
+    view.release()
+    # 使わない末尾を切り詰めてから包む（倍々に広げた分を結果と一緒に持ち続けない）
+    del buf[size - size % 4:]
+    return np.frombuffer(buf, dtype=np.float32)
+
+
+def pcm16_wav_data(header):
+    # 16kHzモノラル・16bit PCMのWAV（ブラウザで変換済みの音声）なら音声データの (開始位置, バイト数) を返す。
+    # それ以外の形式はNone。dataチャンクのサイズが0や上限値（長さ未定のまま書かれたもの）ならNoneを返す
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    position = 12
+    pcm16 = False
+    while position + 8 <= len(header):
+        chunk_id = header[position:position + 4]
+        size = int.from_bytes(header[position + 4:position + 8], 'little')
+        body = position + 8
+        if chunk_id == b'fmt ':
+            fmt = header[body:body + 16]
+            if len(fmt) < 16:
+                return None
+            audio_format = int.from_bytes(fmt[0:2], 'little')
+            channels = int.from_bytes(fmt[2:4], 'little')
+            sample_rate = int.from_bytes(fmt[4:8], 'little')
+            bits = int.from_bytes(fmt[14:16], 'little')
+            pcm16 = (audio_format, channels, sample_rate, bits) == (1, 1, SAMPLE_RATE, 16)
+            if not pcm16:
+                return None
+        elif chunk_id == b'data':
+            if not pcm16 or size in (0, 0xFFFFFFFF):
+                return None
+            return body, size
+        position = body + size + size % 2
+    return None
+
+
+def read_pcm16_wav(file_path):
+    # ブラウザで16kHzモノラルに変換済みのWAVはffmpegを通さずに読む。それ以外の形式はNone
+    with open(file_path, 'rb') as f:
+        header = f.read(4096)
+    data = pcm16_wav_data(header)
+    if data is None:
+        return None
+    offset, size = data
+    # 途中で切れたファイルは読めた分だけを使う
+    size = min(size, os.path.getsize(file_path) - offset)
+    samples = np.fromfile(file_path, dtype='<i2', count=max(size, 0) // 2, offset=offset)
+    return samples.astype(np.float32) / 32768.0
+
+
+def decode_audio(file_path):
+    # コンテナ/コーデックを問わずffmpegでデコードし、一時WAVを作らずにNumPy配列で返す
+    audio = read_pcm16_wav(file_path)
+    if audio is not None:
+        if audio.size == 0:
+            raise Exception("音声ストリームが見つかりません")
+        return audio
+    proc = subprocess.Popen(ffmpeg_decode_command(file_path), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    tail = deque(maxlen=20)
+    drain = threading.Thread(target=_drain, args=(proc.stderr, tail), daemon=True)
+    drain.start()
+    try:
+        audio = read_pcm(proc.stdout)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+        drain.join()
+    if returncode != 0:
+        detail = b''.join(tail).decode('utf-8', 'replace').strip()
+        raise Exception(f"FFmpegによる音声抽出に失敗しました: {detail}")
+    if audio.size == 0:
+        raise Exception("音声ストリームが見つかりません")
+    return audio
+
+
+def probe_duration(file_path):
+    # コンテナのヘッダーにある再生時間（秒）を返す。書かれていない形式（MediaRecorderのWebMなど）はNone。
+    # ffprobeがない環境もあるので、出力ファイルなしで実行したffmpegが表示する情報から読む
+    with open(file_path, 'rb') as f:
+        data = pcm16_wav_data(f.read(4096))
+    if data is not None:
+        return data[1] / (2 * SAMPLE_RATE)
+    try:
+        proc = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', file_path], stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = DURATION_PATTERN.search(proc.stderr.decode('utf-8', 'replace'))
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class StreamDecoder:
+    # 届いた分から順にffmpegの標準入力へ流し込み、デコードされたPCMをブロックごとに取り出す。
+    # 書き込み側と読み出し側は別スレッドで呼ぶ（読まないとffmpegが止まり、書き込みも止まる）
+    def __init__(self):
+        self.proc = subprocess.Popen(ffmpeg_decode_command('pipe:0'), stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.tail = deque(maxlen=20)
+        self.drain = threading.Thread(target=_drain, args=(self.proc.stderr, self.tail), daemon=True)
+        self.drain.start()
+
+    def write(self, data):
+        # ffmpegが先に終了していても（形式の誤りなど）呼び出し側は受信を続けられるようにする
+        try:
+            self.proc.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            pass
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def blocks(self):
+        # float32の境界をまたいだ端数は次のブロックに回す
+        rest = b''
+        while True:
+            data = self.proc.stdout.read1(READ_BLOCK)
+            if not data:
+                break
+            data = rest + data
+            usable = len(data) - len(data) % 4
+            rest = data[usable:]
+            if usable:
+                yield np.frombuffer(data, dtype=np.float32, count=usable // 4)
+
+    def wait(self):
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        self.drain.join()
+        if returncode != 0:
+            detail = b''.join(self.tail).decode('utf-8', 'replace').strip()
+            raise Exception(f"FFmpegによる音声抽出に失敗しました: {detail}")
+
+
+def pipeline_input(audio):
+    # transformersのパイプラインは入力辞書を書き換えるので毎回新しく作る
+    return {'raw': audio, 'sampling_rate': SAMPLE_RATE}
+
+
+def frame_features(audio, frame_length):
+    # フレームごとのエネルギー(dB)とゼロ交差率をベクトル演算で求める
+    n_frames = len(audio) // frame_length
+    frames = audio[:n_frames * frame_length].reshape(n_frames, frame_length)
+    energy_db = 10 * np.log10(np.mean(frames.astype(np.float64) ** 2, axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_length - 1)
+    return energy_db, zcr
+
+
+def runs(mask):
+    # 真が連続する区間の [開始, 終了) フレーム番号
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges.reshape(-1, 2)
+
+
+def detect_speech(audio, frame_ms=30, margin_db=12.0, min_level_db=-55.0, zcr_max=0.35,
+                  min_speech_s=0.25, min_silence_s=0.6, pad_s=0.3):
+    # エネルギーとゼロ交差率による簡易VAD。発話区間をサンプル単位の (開始, 終了) のリストで返す
+    frame_length = SAMPLE_RATE * frame_ms // 1000
+    if len(audio) < frame_length:
+        return [(0, len(audio))] if len(audio) else []
+    energy_db, zcr = frame_features(audio, frame_length)
+
+    # 下位10%のエネルギーを雑音レベルとみなし、そこからmargin_db上を閾値にする。
+    # 無音がほとんどない音声で全体を落とさないよう、上位10%の少し下を超えないようにする
+    floor, peak = np.percentile(energy_db, [10, 90])
+    threshold = max(min(floor + margin_db, peak - 3), min_level_db)
+    speech = energy_db > threshold
+    # 閾値ぎりぎりでゼロ交差が多いフレームは雑音として除く
+    speech &= ~((zcr > zcr_max) & (energy_db < threshold + 6))
+
+    frame_s = frame_ms / 1000
+    regions = []
+    for start, end in runs(speech):
+        if regions and (start - regions[-1][1]) * frame_s < min_silence_s:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+
+    pad = int(pad_s * SAMPLE_RATE)
+    result = []
+    for start, end in regions:
+        if (end - start) * frame_s < min_speech_s:
+            continue
+        start = max(0, start * frame_length - pad)
+        end = min(len(audio), end * frame_length + pad)
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], int(end))
+        else:
+            result.append((int(start), int(end)))
+    return result
+
+
+def split_at_silence(audio, count, search_s=10.0, frame_ms=30):
+    # 音声をおよそ等分するcount個の区間に分ける。各境界は目標位置の前後search_s秒で最も静かなフレームに置く
+    if count <= 1 or len(audio) == 0:
+        return [(0, len(audio))]
+    frame_length = SAMPLE_RATE * frame_ms // 1000
+    energy_db, _ = frame_features(audio, frame_length)
+    search = int(search_s * 1000 / frame_ms)
+    cuts = [0]
+    for k in range(1, count):
+        target = k * len(energy_db) // count
+        lo = max(target - search, cuts[-1] // frame_length + 1)
+        hi = min(target + search, len(energy_db))
+        if lo >= hi:
+            continue
+        quietest = lo + int(np.argmin(energy_db[lo:hi]))
+        cuts.append(quietest * frame_length + frame_length // 2)
+    cuts.append(len(audio))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def quietest_cut(audio, target, search_s=10.0, frame_ms=30):
+    # target（サンプル位置）の前後search_s秒で最も静かなフレームの中央を返す
+    frame_length = SAMPLE_RATE * frame_ms // 1000
+    energy_db, _ = frame_features(audio, frame_length)
+    search = int(search_s * 1000 / frame_ms)
+    center = target // frame_length
+    lo = max(center - search, 1)
+    hi = min(center + search, len(energy_db))
+    if lo >= hi:
+        return target
+    return (lo + int(np.argmin(energy_db[lo:hi]))) * frame_length + frame_length // 2
+
+
+def compact_speech(audio, regions):
+    # 発話区間だけを連結した音声と、連結後の時刻を元の時刻に戻すための対応表を返す
+    if not regions:
+        return audio[:0], []
+    timeline = []
+    position = 0
+    for start, end in regions:
+        timeline.append((position / SAMPLE_RATE, start / SAMPLE_RATE))
+        position += end - start
+    compacted = np.concatenate([audio[start:end] for start, end in regions])
+    return compacted, timeline
+
+
+def restore_timestamp(t, timeline):
+    # 連結後の時刻tを元の音声の時刻に変換する
+    if t is None or not timeline:
+        return t
+    index = bisect.bisect_right([compact for compact, _ in timeline], t) - 1
+    compact, original = timeline[max(index, 0)]
+    return original + (t - compact)
+
+
+def restore_chunks(chunks, timeline):
+    restored = []
+    for chunk in chunks:
+        start, end = chunk['timestamp']
+        restored.append({**chunk, 'timestamp': (restore_timestamp(start, timeline), restore_timestamp(end, timeline))})
+    return restored
+
+
+def prepare_media(path, vad):
+    # 推論の前処理（16kHzモノラルへのデコード、PCMのハッシュ、VAD）。前処理プロセスで実行する。
+    # PCMは1時間で約230MBあるのでpickleせず共有メモリで渡し、戻り値にはその名前とサンプル数だけを入れる。
+    # 受け取る側はtake_pcmで取り出す（使わないならdiscard_pcmで捨てる）。
+    # vadならPCMは発話区間だけを詰めたもので、audio_secondsは元の長さ
+    start = time.perf_counter()
+    audio = decode_audio(path)
+    prepared = {'timeline': None, 'audio_seconds': len(audio) / SAMPLE_RATE,
+                'pcm_digest': hashlib.sha256(audio).hexdigest(), 'decode_seconds': time.perf_counter() - start,
+                'vad_seconds': 0.0}
+    if vad:
+        start = time.perf_counter()
+        audio, prepared['timeline'] = compact_speech(audio, detect_speech(audio))
+        prepared['vad_seconds'] = time.perf_counter() - start
+    shm = shared_memory.SharedMemory(create=True, size=max(audio.nbytes, 1))
+    np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)[:] = audio
+    prepared['shm'] = shm.name
+    prepared['samples'] = len(audio)
+    shm.close()
+    return prepared
+
+
+def take_pcm(prepared):
+    # prepare_mediaが共有メモリに置いたPCMを取り出し、共有メモリを削除する
+    shm = shared_memory.SharedMemory(name=prepared.pop('shm'))
+    try:
+        return np.ndarray((prepared['samples'],), dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def discard_pcm(prepared):
+    # 取り出さずに終わるとき（前処理後のキャンセルなど）に共有メモリを削除する
+    if 'shm' in prepared:
+        shm = shared_memory.SharedMemory(name=prepared.pop('shm'))
+        shm.close()
+        shm.unlink()
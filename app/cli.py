@@ -0,0 +1,248 @@
+# 大量のファイルをまとめて文字起こしする。
+#   python app/cli.py /data/audio --output out/ --devices cuda:0 cuda:1 --decode-workers 8
+# 終わったファイルは <output>/manifest.jsonl に記録し、同じコマンドで再実行すると続きから処理する
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from audio import prepare_media, take_pcm
+
+MEDIA_EXTENSIONS = ('.wav', '.mp3', '.m4a', '.aac', '.flac', '.ogg', '.opus', '.wma', '.webm', '.mp4', '.mkv',
+                    '.mov', '.avi', '.m4v', '.ts')
+
+
+def collect_files(inputs, list_file):
+    # ディレクトリは再帰的にたどり、拡張子が音声/動画のファイルだけを対象にする
+    paths = []
+    if list_file:
+        with open(list_file, 'r', encoding='utf-8') as f:
+            paths.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(MEDIA_EXTENSIONS))
+        else:
+            paths.append(item)
+    return sorted({os.path.abspath(path) for path in paths})
+
+
+def load_manifest(path):
+    # 完了したファイルのパス → 記録。途中で切れた最後の行は無視する
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('status') == 'completed':
+                done[entry['path']] = entry
+            else:
+                done.pop(entry['path'], None)
+    return done
+
+
+class BulkRun:
+    # デコード済みの音声をデバイスのキューに入れ、終わったものから結果とマニフェストを書く
+    def __init__(self, app_module, args, root, files):
+        self.app = app_module
+        self.args = args
+        self.root = root
+        self.files = files
+        self.options = app_module.parse_options({
+            'language': args.language, 'translate': 'both' if args.translate_both else str(args.translate),
+            'vad': str(args.vad),
+            'mode': args.mode or '', 'batch_size': args.batch_size or ''})
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        # 先読みしてメモリに持つ音声の数（デコード中+キュー待ち+推論中）
+        self.slots = threading.BoundedSemaphore(args.prefetch)
+        self.outstanding = {device: 0.0 for device in args.devices}
+        self.manifest = open(os.path.join(args.output, 'manifest.jsonl'), 'a', encoding='utf-8')
+        self.pending = len(files)
+        self.totals = {'completed': 0, 'errors': 0, 'cached': 0, 'audio_seconds': 0.0, 'inference_seconds': 0.0}
+        self.device_seconds = {device: 0.0 for device in args.devices}
+
+    def output_path(self, path, ext):
+        return os.path.join(self.args.output, os.path.relpath(path, self.root) + ext)
+
+    def record(self, path, entry):
+        # 結果ファイルを書いてからマニフェストに追記するので、記録済みなら結果は必ずある
+        with self.lock:
+            self.manifest.write(json.dumps({'path': path, **entry}, ensure_ascii=False) + '\n')
+            self.manifest.flush()
+            os.fsync(self.manifest.fileno())
+            if entry['status'] == 'completed':
+                self.totals['completed'] += 1
+                self.totals['audio_seconds'] += entry['audio_seconds']
+            else:
+                self.totals['errors'] += 1
+            self.pending -= 1
+            done = len(self.files) - self.pending
+            self.finished.notify_all()
+        detail = entry.get('device') or entry.get('error') or '-'
+        print(f"[{done}/{len(self.files)}] {entry['status']} {os.path.relpath(path, self.root)} ({detail})",
+              file=sys.stderr)
+
+    def write_result(self, path, prepared, result, device, inference):
+        text_path = self.output_path(path, '.txt')
+        os.makedirs(os.path.dirname(text_path), exist_ok=True)
+        with open(text_path, 'w', encoding='utf-8') as f:
+            f.write(result['text'])
+        if self.options['translate'] == 'both':
+            with open(self.output_path(path, '.en.txt'), 'w', encoding='utf-8') as f:
+                f.write(result.get('translation', {}).get('text', ''))
+        if self.args.json:
+            with open(self.output_path(path, '.json'), 'w', encoding='utf-8') as f:
+                json.dump({'text': result['text'], 'chunks': result.get('chunks', []),
+                           'translation': result.get('translation'), 'inference': inference},
+                          f, ensure_ascii=False, indent=2)
+        self.record(path, {'status': 'completed', 'output': os.path.relpath(text_path, self.args.output),
+                           'audio_seconds': prepared['audio_seconds'], 'device': device,
+                           'finished_at': time.time()})
+
+    def pick_device(self, audio_seconds):
+        # 未処理の音声が最も少ないデバイスに入れる（速いデバイスほど早く減るので自然に配分される）
+        with self.lock:
+            device = min(self.outstanding, key=self.outstanding.get)
+            self.outstanding[device] += audio_seconds
+        return device
+
+    def on_decoded(self, path, future):
+        try:
+            prepared = future.result()
+            prepared['audio'] = take_pcm(prepared)
+        except Exception as e:
+            self.slots.release()
+            self.record(path, {'status': 'error', 'error': f'デコードに失敗しました: {e}'})
+            return
+        try:
+            self.submit(path, prepared)
+        except Exception as e:
+            self.slots.release()
+            self.record(path, {'status': 'error', 'error': str(e)})
+
+    def submit(self, path, prepared):
+        cache_key = self.app.cache_key('pcm', prepared['pcm_digest'], self.options)
+        cached = self.app.result_cache.get(cache_key)
+        if cached is not None or len(prepared['audio']) == 0:
+            # 同じ音声が既に文字起こし済みか、VADで発話がなかった
+            with self.lock:
+                self.totals['cached'] += cached is not None
+            self.slots.release()
+            self.write_result(path, prepared, cached or {'text': '', 'chunks': []}, None, None)
+            return
+        device = self.pick_device(prepared['audio_seconds'])
+
+        def on_done(job):
+            with self.lock:
+                self.outstanding[device] -= prepared['audio_seconds']
+            self.slots.release()
+            try:
+                if job.get('error'):
+                    raise Exception(job['error'])
+                with self.lock:
+                    self.device_seconds[device] += prepared['audio_seconds']
+                    self.totals['inference_seconds'] += job['inference']['inference_seconds']
+                self.app.result_cache.put(cache_key, {name: job['result'][name] for name in
+                                                      ('text', 'chunks', 'translation') if name in job['result']})
+                self.write_result(path, prepared, job['result'], device, job['inference'])
+            except Exception as e:
+                self.record(path, {'status': 'error', 'error': str(e), 'device': device})
+
+        self.app.device_queues[device].submit(self.app.shard_job(
+            self.options, prepared['audio'], timeline=prepared['timeline'], on_done=on_done))
+
+    def run(self):
+        # spawnで起動するので、デコードプロセスはtorchもappも読み込まない
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.args.decode_workers, mp_context=context) as pool:
+            for path in self.files:
+                self.slots.acquire()
+                future = pool.submit(prepare_media, path, self.options['vad'])
+                future.add_done_callback(lambda future, path=path: self.on_decoded(path, future))
+            with self.lock:
+                while self.pending:
+                    self.finished.wait()
+        self.manifest.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='音声/動画ファイルをまとめて文字起こしする')
+    parser.add_argument('inputs', nargs='*', help='ファイルまたはディレクトリ（再帰的にたどる）')
+    parser.add_argument('--list', help='1行に1パスを書いたファイルリスト')
+    parser.add_argument('--output', required=True, help='結果とmanifest.jsonlを書くディレクトリ')
+    parser.add_argument('--devices', nargs='+', help='使うデバイス（省略時はGPUすべて、なければcpu）')
+    parser.add_argument('--decode-workers', type=int, default=os.cpu_count() or 1, help='デコードするプロセス数')
+    parser.add_argument('--prefetch', type=int, help='メモリに先読みするファイル数（省略時はデバイス数×バッチサイズ×2）')
+    parser.add_argument('--language', default='auto')
+    parser.add_argument('--translate', action='store_true')
+    parser.add_argument('--translate-both', action='store_true',
+                        help='文字起こしと英訳（<ファイル名>.en.txt）を両方書く。エンコーダーの計算は1回で済む')
+    parser.add_argument('--vad', action='store_true', help='無音区間を除いて推論する')
+    parser.add_argument('--mode', choices=('chunked', 'sequential'))
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--json', action='store_true', help='タイムスタンプ付きのJSONも書く')
+    args = parser.parse_args()
+
+    files = collect_files(args.inputs, args.list)
+    if not files:
+        parser.error('対象のファイルがありません')
+    args.output = os.path.abspath(args.output)
+    os.makedirs(args.output, exist_ok=True)
+    # 入力のパス構成を保ったまま出力する
+    root = os.path.commonpath([os.path.dirname(path) for path in files])
+    done = load_manifest(os.path.join(args.output, 'manifest.jsonl'))
+    todo = [path for path in files
+            if path not in done or not os.path.exists(os.path.join(args.output, done[path]['output']))]
+    print(f'{len(files)}件中{len(files) - len(todo)}件は完了済みのためスキップします', file=sys.stderr)
+
+    # デバイスの検出とモデルのロードは自分で行うので、サーバー用のスレッドは起動させない
+    os.environ['SERVE_ROLE'] = 'cli'
+    import app as app_module
+
+    app_module.detect_devices()
+    app_module.devices_ready.set()
+    if not args.devices:
+        args.devices = [device for device in app_module.device_queues if device.startswith('cuda')] or ['cpu']
+    unknown = [device for device in args.devices if device not in app_module.device_queues]
+    if unknown:
+        parser.error(f'不明なデバイスです: {", ".join(unknown)}')
+    if args.prefetch is None:
+        args.prefetch = len(args.devices) * (args.batch_size or app_module.BATCH_SIZE) * 2
+
+    run = BulkRun(app_module, args, root, todo)
+    started = time.time()
+    try:
+        run.run()
+    except KeyboardInterrupt:
+        print('中断しました。同じコマンドで再実行すると続きから処理します', file=sys.stderr)
+        os._exit(130)
+    wall_seconds = time.time() - started
+
+    totals = run.totals
+    print(json.dumps({
+        'files': len(files),
+        'skipped': len(files) - len(todo),
+        'completed': totals['completed'],
+        'errors': totals['errors'],
+        'cache_hits': totals['cached'],
+        'audio_hours': totals['audio_seconds'] / 3600,
+        'wall_hours': wall_seconds / 3600,
+        # 1時間あたりに処理できた音声の時間
+        'audio_hours_per_hour': totals['audio_seconds'] / max(wall_seconds, 1e-6),
+        'inference_seconds': totals['inference_seconds'],
+        'device_audio_hours': {device: seconds / 3600 for device, seconds in run.device_seconds.items()},
+    }, ensure_ascii=False, indent=2))
+    sys.exit(1 if totals['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
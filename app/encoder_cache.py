@@ -0,0 +1,87 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+_attach_lock = threading.Lock()
+# チェックサムで特徴量の一部を間引いて足すときの間隔
+_SAMPLE_STRIDE = 97
+
+
+def _digest(value):
+    # テンソル・配列は形とチェックサム、それ以外はreprをキーにする。
+    # チェックサム（全体の和と間引いた要素の和）はデバイス上で計算し、取り出すのはスカラー2つだけ
+    if hasattr(value, 'shape'):
+        flat = value.reshape(-1)
+        if hasattr(value, 'detach'):
+            import torch
+            sums = torch.stack([flat.sum(dtype=torch.float64), flat[::_SAMPLE_STRIDE].sum(dtype=torch.float64)])
+            checksum = tuple(sums.tolist())
+        else:
+            checksum = (float(flat.sum(dtype=np.float64)), float(flat[::_SAMPLE_STRIDE].sum(dtype=np.float64)))
+        return (tuple(value.shape), str(value.dtype), checksum)
+    return repr(value)
+
+
+class EncoderCache:
+    # Whisperのエンコーダーの出力を入力特徴量ごとに覚えておき、同じウィンドウをtask=transcribeとtask=translateで
+    # 2回デコードするときにエンコーダーの計算を1回で済ませる。
+    # エンコーダーのforwardを差し替えるのはsharing()の中にいるスレッドがあるあいだだけで、覚えるのもそのスレッドの
+    # 呼び出しだけなので、同じモデルを他のワーカーが同時に使っていてもよい
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.forward = encoder.forward
+        # 差し替える前にインスタンス自身がforwardを持っていたか（なければ戻すときに属性を消す）
+        self.own_forward = 'forward' in vars(encoder)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sharers = 0
+
+    @classmethod
+    def attach(cls, pipe):
+        # パイプラインごとに1つ作る
+        with _attach_lock:
+            cache = getattr(pipe, 'encoder_cache', None)
+            if cache is None:
+                cache = pipe.encoder_cache = cls(pipe.model.get_encoder())
+            return cache
+
+    @contextmanager
+    def sharing(self):
+        # この中のエンコーダーの出力を覚えておき、抜けるときに捨てる。
+        # statsのcomputed/reusedは計算した/使い回したウィンドウ数
+        stats = {'computed': 0, 'reused': 0}
+        self.local.entries = {}
+        self.local.stats = stats
+        with self.lock:
+            if self.sharers == 0:
+                # nn.Moduleの呼び出しはインスタンスのforwardを使うので差し替えで割り込める
+                self.encoder.forward = self._forward
+            self.sharers += 1
+        try:
+            yield stats
+        finally:
+            with self.lock:
+                self.sharers -= 1
+                if self.sharers == 0:
+                    if self.own_forward:
+                        self.encoder.forward = self.forward
+                    else:
+                        del self.encoder.forward
+            del self.local.entries
+            del self.local.stats
+
+    def _forward(self, *args, **kwargs):
+        entries = getattr(self.local, 'entries', None)
+        if entries is None:
+            return self.forward(*args, **kwargs)
+        features = kwargs['input_features'] if 'input_features' in kwargs else args[0]
+        key = (tuple(_digest(value) for value in args),
+               tuple(sorted((name, _digest(value)) for name, value in kwargs.items())))
+        windows = len(features)
+        if key in entries:
+            self.local.stats['reused'] += windows
+            return entries[key]
+        output = entries[key] = self.forward(*args, **kwargs)
+        self.local.stats['computed'] += windows
+        return output
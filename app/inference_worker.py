@@ -0,0 +1,106 @@
+import os
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Listener
+
+import numpy as np
+
+import app as app_module
+
+
+def attach(name):
+    # 共有メモリはHTTPワーカーが作成・削除する。こちらのresource_trackerに終了時に削除されないよう登録を外す
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def transcribe(conn, message):
+    shm = attach(message['shm'])
+    audio = np.ndarray((message['samples'],), dtype=np.float32, buffer=shm.buf)
+
+    def on_block(chunks, fraction):
+        # 途中結果はHTTPワーカーに送り、そちらでSSEに流す。切断されていても推論は続ける
+        try:
+            conn.send(('segment', (chunks, fraction)))
+        except OSError:
+            pass
+
+    job = app_module.shard_job(message['options'], audio, timeline=message['timeline'], client=message['client'],
+                               cancel=threading.Event(), on_block=on_block)
+    queue = app_module.device_queues[app_module.INFERENCE_DEVICE]
+    queue.submit(job)
+    listening = True
+    while not job['done'].wait(0.5):
+        # HTTPワーカーからのキャンセルを待つ。待機中ならキューから外し、推論中なら次のブロックの境界で止まる
+        try:
+            if not listening or not conn.poll() or conn.recv().get('op') != 'cancel':
+                continue
+        except (OSError, EOFError):
+            listening = False
+            continue
+        job['cancel'].set()
+        if queue.remove(job['cancel']):
+            app_module.cancel_job(job)
+            break
+    if job.get('cancelled'):
+        conn.send(('cancelled', None))
+    elif job.get('error'):
+        conn.send(('error', job['error']))
+    else:
+        conn.send(('result', {'result': job['result'], 'inference': job['inference'], 'stages': job['stages']}))
+    del job, audio
+    try:
+        shm.close()
+    except BufferError:
+        # パイプラインがまだ配列を参照していればGCで解放される
+        pass
+
+
+def words(conn, message):
+    # ライブ文字起こしの1回分の認識。キューを通さずこのプロセスのパイプラインで直接行う
+    shm = attach(message['shm'])
+    audio = np.array(np.ndarray((message['samples'],), dtype=np.float32, buffer=shm.buf))
+    shm.close()
+    try:
+        conn.send(('result', app_module.recognize_words(app_module.INFERENCE_DEVICE, audio, message['generate_kwargs'])))
+    except Exception as e:
+        conn.send(('error', str(e)))
+
+
+def handle(conn):
+    with conn:
+        try:
+            message = conn.recv()
+            if message['op'] == 'stats':
+                conn.send(app_module.inference_stats())
+            elif message['op'] == 'transcribe':
+                transcribe(conn, message)
+            elif message['op'] == 'words':
+                words(conn, message)
+        except (OSError, EOFError):
+            pass
+
+
+def main():
+    # serve.pyから SERVE_ROLE=inference, INFERENCE_DEVICE=<デバイス> で起動される
+    app_module.devices_ready.wait()
+    if app_module.INFERENCE_DEVICE not in app_module.device_queues:
+        sys.exit(f'不明なデバイスです: {app_module.INFERENCE_DEVICE}')
+    app_module.start_cpu_device(app_module.INFERENCE_DEVICE)
+    address = app_module.socket_path(app_module.INFERENCE_DEVICE)
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family='AF_UNIX', authkey=app_module.INFERENCE_AUTHKEY)
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            print(f'接続の受け付けに失敗しました: {e}')
+            continue
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    main()
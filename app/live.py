@@ -0,0 +1,122 @@
+import numpy as np
+
+from audio import SAMPLE_RATE
+
+# 前回の確定位置より少し前に始まる語は、タイムスタンプの揺れとして確定済みの区間に含める
+COMMIT_TOLERANCE_S = 0.1
+# 確定済みの末尾と同じ語が次の認識結果の先頭に繰り返されたら除く（最大n語）
+MAX_REPEAT_WORDS = 5
+PUNCTUATION = ' 　.,!?、。！？'
+
+
+def normalize(text):
+    return text.strip(PUNCTUATION).lower()
+
+
+class LocalAgreement:
+    # 連続する2回の認識結果で先頭から一致した語だけを確定する（LocalAgreement-2）。
+    # 語は(開始秒, 終了秒, テキスト)で、時刻はストリーム先頭からの絶対時刻
+    def __init__(self):
+        self.committed_until = 0.0
+        self.recent = []
+        self.previous = []
+
+    def _strip_repeats(self, words):
+        if not words or not self.recent or words[0][0] - self.committed_until > 1.0:
+            return words
+        for n in range(min(MAX_REPEAT_WORDS, len(self.recent), len(words)), 0, -1):
+            if [normalize(w[2]) for w in self.recent[-n:]] == [normalize(w[2]) for w in words[:n]]:
+                return words[n:]
+        return words
+
+    def _commit(self, words):
+        if words:
+            self.committed_until = words[-1][1]
+            self.recent = (self.recent + words)[-MAX_REPEAT_WORDS:]
+        return words
+
+    def update(self, words):
+        words = self._strip_repeats([w for w in words if w[0] >= self.committed_until - COMMIT_TOLERANCE_S])
+        agreed = []
+        for previous, word in zip(self.previous, words):
+            if normalize(previous[2]) != normalize(word[2]):
+                break
+            agreed.append(word)
+        self.previous = words[len(agreed):]
+        return self._commit(agreed), self.previous
+
+    def flush(self):
+        # 未確定の語をそのまま確定する（ストリームの終わりやバッファの打ち切り時）
+        words, self.previous = self.previous, []
+        return self._commit(words)
+
+
+class LiveTranscriber:
+    # マイク音声をバッファにためて、未確定の末尾を含むバッファ全体を繰り返し認識する。
+    # バッファはtrim_sを超えたら確定した語の終わりで切り詰め、Whisperの30秒窓に収まるようにする
+    def __init__(self, recognize, step_s=1.0, trim_s=15.0, max_buffer_s=25.0):
+        # recognizeは音声配列を受け取り、配列先頭からの時刻の(開始秒, 終了秒, テキスト)のリストを返す
+        self.recognize = recognize
+        self.step_samples = int(step_s * SAMPLE_RATE)
+        self.trim_s = trim_s
+        self.max_buffer_s = max_buffer_s
+        self.agreement = LocalAgreement()
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.buffer_start = 0.0
+        self.received = 0
+        self.pending = 0
+
+    @property
+    def audio_seconds(self):
+        return self.received / SAMPLE_RATE
+
+    @property
+    def buffer_seconds(self):
+        return len(self.buffer) / SAMPLE_RATE
+
+    def feed(self, samples):
+        self.buffer = np.concatenate([self.buffer, samples])
+        self.received += len(samples)
+        self.pending += len(samples)
+
+    def ready(self):
+        return self.pending >= self.step_samples
+
+    def step(self):
+        # 1回認識して(新たに確定した語, 未確定の語)を返す
+        self.pending = 0
+        if len(self.buffer) == 0:
+            return [], self.agreement.previous
+        duration = self.buffer_seconds
+        words = []
+        for start, end, text in self.recognize(self.buffer):
+            # 最後の語は終了時刻がないことがある
+            end = duration if end is None else min(end, duration)
+            words.append((self.buffer_start + start, self.buffer_start + end, text))
+        agreed, _ = self.agreement.update(words)
+        agreed = agreed + self._trim()
+        return agreed, self.agreement.previous
+
+    def _trim(self):
+        if self.buffer_seconds <= self.trim_s:
+            return []
+        forced = []
+        if self.buffer_seconds > self.max_buffer_s:
+            # 認識結果が安定しないまま伸び続けたら、未確定の語も確定して切り詰める
+            forced = self.agreement.flush()
+        cut = self.agreement.committed_until - self.buffer_start
+        if cut <= 0 and self.buffer_seconds > self.max_buffer_s:
+            # 語が1つもない（無音が続いている）ので古い方を捨てる
+            cut = self.buffer_seconds - self.trim_s
+        if cut > 0:
+            samples = min(int(cut * SAMPLE_RATE), len(self.buffer))
+            self.buffer = self.buffer[samples:]
+            self.buffer_start += samples / SAMPLE_RATE
+        return forced
+
+    def finish(self):
+        # 残りの音声を認識し、未確定の語もすべて確定する
+        agreed = []
+        if self.pending or self.agreement.previous:
+            agreed, _ = self.step()
+        return agreed + self.agreement.flush()
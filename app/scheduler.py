@@ -0,0 +1,59 @@
+import threading
+import time
+
+# 音声の長さによる分類の境界（秒）。状態の表示とメトリクスに使う
+SHORT_MAX_S = 120
+MEDIUM_MAX_S = 1800
+
+
+def duration_class(seconds):
+    if seconds is None:
+        return 'unknown'
+    if seconds <= SHORT_MAX_S:
+        return 'short'
+    if seconds <= MEDIUM_MAX_S:
+        return 'medium'
+    return 'long'
+
+
+class Scheduler:
+    # キューで待っているジョブの処理順を決める。policyがfifoなら到着順、priorityなら次のスコアが小さい順:
+    #   スコア = 音声の秒数 + fair_share_weight × 利用者の最近の利用量（音声秒） − aging × 待った秒数
+    # 利用量は処理を始めたジョブの音声の秒数を半減期half_life秒で減衰させたもの。
+    # 待つほどスコアは下がり続けるので、長い音声や利用の多い利用者のジョブもいずれ先頭になる
+    def __init__(self, policy='priority', aging=10.0, fair_share_weight=1.0, half_life=600.0):
+        self.policy = policy
+        self.aging = aging
+        self.fair_share_weight = fair_share_weight
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        # 利用者 → (利用量, 最後に更新した時刻)
+        self.usage = {}
+
+    def _usage(self, client, now):
+        value, updated = self.usage.get(client, (0.0, now))
+        if not self.half_life:
+            return 0.0
+        return value * 0.5 ** ((now - updated) / self.half_life)
+
+    def score(self, job, now):
+        # nowはtime.perf_counter()の値（job['enqueued_at']と同じ時計）
+        waited = now - job['enqueued_at']
+        if self.policy == 'fifo':
+            return -waited
+        with self.lock:
+            usage = self._usage(job['client'], time.time())
+        return job['duration'] + self.fair_share_weight * usage - self.aging * waited
+
+    def order(self, jobs):
+        now = time.perf_counter()
+        return sorted(jobs, key=lambda job: self.score(job, now))
+
+    def started(self, job):
+        # 処理を始めたジョブの音声の秒数を利用者の利用量に加える
+        now = time.time()
+        with self.lock:
+            self.usage[job['client']] = (self._usage(job['client'], now) + job['duration'], now)
+            # 十分に減衰した利用者は忘れる
+            for client in [client for client in self.usage if self._usage(client, now) < 1.0]:
+                del self.usage[client]
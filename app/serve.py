@@ -0,0 +1,70 @@
+import json
+import os
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+# デバイス検出にだけ使うので、app側のスレッドは起動させない
+os.environ['SERVE_ROLE'] = 'launcher'
+import app as app_module  # noqa: E402
+
+# HTTPワーカー（gunicorn）のプロセス数・スレッド数と待ち受けアドレス
+HTTP_WORKERS = int(os.environ.get('HTTP_WORKERS', '4'))
+HTTP_THREADS = int(os.environ.get('HTTP_THREADS', '8'))
+# SSE（/events）の接続はスレッドを使い続けるので、1ワーカーで開ける数をスレッド数の半分までにして残りを他のリクエストに空けておく
+MAX_EVENT_STREAMS = int(os.environ.get('MAX_EVENT_STREAMS', str(max(1, HTTP_THREADS // 2))))
+BIND = os.environ.get('BIND', '0.0.0.0:5000')
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    # デバイスごとに推論プロセスを1つ起動し、HTTPワーカーは共有メモリとUNIXソケットで推論を依頼する
+    for directory in ('uploads', 'transcriptions', 'temp_chunks'):
+        os.makedirs(directory, exist_ok=True)
+    app_module.task_store.fail_unfinished('サーバーの再起動により処理が中断されました')
+
+    socket_dir = app_module.INFERENCE_SOCKET_DIR
+    shutil.rmtree(socket_dir, ignore_errors=True)
+    os.makedirs(socket_dir)
+    devices = app_module.get_available_devices()
+    default_device = 'cuda:0' if any(device_id.startswith('cuda') for device_id, _ in devices) else devices[0][0]
+    env = {**os.environ, 'INFERENCE_SOCKET_DIR': os.path.abspath(socket_dir),
+           'INFERENCE_AUTHKEY': secrets.token_hex(16), 'PYTHONPATH': APP_DIR}
+
+    processes = []
+    for device_id, _ in devices:
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(APP_DIR, 'inference_worker.py')],
+            env={**env, 'SERVE_ROLE': 'inference', 'INFERENCE_DEVICE': device_id}))
+    with open(os.path.join(socket_dir, 'devices.json'), 'w', encoding='utf-8') as f:
+        json.dump({'devices': devices, 'default_device': default_device}, f, ensure_ascii=False)
+
+    # 同期エンドポイントは文字起こしが終わるまで応答しないのでタイムアウトは無効にする
+    processes.append(subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(HTTP_WORKERS), '--worker-class', 'gthread',
+         '--threads', str(HTTP_THREADS), '--timeout', '0', '--bind', BIND, 'app:app'],
+        env={**env, 'SERVE_ROLE': 'http', 'MAX_EVENT_STREAMS': str(MAX_EVENT_STREAMS)}))
+
+    def stop(*_):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # どれか1つでも終了したら全体を止める（コンテナの再起動に任せる）
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    finally:
+        stop()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
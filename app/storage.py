@@ -0,0 +1,137 @@
+import fnmatch
+import os
+import shutil
+import threading
+import time
+
+
+def entry_stats(path):
+    # ファイルはそのまま、ディレクトリは中身の合計サイズと最新の更新時刻を返す
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    size = 0
+    mtime = os.stat(path).st_mtime
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+    return size, mtime
+
+
+class StorageJanitor:
+    # uploads/・temp_chunks/・transcriptions/ の使用量を集計し、期限切れや容量超過のエントリを古い順に削除する。
+    # rulesはディレクトリ名 → {'max_bytes', 'max_age', 'pattern', 'reason'}（0は無制限）。
+    # live_entries()はディレクトリ名 → 使用中のエントリ名の集合を返し、そこに含まれるものは消さない
+    def __init__(self, rules, live_entries):
+        self.rules = rules
+        self.live_entries = live_entries
+        self.lock = threading.Lock()
+        self.usage = {}
+        self.reclaimed = {}
+        self.removed = {}
+        self.last_sweep = None
+        self.sweep_seconds = None
+
+    def _record(self, directory, reason, size):
+        with self.lock:
+            key = (directory, reason)
+            self.reclaimed[key] = self.reclaimed.get(key, 0) + size
+            self.removed[key] = self.removed.get(key, 0) + 1
+
+    def _remove(self, directory, path, reason):
+        try:
+            size, _ = entry_stats(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            # 別のワーカーやジョブが先に消した
+            return 0
+        self._record(directory, reason, size)
+        return size
+
+    def discard(self, path, reason='job'):
+        # ジョブの終わりに不要になったファイルを消す（存在しなければ何もしない）
+        if path and os.path.exists(path):
+            return self._remove(os.path.basename(os.path.dirname(path)), path, reason)
+        return 0
+
+    def _scan(self, directory, pattern):
+        entries = []
+        total = 0
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                size, mtime = entry_stats(path)
+            except FileNotFoundError:
+                continue
+            total += size
+            if fnmatch.fnmatch(name, pattern):
+                entries.append((mtime, name, size))
+        return sorted(entries), total
+
+    def sweep(self):
+        # 1回掃除して、このときに消したバイト数を返す
+        started = time.perf_counter()
+        live = self.live_entries()
+        reclaimed = 0
+        usage = {}
+        for directory, rule in self.rules.items():
+            if not os.path.isdir(directory):
+                continue
+            protected = live.get(directory, set())
+            entries, total = self._scan(directory, rule.get('pattern', '*'))
+            now = time.time()
+            kept = []
+            for mtime, name, size in entries:
+                if name not in protected and rule['max_age'] and now - mtime > rule['max_age']:
+                    reclaimed += self._remove(directory, os.path.join(directory, name), rule.get('reason', 'expired'))
+                    total -= size
+                else:
+                    kept.append((mtime, name, size))
+            # 容量の上限は対象のエントリの合計に対して適用し、古いものから消す
+            managed = sum(size for _, _, size in kept)
+            count = len(kept)
+            for mtime, name, size in kept:
+                if not rule['max_bytes'] or managed <= rule['max_bytes']:
+                    break
+                if name in protected:
+                    continue
+                reclaimed += self._remove(directory, os.path.join(directory, name), 'quota')
+                managed -= size
+                total -= size
+                count -= 1
+            usage[directory] = {
+                'bytes': total,
+                'managed_bytes': managed,
+                'entries': count,
+                'live_entries': len(protected),
+                'max_bytes': rule['max_bytes'],
+                'max_age_seconds': rule['max_age'],
+                'over_quota': bool(rule['max_bytes']) and managed > rule['max_bytes'],
+            }
+        with self.lock:
+            self.usage = usage
+            self.last_sweep = time.time()
+            self.sweep_seconds = time.perf_counter() - started
+        return reclaimed
+
+    def stats(self):
+        disk = shutil.disk_usage('.')
+        with self.lock:
+            return {
+                'directories': self.usage,
+                'reclaimed': [{'directory': directory, 'reason': reason, 'bytes': size,
+                               'files': self.removed[(directory, reason)]}
+                              for (directory, reason), size in sorted(self.reclaimed.items())],
+                'reclaimed_bytes': sum(self.reclaimed.values()),
+                'disk': {'total_bytes': disk.total, 'free_bytes': disk.free},
+                'last_sweep': self.last_sweep,
+                'sweep_seconds': self.sweep_seconds,
+            }
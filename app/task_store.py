@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+FINISHED_STATUSES = ('completed', 'error', 'cancelled')
+# FINISHED_STATUSESをSQLのIN句に渡すためのプレースホルダー
+FINISHED_PLACEHOLDERS = ', '.join('?' * len(FINISHED_STATUSES))
+
+
+class TaskStore:
+    # タスクの状態をSQLiteに保存する。WALモードなので状態の読み取りがワーカーの書き込みを待たない。
+    # 完了/失敗したタスクはttl_seconds経過後にevict_expiredで削除する
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                finished_at REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS tasks_finished_at ON tasks (finished_at)')
+        # 複数プロセス構成でSSEのイベントをプロセス間で共有するための表
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                task_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (task_id, seq)
+            )
+        ''')
+        conn.commit()
+
+    def _conn(self):
+        # sqlite3の接続はスレッドごとに持つ
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self.local.conn = conn
+        return conn
+
+    def create(self, task_id, fields):
+        now = time.time()
+        self._conn().execute(
+            'INSERT INTO tasks (task_id, status, data, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (task_id, fields['status'], json.dumps(fields, ensure_ascii=False), now, now))
+
+    def update(self, task_id, fields):
+        # 読み込み→マージ→書き込みを1トランザクションで行い、更新後のタスクを返す
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return None
+            task = json.loads(row[0])
+            task.update(fields)
+            now = time.time()
+            finished_at = now if task['status'] in FINISHED_STATUSES else None
+            conn.execute('UPDATE tasks SET status = ?, data = ?, updated_at = ?, finished_at = ? WHERE task_id = ?',
+                         (task['status'], json.dumps(task, ensure_ascii=False), now, finished_at, task_id))
+            conn.execute('COMMIT')
+            return task
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, task_id):
+        row = self._conn().execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_event(self, task_id, event, data):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT INTO events (task_id, seq, event, data) '
+                         'SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ? FROM events WHERE task_id = ?',
+                         (task_id, event, json.dumps(data, ensure_ascii=False), task_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def events_after(self, positions):
+        # task_id → 次に読むseq を受け取り、それ以降のイベントを (task_id, seq, event, data) で返す。
+        # 購読中のタスクをまとめて1回の問い合わせで引く（SQLiteの変数の数の上限に収まるよう分ける）
+        items = list(positions.items())
+        rows = []
+        for start in range(0, len(items), 400):
+            batch = items[start:start + 400]
+            values = ', '.join('(?, ?)' for _ in batch)
+            rows.extend(self._conn().execute(
+                f'WITH wanted (task_id, seq) AS (VALUES {values}) '
+                'SELECT e.task_id, e.seq, e.event, e.data FROM events e '
+                'JOIN wanted w ON e.task_id = w.task_id AND e.seq >= w.seq ORDER BY e.task_id, e.seq',
+                [value for item in batch for value in item]).fetchall())
+        return [(task_id, seq, event, json.loads(data)) for task_id, seq, event, data in rows]
+
+    def evict_events(self, cutoff):
+        # cutoffより前に終了したタスクのイベントを削除する（タスク自体はTTLまで残す）
+        self._conn().execute('DELETE FROM events WHERE task_id IN '
+                             '(SELECT task_id FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?)', (cutoff,))
+
+    def evict_expired(self):
+        # 期限切れのタスクを削除し、そのIDを返す
+        conn = self._conn()
+        cutoff = time.time() - self.ttl_seconds
+        rows = conn.execute('SELECT task_id FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?',
+                            (cutoff,)).fetchall()
+        conn.execute('DELETE FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?', (cutoff,))
+        conn.execute('DELETE FROM events WHERE task_id NOT IN (SELECT task_id FROM tasks)')
+        return [row[0] for row in rows]
+
+    def fail_unfinished(self, message):
+        # 前回のプロセスで処理中だったタスクはもう完了しないので失敗にする
+        conn = self._conn()
+        rows = conn.execute(f"SELECT task_id FROM tasks WHERE status NOT IN ({FINISHED_PLACEHOLDERS})",
+                            FINISHED_STATUSES).fetchall()
+        for (task_id,) in rows:
+            self.update(task_id, {'status': 'error', 'error': message})
+        return len(rows)
+
+    def field_values(self, name, unfinished_only=False):
+        # タスクのdataにある指定フィールドの値の集合（ストレージの掃除で参照中のファイルを調べる）
+        query = 'SELECT json_extract(data, ?) FROM tasks'
+        if unfinished_only:
+            query += f' WHERE status NOT IN ({FINISHED_PLACEHOLDERS})'
+        params = ('$.' + name,) + (FINISHED_STATUSES if unfinished_only else ())
+        return {row[0] for row in self._conn().execute(query, params).fetchall() if row[0] is not None}
+
+    def counts(self):
+        rows = self._conn().execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return dict(rows)
+
+    def outstanding_audio(self, statuses=None):
+        # 終わっていない（statusesを指定したらその状態の）タスクの音声の秒数をデバイスごとに合計する。
+        # 受け付けの上限と完了時刻の見積もりに使う
+        if statuses:
+            condition = f"status IN ({', '.join('?' * len(statuses))})"
+            params = tuple(statuses)
+        else:
+            condition = f'status NOT IN ({FINISHED_PLACEHOLDERS})'
+            params = FINISHED_STATUSES
+        rows = self._conn().execute(
+            "SELECT json_extract(data, '$.device'), SUM(COALESCE(json_extract(data, '$.duration'), 0)) FROM tasks "
+            f"WHERE {condition} GROUP BY json_extract(data, '$.device')", params).fetchall()
+        return {device: seconds for device, seconds in rows if device is not None}
@@ -0,0 +1,86 @@
+# スタブモデルでバッチ推論あり/なしのスループット（音声秒/実時間秒）を比較する
+#   python bench/batching.py --jobs 24 --batch-size 8
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from stub_pipeline import StubPipeline, SAMPLE_RATE, load_app  # noqa: E402
+
+
+def write_wav(path, seconds, seed):
+    rng = random.Random(seed)
+    frames = bytearray()
+    for i in range(int(seconds * SAMPLE_RATE)):
+        value = int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE) + rng.randint(-500, 500))
+        frames += value.to_bytes(2, 'little', signed=True)
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(bytes(frames))
+
+
+def run(app_module, sources, batch_size, stub):
+    app_module.BATCH_SIZE = batch_size
+    app_module.model_cache.clear()
+    app_module.initialize_model = lambda device: stub
+
+    jobs = []
+    started = time.time()
+    for src, _ in sources:
+        path = os.path.join('uploads', f'{time.time_ns()}_{os.path.basename(src)}')
+        shutil.copy(src, path)
+        jobs.append(app_module.submit_job(path, os.path.basename(src), 'cpu', app_module.parse_options({})))
+    for job in jobs:
+        app_module.wait_job(job)
+    wall = time.time() - started
+
+    audio_seconds = sum(seconds for _, seconds in sources)
+    return {
+        'batch_size': batch_size,
+        'jobs': len(sources),
+        'audio_seconds': audio_seconds,
+        'wall_seconds': round(wall, 3),
+        'throughput': round(audio_seconds / wall, 2),
+        'model_calls': stub.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=24)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--min-seconds', type=float, default=5)
+    parser.add_argument('--max-seconds', type=float, default=90)
+    parser.add_argument('--window-cost', type=float, default=0.05)
+    args = parser.parse_args()
+
+    app_module, workdir = load_app()
+
+    rng = random.Random(0)
+    sources = []
+    for i in range(args.jobs):
+        seconds = round(rng.uniform(args.min_seconds, args.max_seconds), 1)
+        path = os.path.join(workdir, f'clip_{i}.wav')
+        write_wav(path, seconds, i)
+        sources.append((path, seconds))
+
+    results = [
+        run(app_module, sources, 1, StubPipeline(window_cost=args.window_cost)),
+        run(app_module, sources, args.batch_size, StubPipeline(window_cost=args.window_cost)),
+    ]
+    results[1]['speedup'] = round(results[1]['throughput'] / results[0]['throughput'], 2)
+    print(json.dumps(results, indent=2))
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# ブラウザで16kHzモノラルに変換してから送る場合と、元のファイルを送る場合の送信量と所要時間を比べる（スタブモデル）
+#   python bench/client_decode.py --durations 60 600 --uplink-mbps 20 --output result.json
+# ブラウザでの変換はffmpegによる同じ形式（16bit PCMのWAV）への変換で代用する。
+# テストクライアントには回線がないので、送信時間は --uplink-mbps の回線を仮定して送信量から求める
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from endpoints import make_media  # noqa: E402
+from stub_pipeline import load_app, per_second_stub  # noqa: E402
+
+
+def to_client_wav(path):
+    # ブラウザが作るのと同じ16kHzモノラル・16bit PCMのWAV
+    target = path + '.16k.wav'
+    started = time.perf_counter()
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', path, '-vn', '-ac', '1', '-ar', '16000',
+                    '-c:a', 'pcm_s16le', target], check=True)
+    return target, time.perf_counter() - started
+
+
+def transcribe(client, data, filename, extra):
+    started = time.perf_counter()
+    response = client.post('/transcribe', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(data), filename), 'device': 'cpu', **extra})
+    if response.status_code != 200:
+        raise Exception(response.get_json())
+    return time.perf_counter() - started, response.get_json()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--durations', nargs='+', type=float, default=[60, 600], help='合成する音声の長さ（秒）')
+    parser.add_argument('--kinds', nargs='+', choices=('mp3', 'video'), default=['mp3', 'video'])
+    parser.add_argument('--uplink-mbps', type=float, default=20, help='仮定する上り回線の速度（Mbps）')
+    parser.add_argument('--cost-per-second', type=float, default=0.001, help='スタブモデルの音声1秒あたりの推論時間')
+    parser.add_argument('--output', help='結果のJSONを書き出すファイル（省略時は標準出力）')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    app_module, workdir = load_app()
+    stub = per_second_stub(app_module, args.cost_per_second)
+    app_module.initialize_model = lambda device: stub
+    client = app_module.app.test_client()
+    bytes_per_second = args.uplink_mbps * 1e6 / 8
+
+    results = []
+    for seconds in args.durations:
+        for kind in args.kinds:
+            path = os.path.join(workdir, f'clip_{seconds:g}s.{"mp4" if kind == "video" else "mp3"}')
+            make_media(path, seconds, kind)
+            wav_path, convert_seconds = to_client_wav(path)
+            with open(path, 'rb') as f:
+                original = f.read()
+            with open(wav_path, 'rb') as f:
+                converted = f.read()
+
+            server_original, _ = transcribe(client, original, os.path.basename(path), {})
+            server_converted, payload = transcribe(client, converted, os.path.basename(path), {
+                'originalSize': str(len(original)), 'clientDecodeSeconds': str(convert_seconds)})
+            upload_original = len(original) / bytes_per_second
+            upload_converted = len(converted) / bytes_per_second
+            results.append({
+                'kind': kind,
+                'audio_seconds': seconds,
+                'original_bytes': len(original),
+                'upload_bytes': len(converted),
+                'saved_bytes': len(original) - len(converted),
+                'client_upload': payload.get('client_upload'),
+                'end_to_end_seconds': {
+                    'original': round(upload_original + server_original, 3),
+                    'client_decode': round(convert_seconds + upload_converted + server_converted, 3),
+                },
+                'server_seconds': {'original': round(server_original, 3), 'client_decode': round(server_converted, 3)},
+            })
+            print(f"{kind} {seconds:g}s: {len(original)} -> {len(converted)} bytes", file=sys.stderr)
+
+    text = json.dumps({'config': {'uplink_mbps': args.uplink_mbps, 'cost_per_second': args.cost_per_second},
+                       'results': results}, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
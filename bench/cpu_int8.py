@@ -0,0 +1,98 @@
+# 同じ音声でCPUのfp32推論とint8動的量子化推論の実時間比とWER/CERを比較する（実際のモデルを使う）
+#   python bench/cpu_int8.py clip1.mp3 clip2.wav --refs refs/ --language ja
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+
+def edit_distance(ref, hyp):
+    previous = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        current = [i]
+        for j, h in enumerate(hyp, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)))
+        previous = current
+    return previous[-1]
+
+
+def error_rates(ref, hyp):
+    # 日本語は単語区切りがないのでCER（空白を除いた文字単位）も出す
+    ref_words, hyp_words = ref.split(), hyp.split()
+    ref_chars, hyp_chars = ''.join(ref_words), ''.join(hyp_words)
+    return {
+        'wer': edit_distance(ref_words, hyp_words) / max(len(ref_words), 1),
+        'cer': edit_distance(ref_chars, hyp_chars) / max(len(ref_chars), 1),
+    }
+
+
+def transcribe_all(app_module, device, clips, args):
+    import torch
+    load_start = time.time()
+    pipe = app_module.initialize_model(device)
+    load_seconds = time.time() - load_start
+    generate_kwargs = app_module.build_generate_kwargs(args.language, False)
+    options = app_module.parse_options({})
+    outputs = []
+    # CPUデバイスを1つだけ使うサーバーのワーカーと同じスレッド数で計測する
+    torch.set_num_threads(app_module.cpu_worker_threads(1))
+    # 1回目はウォームアップとして計測しない
+    pipe(app_module.pipeline_input(clips[0][1][:app_module.SAMPLE_RATE]), return_timestamps=True)
+    for name, audio in clips:
+        started = time.time()
+        result = pipe(app_module.pipeline_input(audio), return_timestamps=True, generate_kwargs=generate_kwargs,
+                      chunk_length_s=options['chunk_length_s'], stride_length_s=options['stride_length_s'],
+                      batch_size=options['batch_size'])
+        seconds = time.time() - started
+        outputs.append({'clip': name, 'text': result['text'], 'inference_seconds': seconds,
+                        'realtime_factor': seconds / (len(audio) / app_module.SAMPLE_RATE)})
+    return {'device': device, 'load_seconds': load_seconds, 'model_bytes': app_module.pipeline_bytes(pipe),
+            'clips': outputs}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('clips', nargs='+', help='比較に使う音声/動画ファイル')
+    parser.add_argument('--refs', help='正解テキスト（<クリップ名>.txt）のディレクトリ。省略時はfp32の出力を基準にする')
+    parser.add_argument('--language', default='auto')
+    args = parser.parse_args()
+
+    os.environ['STARTUP_WARMUP'] = 'false'
+    import app as app_module
+
+    clips = [(os.path.basename(path), app_module.decode_audio(path)) for path in args.clips]
+    runs = [transcribe_all(app_module, device, clips, args) for device in ('cpu', app_module.CPU_INT8_DEVICE)]
+
+    references = {}
+    for i, (name, _) in enumerate(clips):
+        if args.refs:
+            with open(os.path.join(args.refs, os.path.splitext(name)[0] + '.txt'), encoding='utf-8') as f:
+                references[name] = f.read()
+        else:
+            references[name] = runs[0]['clips'][i]['text']
+
+    summary = []
+    for run in runs:
+        for clip in run['clips']:
+            clip.update(error_rates(references[clip['clip']], clip['text']))
+        audio_seconds = sum(len(audio) for _, audio in clips) / app_module.SAMPLE_RATE
+        inference_seconds = sum(clip['inference_seconds'] for clip in run['clips'])
+        summary.append({
+            'device': run['device'],
+            'cpu_threads': app_module.cpu_worker_threads(1),
+            'load_seconds': round(run['load_seconds'], 2),
+            'model_mb': round(run['model_bytes'] / (1 << 20), 1),
+            'realtime_factor': round(inference_seconds / audio_seconds, 4),
+            'wer': round(sum(c['wer'] for c in run['clips']) / len(run['clips']), 4),
+            'cer': round(sum(c['cer'] for c in run['clips']) / len(run['clips']), 4),
+        })
+    summary[1]['speedup_vs_fp32'] = round(summary[0]['realtime_factor'] / summary[1]['realtime_factor'], 2)
+    print(json.dumps({'reference': 'refs' if args.refs else 'fp32', 'summary': summary, 'runs': runs},
+                     indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
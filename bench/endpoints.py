@@ -0,0 +1,231 @@
+# スタブモデルでアップロードから文字起こし結果までのエンドポイントを負荷試験する（GPU・ネットワーク不要）
+#   python bench/endpoints.py --concurrency 1 4 8 --requests 16 --output result.json
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from stub_pipeline import load_app, per_second_stub  # noqa: E402
+
+SCENARIOS = ('sync', 'async', 'chunked', 'chunked_async')
+
+
+def make_media(path, seconds, kind):
+    # ffmpegのテスト信号で合成する。videoはテスト映像+音声のmp4
+    tone = f'sine=frequency=440:duration={seconds}:sample_rate=44100'
+    if kind == 'video':
+        inputs = ['-f', 'lavfi', '-i', f'testsrc=size=320x240:rate=10:duration={seconds}', '-f', 'lavfi', '-i', tone]
+        codecs = ['-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-shortest']
+    else:
+        inputs = ['-f', 'lavfi', '-i', tone]
+        codecs = ['-c:a', 'libmp3lame'] if path.endswith('.mp3') else []
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', *inputs, *codecs, path], check=True)
+
+
+class RssSampler:
+    # 区間内のピークRSSを測る（/procがなければプロセス全体のru_maxrssを使う）
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _current(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.peak = max(self.peak, self._current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, self._current())
+
+
+def wait_status(client, task_id, poll_interval):
+    while True:
+        status = client.get(f'/status/{task_id}').get_json()
+        if status['status'] in ('completed', 'error'):
+            return status
+        time.sleep(poll_interval)
+
+
+def upload_chunks(client, data, filename, chunk_size, endpoint):
+    file_id = str(uuid.uuid4())
+    total_chunks = max(1, -(-len(data) // chunk_size))
+    for index in range(total_chunks):
+        response = client.post(endpoint, content_type='multipart/form-data', data={
+            'file': (io.BytesIO(data[index * chunk_size:(index + 1) * chunk_size]), 'blob'),
+            'fileId': file_id,
+            'chunkIndex': str(index),
+            'totalChunks': str(total_chunks),
+            'chunkSize': str(chunk_size),
+            'totalSize': str(len(data)),
+            'fileName': filename,
+        })
+        if response.status_code != 200:
+            return None
+    return file_id
+
+
+def request_once(client, scenario, data, filename, args):
+    # 1件分の文字起こしを行い、成功したかを返す
+    if scenario in ('sync', 'async'):
+        response = client.post('/transcribe', content_type='multipart/form-data', data={
+            'file': (io.BytesIO(data), filename),
+            'device': 'cpu',
+            'polling': 'true' if scenario == 'async' else 'false',
+        })
+    else:
+        async_mode = scenario == 'chunked_async'
+        file_id = upload_chunks(client, data, filename, args.chunk_size,
+                                '/transcribe_chunk_async' if async_mode else '/transcribe_chunk')
+        if file_id is None:
+            return False
+        response = client.post('/transcribe_finalize_async' if async_mode else '/transcribe_finalize',
+                               json={'fileId': file_id, 'device': 'cpu'})
+    if response.status_code == 202:
+        return wait_status(client, response.get_json()['task_id'], args.poll_interval)['status'] == 'completed'
+    return response.status_code == 200
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * q
+    low = int(index)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def run(app_module, scenario, concurrency, media, args):
+    # concurrency本のスレッドがそれぞれテストクライアントでリクエストを出し続ける
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def worker():
+        client = app_module.app.test_client()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            data, filename, _ = media[index % len(media)]
+            started = time.perf_counter()
+            try:
+                ok = request_once(client, scenario, data, filename, args)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+    audio_seconds = sum(media[i % len(media)][2] for i in range(args.requests))
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': args.requests,
+        'errors': errors[0],
+        'wall_seconds': round(wall, 3),
+        'latency_seconds': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+        },
+        'throughput_rps': round(len(latencies) / wall, 3),
+        'audio_seconds_per_second': round(audio_seconds / wall, 2),
+        'peak_rss_mb': round(rss.peak / (1 << 20), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 8])
+    parser.add_argument('--requests', type=int, default=16, help='シナリオ・並列度ごとのリクエスト数')
+    parser.add_argument('--durations', nargs='+', type=float, default=[10, 45, 120], help='合成する音声の長さ（秒）')
+    parser.add_argument('--kinds', nargs='+', choices=('wav', 'mp3', 'video'), default=['wav', 'mp3', 'video'])
+    parser.add_argument('--cost-per-second', type=float, default=0.001, help='スタブモデルの音声1秒あたりの推論時間')
+    parser.add_argument('--chunk-size', type=int, default=1 << 20)
+    parser.add_argument('--poll-interval', type=float, default=0.02)
+    parser.add_argument('--output', help='結果のJSONを書き出すファイル（省略時は標準出力）')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    app_module, workdir = load_app()
+
+    media = []
+    for seconds in args.durations:
+        for kind in args.kinds:
+            ext = {'wav': 'wav', 'mp3': 'mp3', 'video': 'mp4'}[kind]
+            path = os.path.join(workdir, f'clip_{seconds:g}s.{ext}')
+            make_media(path, seconds, kind)
+            with open(path, 'rb') as f:
+                media.append((f.read(), os.path.basename(path), seconds))
+
+    stub = per_second_stub(app_module, args.cost_per_second)
+    app_module.initialize_model = lambda device: stub
+
+    results = []
+    for scenario in args.scenarios:
+        for concurrency in args.concurrency:
+            results.append(run(app_module, scenario, concurrency, media, args))
+            print(f"{scenario} x{concurrency}: p50={results[-1]['latency_seconds']['p50']}", file=sys.stderr)
+
+    report = {
+        'config': {
+            'durations': args.durations,
+            'kinds': args.kinds,
+            'cost_per_second': args.cost_per_second,
+            'workers_per_device': app_module.WORKERS_PER_DEVICE,
+            'batch_size': app_module.BATCH_SIZE,
+            'inference_mode': app_module.INFERENCE_MODE,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# マイクの代わりに音声ファイルを実時間で /live に送り、語が表示・確定されるまでの遅延を測る
+#   python bench/live_latency.py --seconds 60 --output result.json
+#   python bench/live_latency.py --input speech.wav --real   # 本物のモデルで測る
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from stub_pipeline import StubPipeline  # noqa: E402
+from endpoints import percentile  # noqa: E402
+
+
+def make_chirp(path, seconds):
+    # 周波数が変化し続ける信号にして、スタブが区間ごとに異なる語を返すようにする
+    expr = 'sin(2*PI*(200+40*t)*t)*0.5'
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i',
+                    f'aevalsrc={expr}:s=44100:d={seconds}', path], check=True)
+
+
+def summarize(values):
+    return {
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'max': max(values) if values else None,
+        'mean': sum(values) / len(values) if values else None,
+    }
+
+
+def replay(url, pcm, args):
+    # 送信スレッドはframe_ms分のPCM16を実時間で送り、受信側は届いた語ごとに
+    # 「その語の終わりの音声を送った時刻」から受け取るまでの時間を記録する
+    from simple_websocket import Client
+
+    ws = Client.connect(url)
+    frame = int(16000 * args.frame_ms / 1000)
+    started = time.perf_counter()
+
+    def sent_at(audio_time):
+        return started + audio_time / args.speed
+
+    def send():
+        for offset in range(0, len(pcm), frame):
+            delay = sent_at(offset / 16000) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            ws.send((pcm[offset:offset + frame] * 32767).astype('<i2').tobytes())
+        stop_sent[0] = time.perf_counter()
+        ws.send(json.dumps({'type': 'stop'}))
+
+    stop_sent = [None]
+    sender = threading.Thread(target=send)
+    sender.start()
+
+    committed, first_seen, decode_seconds, buffer_seconds = [], {}, [], []
+    final_latency = None
+    text = []
+    while True:
+        message = json.loads(ws.receive())
+        now = time.perf_counter()
+        if message['type'] == 'error':
+            raise RuntimeError(message['error'])
+        for word in message['tentative'] + message['committed']:
+            first_seen.setdefault(round(word['start'], 2), now - sent_at(word['end']))
+        for word in message['committed']:
+            text.append(word['text'])
+            if message['type'] == 'update':
+                committed.append(now - sent_at(word['end']))
+        if message['decode_seconds'] is not None:
+            decode_seconds.append(message['decode_seconds'])
+        buffer_seconds.append(message['buffer_seconds'])
+        if message['type'] == 'final':
+            final_latency = now - stop_sent[0]
+            break
+    # 最終結果を送るとサーバー側が接続を閉じる
+    sender.join()
+    return {
+        'words': len(text),
+        'updates': len(decode_seconds),
+        'first_seen_latency_seconds': summarize(list(first_seen.values())),
+        'commit_latency_seconds': summarize(committed),
+        'final_after_stop_seconds': final_latency,
+        'decode_seconds': summarize(decode_seconds),
+        'max_buffer_seconds': max(buffer_seconds),
+        'text': ''.join(text),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help='再生する音声/動画ファイル（省略時は合成した信号）')
+    parser.add_argument('--seconds', type=float, default=60, help='合成する信号の長さ（秒）')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--language', default='auto')
+    parser.add_argument('--frame-ms', type=int, default=100, help='1回に送るPCMの長さ（ミリ秒）')
+    parser.add_argument('--speed', type=float, default=1.0, help='再生速度（1で実時間）')
+    parser.add_argument('--cost-per-second', type=float, default=0.02,
+                        help='スタブモデルでバッファ1秒あたりにかかる認識時間')
+    parser.add_argument('--real', action='store_true', help='スタブを使わず本物のモデルで認識する')
+    parser.add_argument('--output', help='結果のJSONを書き出すファイル（省略時は標準出力）')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    source = os.path.abspath(args.input) if args.input else None
+
+    workdir = tempfile.mkdtemp(prefix='whisper-live-bench-')
+    os.chdir(workdir)
+    if source is None:
+        source = os.path.join(workdir, 'chirp.wav')
+        make_chirp(source, args.seconds)
+
+    os.environ['STARTUP_WARMUP'] = 'false'
+    os.environ['TASK_DB_PATH'] = os.path.join(workdir, 'tasks.db')
+    import app as app_module
+    from audio import decode_audio
+    from werkzeug.serving import make_server
+
+    if app_module.Sock is None:
+        sys.exit('flask-sock がインストールされていません')
+    if not args.real:
+        stub = StubPipeline(window_cost=args.cost_per_second * 30)
+        app_module.initialize_model = lambda device: stub
+    # 最初の認識でのモデルのロードは遅延に含めない
+    app_module.wait_devices()
+    app_module.warmup_model(args.device)
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'ws://127.0.0.1:{server.server_port}/live?device={args.device}&language={args.language}'
+
+    pcm = decode_audio(source)
+    result = replay(url, pcm, args)
+    server.shutdown()
+
+    report = {
+        'config': {
+            'audio_seconds': round(len(pcm) / 16000, 2),
+            'device': args.device,
+            'real_model': args.real,
+            'frame_ms': args.frame_ms,
+            'speed': args.speed,
+            'cost_per_second': None if args.real else args.cost_per_second,
+            'live_step_s': app_module.LIVE_STEP_S,
+            'live_trim_s': app_module.LIVE_TRIM_S,
+            'live_max_buffer_s': app_module.LIVE_MAX_BUFFER_S,
+        },
+        'result': result,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# スタブモデルで逐次モードとchunkedモードの処理時間を比較する
+#   python bench/modes.py --minutes 60
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from stub_pipeline import StubPipeline, SAMPLE_RATE, load_app  # noqa: E402
+
+
+def write_wav(path, seconds):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    samples = (8000 * np.sin(2 * np.pi * 440 * t)).astype('<i2')
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(samples.tobytes())
+
+
+def run(app_module, source, options):
+    path = os.path.join('uploads', f'{time.time_ns()}.wav')
+    shutil.copy(source, path)
+    started = time.time()
+    job = app_module.submit_job(path, 'long.wav', 'cpu', app_module.parse_options(options))
+    task = app_module.wait_job(job)
+    return {'wall_seconds': round(time.time() - started, 3), 'inference': task.get('inference'), 'error': task['error']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=60)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--window-cost', type=float, default=0.02)
+    args = parser.parse_args()
+
+    app_module, workdir = load_app()
+    source = os.path.join(workdir, 'long.wav')
+    write_wav(source, args.minutes * 60)
+
+    app_module.initialize_model = lambda device: StubPipeline(window_cost=args.window_cost)
+
+    results = {
+        'sequential': run(app_module, source, {'mode': 'sequential'}),
+        'chunked': run(app_module, source, {'mode': 'chunked', 'batch_size': str(args.batch_size)}),
+    }
+    results['speedup'] = round(results['sequential']['wall_seconds'] / results['chunked']['wall_seconds'], 2)
+    print(json.dumps(results, indent=2))
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
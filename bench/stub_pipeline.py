@@ -0,0 +1,169 @@
+import math
+import os
+import tempfile
+import time
+import wave
+import zlib
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+# 語単位のタイムスタンプを求められたときの1語の長さ（秒）
+WORD_SECONDS = 0.6
+
+
+def audio_duration(item):
+    # パイプラインに渡される入力（パス/辞書/配列）から音声長（秒）を求める
+    if isinstance(item, str):
+        with wave.open(item, 'rb') as w:
+            return w.getnframes() / w.getframerate()
+    if isinstance(item, dict):
+        return len(item['raw']) / item.get('sampling_rate', SAMPLE_RATE)
+    return len(item) / SAMPLE_RATE
+
+
+class StubEncoder:
+    # エンコーダー部分。nn.Moduleと同じく呼び出しはforwardに渡すので、forwardを差し替えて割り込める。
+    # input_featuresは1バッチのウィンドウを表す配列で、時間はバッチの推論時間のencoder_fractionの割合
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+    def forward(self, input_features):
+        time.sleep(self.pipe.encoder_fraction * self.pipe.batch_cost(len(input_features)))
+        return input_features
+
+
+class StubModel:
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    def get_encoder(self):
+        return self.encoder
+
+    def state_dict(self):
+        return {}
+
+
+class StubPipeline:
+    # transformersのASRパイプラインを模した決定的なスタブ。
+    # 1バッチの推論時間 = batch_overhead + window_cost * (1 + batch_scaling * (n - 1))
+    # そのうちencoder_fractionの割合をエンコーダー（model.get_encoder()）で、残りをデコードで費やす
+    def __init__(self, window_cost=0.05, batch_overhead=0.01, batch_scaling=0.1, encoder_fraction=0.0):
+        self.window_cost = window_cost
+        self.batch_overhead = batch_overhead
+        self.batch_scaling = batch_scaling
+        self.encoder_fraction = encoder_fraction
+        self.model = StubModel(StubEncoder(self))
+        self.calls = 0
+
+    def batch_cost(self, n):
+        return self.batch_overhead + self.window_cost * (1 + self.batch_scaling * (n - 1))
+
+    def _run_windows(self, windows):
+        # windowsはバッチに入るウィンドウごとの(入力の音声長, ウィンドウ番号)。同じ音声の同じ分割なら同じ特徴量になる
+        if not windows:
+            return
+        self.calls += 1
+        self.model.get_encoder()(input_features=np.array(windows, dtype=np.float64))
+        time.sleep((1 - self.encoder_fraction) * self.batch_cost(len(windows)))
+
+    def _result(self, duration, step):
+        chunks = []
+        start = 0.0
+        while start < duration:
+            end = min(start + step, duration)
+            chunks.append({'timestamp': (start, end), 'text': f' [{start:.1f}-{end:.1f}]'})
+            start = end
+        return {'text': ''.join(c['text'] for c in chunks), 'chunks': chunks}
+
+    def _iterate(self, inputs, batch_size, window):
+        batch_size = max(1, batch_size)
+        # [音声長, 未処理ウィンドウ数, ウィンドウ数] を入力順に保持する
+        pending = []
+        queued_windows = 0
+        for item in inputs:
+            duration = audio_duration(item)
+            windows = max(1, math.ceil(duration / window))
+            pending.append([duration, windows, windows])
+            queued_windows += windows
+            while queued_windows >= batch_size:
+                yield from self._consume(pending, batch_size, window)
+                queued_windows -= batch_size
+        if queued_windows:
+            yield from self._consume(pending, queued_windows, window)
+
+    def _consume(self, pending, n, window):
+        # nウィンドウを1バッチとして推論し、全ウィンドウが済んだ入力を返す
+        windows = []
+        i = 0
+        while n > 0 and i < len(pending):
+            duration, remaining, total = pending[i]
+            used = min(n, remaining)
+            windows.extend((duration, total - remaining + j) for j in range(used))
+            pending[i][1] -= used
+            n -= used
+            i += 1
+        self._run_windows(windows)
+        while pending and pending[0][1] == 0:
+            yield self._result(pending.pop(0)[0], window)
+
+    def _words(self, item):
+        # 入力先頭からWORD_SECONDSごとに1語とし、語のテキストはその区間の音声から決める。
+        # 同じ音声には同じ語を返すので、ライブ認識で末尾の不完全な語だけが認識ごとに変わる
+        audio = item['raw'] if isinstance(item, dict) else item
+        duration = audio_duration(item)
+        time.sleep(self.batch_overhead + self.window_cost * duration / 30)
+        step = int(WORD_SECONDS * SAMPLE_RATE)
+        chunks = []
+        for start in range(0, len(audio), step):
+            pcm = np.round(np.asarray(audio[start:start + step]) * 1000).astype(np.int16)
+            end = min(start + step, len(audio))
+            chunks.append({'timestamp': (start / SAMPLE_RATE, end / SAMPLE_RATE),
+                           'text': f' w{zlib.crc32(pcm.tobytes()) % 10000}'})
+        return {'text': ''.join(c['text'] for c in chunks), 'chunks': chunks}
+
+    def __call__(self, inputs, batch_size=1, chunk_length_s=0, stride_length_s=None, **kwargs):
+        if kwargs.get('return_timestamps') == 'word':
+            return self._words(inputs)
+        # chunk_length_sなし（逐次モード）は30秒ずつ1ウィンドウごとに進む。
+        # ありなら両端の重なりを除いた幅ずつ進む
+        if chunk_length_s:
+            stride = chunk_length_s / 6 if stride_length_s is None else stride_length_s
+            window = chunk_length_s - 2 * stride
+        else:
+            window = 30
+            batch_size = 1
+        if isinstance(inputs, (str, dict)) or hasattr(inputs, 'shape'):
+            return next(self._iterate([inputs], batch_size, window))
+        return self._iterate(inputs, batch_size, window)
+
+
+def load_app(**env):
+    # 一時ディレクトリに移ってから、スタブモデルで計測するための設定でappを読み込む。
+    # envで設定を足す・上書きする。(appモジュール, 作業ディレクトリ)を返す
+    workdir = tempfile.mkdtemp(prefix='whisper-bench-')
+    os.chdir(workdir)
+    os.makedirs('uploads', exist_ok=True)
+    os.makedirs('transcriptions', exist_ok=True)
+    os.environ.update({
+        # 同じ素材を繰り返し送るので結果キャッシュは無効にし、毎回推論まで通す
+        'RESULT_CACHE_MAX_MB': '0',
+        # スタブに差し替える前に本物のモデルをロードしないよう起動時のウォームアップを止める
+        'STARTUP_WARMUP': 'false',
+        # 受け付けの上限と同期リクエストの非同期への切り替えで結果が変わらないよう止める
+        'MAX_BACKLOG_AUDIO_S': '0',
+        'SYNC_TIMEOUT_S': '0',
+        'TASK_DB_PATH': os.path.join(workdir, 'tasks.db'),
+        **env,
+    })
+    import app as app_module
+    return app_module, workdir
+
+
+def per_second_stub(app_module, cost_per_second, **kwargs):
+    # 音声1秒あたりのコストを、スタブのウィンドウ幅（chunk_length_s - 2 * stride）あたりのコストに換算する
+    window = app_module.CHUNK_LENGTH_S - 2 * (app_module.STRIDE_LENGTH_S or app_module.CHUNK_LENGTH_S / 6)
+    return StubPipeline(window_cost=cost_per_second * window, **kwargs)
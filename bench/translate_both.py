@@ -0,0 +1,90 @@
+# 文字起こしと英訳を、2回に分けて送る場合（translate=false と translate=true）と
+# translate=both で1回で作る場合の所要時間を比べる（スタブモデル）
+#   python bench/translate_both.py --durations 60 600 --encoder-fraction 0.6 --output result.json
+# スタブの推論時間のうちencoder_fractionの割合をエンコーダーの計算とみなす。
+# 所要時間（wall）とは別に、推論にかかった時間（応答のinference.inference_seconds）も出す
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from endpoints import make_media  # noqa: E402
+from stub_pipeline import load_app, per_second_stub  # noqa: E402
+
+
+def transcribe(client, data, filename, translate, mode):
+    started = time.perf_counter()
+    response = client.post('/transcribe', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(data), filename), 'device': 'cpu', 'translate': translate, 'mode': mode})
+    if response.status_code != 200:
+        raise Exception(response.get_json())
+    payload = response.get_json()
+    return time.perf_counter() - started, payload['inference']['inference_seconds'], payload
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--durations', nargs='+', type=float, default=[60, 600], help='合成する音声の長さ（秒）')
+    parser.add_argument('--modes', nargs='+', choices=('chunked', 'sequential'), default=['chunked'])
+    parser.add_argument('--encoder-fraction', type=float, default=0.6, help='推論時間のうちエンコーダーの割合')
+    parser.add_argument('--cost-per-second', type=float, default=0.001, help='スタブモデルの音声1秒あたりの推論時間')
+    parser.add_argument('--output', help='結果のJSONを書き出すファイル（省略時は標準出力）')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    # 1件ずつ送るのでバッチがそろうのを待たない（待ち時間が所要時間の差を隠してしまう）
+    app_module, workdir = load_app(BATCH_MAX_WAIT='0')
+    stub = per_second_stub(app_module, args.cost_per_second, encoder_fraction=args.encoder_fraction)
+    app_module.initialize_model = lambda device: stub
+    client = app_module.app.test_client()
+
+    # 最初のリクエストはモデルのロードを含むので計測しない
+    warmup = os.path.join(workdir, 'warmup.mp3')
+    make_media(warmup, 1, 'mp3')
+    with open(warmup, 'rb') as f:
+        transcribe(client, f.read(), 'warmup.mp3', 'false', args.modes[0])
+
+    results = []
+    for seconds in args.durations:
+        path = os.path.join(workdir, f'clip_{seconds:g}s.mp3')
+        make_media(path, seconds, 'mp3')
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(path)
+        for mode in args.modes:
+            transcribe_seconds, transcribe_inference, _ = transcribe(client, data, name, 'false', mode)
+            translate_seconds, translate_inference, _ = transcribe(client, data, name, 'true', mode)
+            both_seconds, both_inference, payload = transcribe(client, data, name, 'both', mode)
+            separate = transcribe_seconds + translate_seconds
+            separate_inference = transcribe_inference + translate_inference
+            results.append({
+                'mode': mode,
+                'audio_seconds': seconds,
+                'separate_seconds': round(separate, 3),
+                'both_seconds': round(both_seconds, 3),
+                'speedup': round(separate / both_seconds, 2),
+                'separate_inference_seconds': round(separate_inference, 3),
+                'both_inference_seconds': round(both_inference, 3),
+                'inference_speedup': round(separate_inference / both_inference, 2),
+                'encoder_windows': payload['inference'].get('encoder_windows'),
+            })
+            print(f"{mode} {seconds:g}s: {separate:.2f}s -> {both_seconds:.2f}s "
+                  f"(inference {separate_inference:.2f}s -> {both_inference:.2f}s)", file=sys.stderr)
+
+    text = json.dumps({'config': {'encoder_fraction': args.encoder_fraction, 'cost_per_second': args.cost_per_second},
+                       'results': results}, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    # 作業ディレクトリ（uploads/ など）を一時ディレクトリにしてapp.pyを読み込む。
+    # SERVE_ROLE=cliならデバイス検出や掃除のスレッドは起動しない
+    pytest.importorskip('flask')
+    pytest.importorskip('numpy')
+    workdir = tmp_path_factory.mktemp('work')
+    os.chdir(workdir)
+    for name in ('uploads', 'temp_chunks', 'transcriptions'):
+        os.makedirs(name, exist_ok=True)
+    os.environ.update(SERVE_ROLE='cli', STARTUP_WARMUP='false', PREPROCESS_WORKERS='0',
+                      TASK_DB_PATH=str(workdir / 'tasks.db'))
+    sys.path.insert(0, APP_DIR)
+    import app
+    return app
@@ -0,0 +1,64 @@
+import io
+import os
+
+import pytest
+
+
+@pytest.fixture
+def admission(app_module):
+    import admission
+    return admission
+
+
+def test_accepts_within_backlog_limit(admission):
+    a = admission.Admission(max_backlog=600)
+    assert a.retry_after(['cpu'], 300, 300) is None
+    # 何も待っていなければ上限より長い音声でも受け付ける
+    assert a.retry_after(['cpu'], 0, 3600) is None
+    # 上限0は無制限
+    assert admission.Admission().retry_after(['cpu'], 10 ** 6, 3600) is None
+
+
+def test_retry_after_is_time_to_drain_the_excess(admission):
+    a = admission.Admission(max_backlog=600)
+    a.observe('cuda:0', 0.1)
+    # 超過分（300 + 500 - 600 = 200秒）を実時間比0.1で処理し終えるまで
+    assert a.retry_after(['cuda:0'], 300, 500) == 20
+    # 超過分が未処理の音声より多くても、待つのは未処理の音声が片付くまで
+    assert a.retry_after(['cuda:0'], 100, 5000) == 10
+    # 1秒未満でも1秒は待たせる
+    assert a.retry_after(['cuda:0'], 601, 0) == 1
+
+
+def test_devices_share_the_backlog(admission):
+    a = admission.Admission(max_backlog=600)
+    a.observe('cuda:0', 0.1)
+    a.observe('cuda:1', 0.1)
+    devices = ['cuda:0', 'cuda:1']
+    assert a.retry_after(devices, 1000, 100) is None
+    assert a.retry_after(devices, 1200, 200) == 10
+
+
+def test_realtime_factor_is_a_moving_average(admission):
+    a = admission.Admission(smoothing=0.5)
+    assert a.realtime_factor(['cpu:int8']) == admission.DEFAULT_REALTIME_FACTORS['cpu:int8']
+    a.observe('cpu', 0.4)
+    a.observe('cpu', 0.8)
+    a.observe('cpu', 0)
+    assert a.realtime_factor(['cpu']) == pytest.approx(0.6)
+
+
+def test_overloaded_upload_gets_429_with_retry_after(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'parse_device', lambda value: 'cpu')
+    monkeypatch.setattr(app_module.admission, 'max_backlog', 600)
+    monkeypatch.setattr(app_module, 'backlog_audio', lambda devices, statuses=None: 900)
+    before = set(os.listdir('uploads'))
+
+    response = app_module.app.test_client().post('/transcribe', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(b'RIFF' + b'\0' * 64), 'a.wav'), 'polling': 'true'})
+    assert response.status_code == 429
+    retry_after = response.get_json()['retry_after']
+    assert retry_after >= 1
+    assert response.headers['Retry-After'] == str(retry_after)
+    # 断ったアップロードは保存しない
+    assert set(os.listdir('uploads')) == before
@@ -0,0 +1,11 @@
+import io
+
+
+def test_read_pcm_does_not_keep_the_growth_buffer(app_module):
+    import numpy as np
+    import audio
+    samples = np.arange(audio.READ_BLOCK * 3, dtype=np.float32)
+    # float32の境界に満たない端数は捨てる
+    pcm = audio.read_pcm(io.BytesIO(samples.tobytes() + b'\x00\x01'))
+    assert (pcm == samples).all()
+    assert len(pcm.base) == samples.nbytes
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import pytest
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench')
+
+
+@pytest.fixture
+def stub_pipeline(app_module):
+    if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+    import stub_pipeline
+    return stub_pipeline
+
+
+def audio(seconds):
+    import numpy as np
+    return {'raw': np.zeros(int(16000 * seconds), dtype=np.float32), 'sampling_rate': 16000}
+
+
+def free_stub(stub_pipeline):
+    # 待ち時間なしで呼び出し回数と結果だけを見る
+    return stub_pipeline.StubPipeline(window_cost=0, batch_overhead=0)
+
+
+def test_windows_are_batched_across_inputs(stub_pipeline):
+    pipe = free_stub(stub_pipeline)
+    # 重なりを除いたウィンドウ幅は30 - 2 * 5 = 20秒。60秒の入力3件で9ウィンドウ、4件ずつで3バッチ
+    outputs = list(pipe([audio(60), audio(60), audio(50)], batch_size=4, chunk_length_s=30, stride_length_s=5))
+    assert pipe.calls == 3
+    assert [output['chunks'][-1]['timestamp'][1] for output in outputs] == [60, 60, 50]
+    assert [chunk['timestamp'] for chunk in outputs[2]['chunks']] == [(0.0, 20.0), (20.0, 40.0), (40.0, 50)]
+
+
+def test_sequential_mode_runs_one_window_at_a_time(stub_pipeline):
+    pipe = free_stub(stub_pipeline)
+    output = pipe(audio(75), batch_size=8)
+    assert pipe.calls == 3
+    assert output['text'] == ' [0.0-30.0] [30.0-60.0] [60.0-75.0]'
+
+
+def test_batch_cost_model(stub_pipeline):
+    pipe = stub_pipeline.StubPipeline(window_cost=0.1, batch_overhead=0.01, batch_scaling=0.5)
+    assert pipe.batch_cost(1) == pytest.approx(0.11)
+    assert pipe.batch_cost(3) == pytest.approx(0.21)
+
+
+def test_word_timestamps_depend_only_on_the_audio(stub_pipeline):
+    import numpy as np
+    pipe = free_stub(stub_pipeline)
+    pcm = np.sin(np.arange(16000 * 2) * 0.01).astype(np.float32)
+    first = pipe({'raw': pcm, 'sampling_rate': 16000}, return_timestamps='word')
+    longer = pipe({'raw': np.concatenate([pcm, pcm[:8000]]), 'sampling_rate': 16000}, return_timestamps='word')
+    # 先に確定した語は音声が伸びても変わらない
+    assert longer['chunks'][:3] == first['chunks'][:3]
+    assert len(longer['chunks']) == 5
+
+
+def test_per_second_stub_scales_the_window_cost(app_module, stub_pipeline):
+    window = app_module.CHUNK_LENGTH_S - 2 * (app_module.STRIDE_LENGTH_S or app_module.CHUNK_LENGTH_S / 6)
+    pipe = stub_pipeline.per_second_stub(app_module, 0.01, batch_overhead=0)
+    assert pipe.window_cost == pytest.approx(0.01 * window)
+    assert pipe.batch_overhead == 0
+
+
+def test_percentile_interpolates(stub_pipeline):
+    import endpoints
+    assert endpoints.percentile([], 0.5) is None
+    assert endpoints.percentile([4, 1, 3, 2], 0.5) == pytest.approx(2.5)
+    assert endpoints.percentile([1, 2, 3], 1.0) == 3
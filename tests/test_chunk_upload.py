@@ -0,0 +1,100 @@
+import io
+import threading
+
+import pytest
+
+
+def upload(client, file_id, chunks, indexes=None):
+    total_size = sum(len(chunk) for chunk in chunks)
+    for index in range(len(chunks)) if indexes is None else indexes:
+        response = client.post('/transcribe_chunk', content_type='multipart/form-data', data={
+            'file': (io.BytesIO(chunks[index]), 'blob'), 'fileId': file_id, 'chunkIndex': str(index),
+            'totalChunks': str(len(chunks)), 'chunkSize': str(len(chunks[0])), 'totalSize': str(total_size),
+            'fileName': 'a.wav'})
+        assert response.status_code == 200
+
+
+@pytest.fixture
+def finalize_app(app_module, monkeypatch):
+    # デコードやモデルは使わず、登録されたジョブだけを記録する
+    submitted = []
+
+    def submit_job(file_path, filename, device, options, upload_digest, stages, client, duration):
+        submitted.append(file_path)
+        return {'task_id': app_module.create_task(filename, device, file_path)}
+
+    monkeypatch.setattr(app_module, 'parse_device', lambda value: 'cpu')
+    monkeypatch.setattr(app_module, 'media_duration', lambda file_path: 1.0)
+    monkeypatch.setattr(app_module, 'check_admission', lambda device, audio_seconds: None)
+    monkeypatch.setattr(app_module, 'submit_cached', lambda *args: None)
+    monkeypatch.setattr(app_module, 'submit_job', submit_job)
+    return submitted
+
+
+def test_concurrent_finalize_is_rejected(app_module, finalize_app, monkeypatch):
+    client = app_module.app.test_client()
+    upload(client, 'fin1', [b'a' * 8, b'b' * 8, b'c' * 3])
+
+    # 1回目の最終化を受け付けの判定で止めておき、その間に2回目を送る
+    entered = threading.Event()
+    release = threading.Event()
+
+    def check_admission(device, audio_seconds):
+        entered.set()
+        release.wait(5)
+
+    monkeypatch.setattr(app_module, 'check_admission', check_admission)
+    responses = []
+    first = threading.Thread(target=lambda: responses.append(
+        client.post('/transcribe_finalize_async', json={'fileId': 'fin1'})))
+    first.start()
+    assert entered.wait(5)
+    second = client.post('/transcribe_finalize_async', json={'fileId': 'fin1'})
+    release.set()
+    first.join()
+
+    assert second.status_code == 409
+    assert responses[0].status_code == 202
+    assert len(finalize_app) == 1
+    with open(finalize_app[0], 'rb') as f:
+        assert f.read() == b'a' * 8 + b'b' * 8 + b'c' * 3
+
+
+def test_finalize_can_be_retried_after_rejection(app_module, finalize_app, monkeypatch):
+    client = app_module.app.test_client()
+    upload(client, 'fin2', [b'a' * 8, b'b' * 2])
+
+    def overloaded(device, audio_seconds):
+        raise app_module.Overloaded(3)
+
+    monkeypatch.setattr(app_module, 'check_admission', overloaded)
+    response = client.post('/transcribe_finalize_async', json={'fileId': 'fin2'})
+    assert response.status_code == 429
+
+    monkeypatch.setattr(app_module, 'check_admission', lambda device, audio_seconds: None)
+    response = client.post('/transcribe_finalize_async', json={'fileId': 'fin2'})
+    assert response.status_code == 202
+    assert len(finalize_app) == 1
+
+
+def test_upload_status_resumes_after_restart(app_module, finalize_app):
+    client = app_module.app.test_client()
+    chunks = [b'a' * 8, b'b' * 8, b'c' * 5]
+    assert client.get('/upload_status/res1').get_json() == {'received': [], 'totalChunks': None}
+    upload(client, 'res1', chunks, indexes=[2, 0])
+    assert client.get('/upload_status/res1').get_json() == {'received': [0, 2], 'totalChunks': 3}
+
+    # 再起動でメモリ上の状態を失っても、ディスクの記録から受信済みのチャンクがわかる
+    with app_module.upload_states_lock:
+        app_module.upload_states.clear()
+    assert client.get('/upload_status/res1').get_json() == {'received': [0, 2], 'totalChunks': 3}
+    response = client.post('/transcribe_finalize_async', json={'fileId': 'res1'})
+    assert response.status_code == 400
+    assert response.get_json()['missing'] == [1]
+
+    upload(client, 'res1', chunks, indexes=[1])
+    assert client.post('/transcribe_finalize_async', json={'fileId': 'res1'}).status_code == 202
+    with open(finalize_app[0], 'rb') as f:
+        assert f.read() == b''.join(chunks)
+    assert client.get('/upload_status/res1').get_json() == {'received': [], 'totalChunks': None}
+
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def cli(app_module):
+    import cli
+    return cli
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb'):
+        pass
+
+
+def test_collect_files_walks_directories_and_list(cli, tmp_path):
+    for name in ('a/x.wav', 'a/b/y.MP4', 'a/notes.txt', 'c.flac'):
+        touch(str(tmp_path / name))
+    list_file = tmp_path / 'list.txt'
+    list_file.write_text(f'# コメント\n{tmp_path / "c.flac"}\n\n{tmp_path / "a" / "x.wav"}\n', encoding='utf-8')
+
+    files = cli.collect_files([str(tmp_path / 'a')], str(list_file))
+    # 拡張子で絞るのはディレクトリをたどるときだけ。重複は1つにまとめる
+    assert files == sorted(str(tmp_path / name) for name in ('a/x.wav', 'a/b/y.MP4', 'c.flac'))
+
+
+def test_manifest_resumes_only_completed_files(cli, tmp_path):
+    manifest = tmp_path / 'manifest.jsonl'
+    assert cli.load_manifest(str(manifest)) == {}
+    lines = [
+        {'path': '/a.wav', 'status': 'completed', 'output': 'a.wav.txt'},
+        {'path': '/b.wav', 'status': 'error', 'error': 'x'},
+        {'path': '/c.wav', 'status': 'completed', 'output': 'c.wav.txt'},
+        # 完了した後に失敗したファイルはやり直す
+        {'path': '/c.wav', 'status': 'error', 'error': 'y'},
+    ]
+    with open(manifest, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(line) + '\n' for line in lines)
+        # 書き込み中に止まった最後の行
+        f.write('{"path": "/d.wav", "sta')
+
+    done = cli.load_manifest(str(manifest))
+    assert set(done) == {'/a.wav'}
+    assert done['/a.wav']['output'] == 'a.wav.txt'
@@ -0,0 +1,29 @@
+import io
+import os
+import time
+
+
+def test_janitor_keeps_queued_client_decoded_upload(app_module, monkeypatch):
+    # ブラウザで変換して送られたタスクが待機中に掃除が走っても、アップロードは消されない
+    def submit_job(file_path, filename, device, options, upload_digest, stages, client):
+        # キューには入れず、待機中のタスクだけを作る
+        return {'task_id': app_module.create_task(filename, device, file_path)}
+
+    monkeypatch.setattr(app_module, 'parse_device', lambda value: 'cpu')
+    monkeypatch.setattr(app_module, 'check_admission', lambda device, audio_seconds: None)
+    monkeypatch.setattr(app_module, 'submit_job', submit_job)
+    monkeypatch.setitem(app_module.storage.rules['uploads'], 'max_age', 1)
+
+    response = app_module.app.test_client().post('/transcribe', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(b'RIFF' + b'\0' * 1024), 'a1.wav'), 'polling': 'true',
+        'originalSize': '4096', 'clientDecodeSeconds': '0.5'})
+    assert response.status_code == 202
+    task = app_module.get_task(response.get_json()['task_id'])
+    assert task['client_upload']['saved_bytes'] == 4096 - 1028
+
+    upload_path = os.path.join('uploads', task['upload'])
+    # 期限切れにして掃除の対象にする
+    old = time.time() - 3600
+    os.utime(upload_path, (old, old))
+    app_module.storage.sweep()
+    assert os.path.exists(upload_path)
@@ -0,0 +1,40 @@
+import sys
+import types
+
+
+def fake_torch(monkeypatch, calls):
+    torch = types.ModuleType('torch')
+    torch.set_num_threads = calls.append
+    monkeypatch.setitem(sys.modules, 'torch', torch)
+
+
+def test_threads_are_split_by_cpu_devices_in_use(app_module, monkeypatch):
+    calls = []
+    fake_torch(monkeypatch, calls)
+    monkeypatch.setattr(app_module, 'CPU_THREADS', 8)
+    monkeypatch.setattr(app_module, 'WORKERS_PER_DEVICE', 1)
+    monkeypatch.setattr(app_module, 'cpu_devices_started', set())
+
+    app_module.start_cpu_device('cuda:0')
+    assert calls == []
+    app_module.start_cpu_device('cpu')
+    app_module.start_cpu_device('cpu')
+    assert calls == [8]
+    app_module.start_cpu_device('cpu:int8')
+    assert calls == [8, 4]
+
+
+def test_inference_process_splits_by_configured_cpu_devices(app_module, monkeypatch):
+    calls = []
+    fake_torch(monkeypatch, calls)
+    monkeypatch.setattr(app_module, 'CPU_THREADS', 8)
+    monkeypatch.setattr(app_module, 'WORKERS_PER_DEVICE', 2)
+    monkeypatch.setattr(app_module, 'cpu_devices_started', set())
+    monkeypatch.setattr(app_module, 'SERVE_ROLE', 'inference')
+
+    monkeypatch.setattr(app_module, 'CPU_DEVICES', ['cpu', 'cpu:int8'])
+    app_module.start_cpu_device('cpu')
+    monkeypatch.setattr(app_module, 'CPU_DEVICES', ['cpu'])
+    monkeypatch.setattr(app_module, 'cpu_devices_started', set())
+    app_module.start_cpu_device('cpu')
+    assert calls == [2, 4]
@@ -0,0 +1,66 @@
+import time
+
+
+def test_queue_positions_are_published_only_when_changed(app_module, monkeypatch):
+    published = []
+    monkeypatch.setattr(app_module, 'publish', lambda task_id, event, data: published.append((task_id, data)))
+    queue = app_module.DeviceQueue('cpu', 0)
+    for task_id in ('t1', 't2', 't3'):
+        queue.submit({'task_id': task_id, 'duration': 10.0, 'enqueued_at': time.perf_counter()})
+    assert published == [('t1', {'queue_position': 1}), ('t2', {'queue_position': 2}),
+                         ('t3', {'queue_position': 3})]
+
+    published.clear()
+    with queue.cond:
+        queue._pop_first()
+    queue._publish_positions()
+    assert published == [('t2', {'queue_position': 1}), ('t3', {'queue_position': 2})]
+
+
+def test_completed_event_carries_no_transcript(app_module):
+    task_id = app_module.create_task('a.wav', 'cpu')
+    with open('transcriptions/result.txt', 'w', encoding='utf-8') as f:
+        f.write('hello')
+    app_module.update_task(task_id, status='completed', id='result')
+    event, data = app_module.wait_events(task_id, 0, timeout=0)[-1]
+    assert event == 'completed'
+    assert data == {'id': 'result', 'filename': 'a.wav'}
+
+
+def test_finished_task_events_replay_only_the_terminal_event(app_module):
+    task_id = app_module.create_task('a.wav', 'cpu')
+    app_module.update_task(task_id, status='error', error='boom')
+    with app_module.task_events_lock:
+        app_module.task_events.pop(task_id)
+    response = app_module.app.test_client().get(f'/events/{task_id}')
+    body = response.get_data(as_text=True)
+    response.close()
+    assert 'event: error' in body
+    assert '"error": "boom"' in body
+
+
+def test_events_after_reads_all_subscribed_tasks_at_once(app_module):
+    store = app_module.task_store
+    for task_id in ('s1', 's2'):
+        store.create(task_id, {'status': 'queued'})
+        for percent in (10, 20, 30):
+            store.add_event(task_id, 'progress', {'percent': percent})
+    rows = store.events_after({'s1': 2, 's2': 0, 'missing': 0})
+    assert [(task_id, seq) for task_id, seq, _, _ in rows] == [('s1', 2), ('s2', 0), ('s2', 1), ('s2', 2)]
+    assert rows[0][3] == {'percent': 30}
+
+
+def test_event_streams_over_the_limit_are_refused(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_EVENT_STREAMS', 1)
+    client = app_module.app.test_client()
+    task_id = app_module.create_task('a.wav', 'cpu')
+    assert app_module.acquire_event_stream()
+    try:
+        assert client.get(f'/events/{task_id}').status_code == 503
+    finally:
+        app_module.release_event_stream()
+    app_module.update_task(task_id, status='cancelled')
+    response = client.get(f'/events/{task_id}')
+    assert response.status_code == 200
+    response.close()
+    assert app_module.event_streams[0] == 0
@@ -0,0 +1,52 @@
+import pytest
+
+
+@pytest.fixture
+def metrics(app_module):
+    import metrics
+    return metrics
+
+
+def test_histogram_buckets_are_cumulative(metrics):
+    histogram = metrics.Histogram('t_seconds', 'テスト', ['stage'], buckets=(1, 0.1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage='decode')
+    assert histogram.render() == [
+        '# HELP t_seconds テスト',
+        '# TYPE t_seconds histogram',
+        't_seconds_bucket{stage="decode",le="0.1"} 1',
+        't_seconds_bucket{stage="decode",le="1.0"} 2',
+        't_seconds_bucket{stage="decode",le="+Inf"} 3',
+        't_seconds_sum{stage="decode"} 5.55',
+        't_seconds_count{stage="decode"} 3',
+    ]
+
+
+def test_counter_and_label_escaping(metrics):
+    counter = metrics.Counter('t_total', 'テスト', ['path'])
+    counter.inc(path='a"b\\c')
+    counter.inc(2, path='a"b\\c')
+    assert counter.render()[-1] == 't_total{path="a\\"b\\\\c"} 3.0'
+    assert metrics.gauge('t_bytes', 'テスト', [({}, 7)])[-1] == 't_bytes 7.0'
+
+
+def test_timed_records_the_stage(app_module, monkeypatch):
+    histogram = app_module.metrics.Histogram('t_stage_seconds', 'テスト', ['stage'])
+    monkeypatch.setattr(app_module, 'stage_seconds', histogram)
+    stages = {}
+    for _ in range(2):
+        with app_module.timed(stages, 'probe'):
+            pass
+    assert set(stages) == {'probe'}
+    assert histogram.series[('probe',)]['count'] == 2
+    assert histogram.series[('probe',)]['sum'] == pytest.approx(stages['probe'])
+
+
+def test_metrics_endpoint_exposes_stage_timings(app_module):
+    app_module.stage_seconds.observe(0.2, stage='upload')
+    response = app_module.app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE whisper_stage_seconds histogram' in text
+    assert 'whisper_stage_seconds_count{stage="upload"}' in text
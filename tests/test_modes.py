@@ -0,0 +1,59 @@
+import pytest
+
+
+def test_default_options_follow_the_configuration(app_module):
+    options = app_module.parse_options({})
+    assert options['mode'] == app_module.INFERENCE_MODE
+    assert options['batch_size'] == app_module.BATCH_SIZE
+    if options['mode'] == 'chunked':
+        assert options['chunk_length_s'] == app_module.CHUNK_LENGTH_S
+
+
+def test_chunked_mode_defaults_stride_to_a_sixth(app_module):
+    options = app_module.parse_options({'mode': 'chunked', 'chunk_length_s': '24', 'batch_size': '4'})
+    assert (options['chunk_length_s'], options['stride_length_s'], options['batch_size']) == (24.0, 4.0, 4)
+
+
+def test_sequential_mode_has_no_windows(app_module):
+    options = app_module.parse_options({'mode': 'sequential', 'chunk_length_s': '24'})
+    assert options['chunk_length_s'] is None
+    assert options['stride_length_s'] is None
+
+
+@pytest.mark.parametrize('values', [
+    {'mode': 'beam'}, {'chunk_length_s': 'abc'}, {'chunk_length_s': '0.5'}, {'batch_size': '0'},
+    {'chunk_length_s': '10', 'stride_length_s': '5'}, {'translate': 'maybe'},
+])
+def test_invalid_options_are_rejected(app_module, values):
+    with pytest.raises(ValueError):
+        app_module.parse_options(values)
+
+
+def test_invalid_mode_gets_400(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'parse_device', lambda value: 'cpu')
+    response = app_module.app.test_client().post('/transcribe_finalize_async',
+                                                 json={'fileId': 'missing', 'mode': 'beam'})
+    assert response.status_code == 400
+
+
+def test_jobs_with_different_modes_are_not_batched_together(app_module):
+    chunked = app_module.parse_options({'mode': 'chunked'})
+    sequential = app_module.parse_options({'mode': 'sequential'})
+    wider = app_module.parse_options({'mode': 'chunked', 'chunk_length_s': '20'})
+    assert app_module.batch_key(chunked) == app_module.batch_key(dict(chunked))
+    assert len({app_module.batch_key(options) for options in (chunked, sequential, wider)}) == 3
+
+
+def test_inference_report_compares_with_sequential(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'inference_rates', {})
+    sequential = app_module.parse_options({'mode': 'sequential'})
+    chunked = app_module.parse_options({'mode': 'chunked'})
+    first = app_module.inference_report('cpu', chunked, 60, 0.5)
+    assert first['speedup_vs_sequential'] is None
+    app_module.inference_report('cpu', sequential, 60, 1.0)
+    report = app_module.inference_report('cpu', chunked, 60, 0.25)
+    # 逐次モードの速度の移動平均と今回の速度を比べる
+    assert report['speedup_vs_sequential'] == pytest.approx(1.0 / 0.25)
+    assert report['inference_seconds'] == pytest.approx(15)
+    assert report['batch_size'] == chunked['batch_size']
+    assert app_module.inference_report('cpu', sequential, 60, 1.0)['batch_size'] == 1
@@ -0,0 +1,60 @@
+import shutil
+import wave
+from multiprocessing import shared_memory
+
+import pytest
+
+
+def write_wav(path, seconds):
+    import numpy as np
+    samples = (np.sin(np.arange(int(16000 * seconds)) * 0.05) * 8000).astype(np.int16)
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(samples.tobytes())
+
+
+@pytest.fixture
+def audio(app_module):
+    if shutil.which('ffmpeg') is None:
+        pytest.skip('ffmpeg is not installed')
+    import audio
+    return audio
+
+
+def test_prepared_pcm_is_handed_over_through_shared_memory(audio, tmp_path):
+    path = tmp_path / 'a.wav'
+    write_wav(path, 2)
+    prepared = audio.prepare_media(str(path), False)
+    assert 'audio' not in prepared
+    name = prepared['shm']
+    pcm = audio.take_pcm(prepared)
+    assert len(pcm) == prepared['samples'] == 32000
+    assert (pcm == audio.decode_audio(str(path))).all()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+def test_discarded_pcm_releases_shared_memory(audio, tmp_path):
+    path = tmp_path / 'a.wav'
+    write_wav(path, 1)
+    prepared = audio.prepare_media(str(path), False)
+    name = prepared['shm']
+    audio.discard_pcm(prepared)
+    audio.discard_pcm(prepared)
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+def test_cancelling_after_preprocessing_releases_shared_memory(app_module, audio, tmp_path):
+    from concurrent.futures import Future
+    path = tmp_path / 'a.wav'
+    write_wav(path, 1)
+    future = Future()
+    future.set_running_or_notify_cancel()
+    future.set_result(audio.prepare_media(str(path), False))
+    name = future.result()['shm']
+    app_module.cancel_job({'prepared': future, 'shard': True})
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
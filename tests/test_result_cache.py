@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+
+def test_cache_key_ignores_batch_size_and_job_fields(app_module):
+    options = app_module.parse_options({})
+    key = app_module.cache_key('pcm', 'abc', options)
+    assert app_module.cache_key('pcm', 'abc', app_module.parse_options({'batch_size': '64'})) == key
+    # ジョブの辞書をそのまま渡しても、設定以外の項目はキーに入らない
+    assert app_module.cache_key('pcm', 'abc', {**options, 'task_id': 't', 'file_path': 'f'}) == key
+    assert key.startswith('pcm-abc-')
+
+
+@pytest.mark.parametrize('values', [
+    {'language': 'ja'}, {'translate': 'true'}, {'translate': 'both'}, {'vad': 'true'},
+    {'mode': 'sequential'}, {'chunk_length_s': '20'}, {'stride_length_s': '2'},
+])
+def test_cache_key_changes_with_result_options(app_module, values):
+    default = app_module.cache_key('pcm', 'abc', app_module.parse_options({}))
+    assert app_module.cache_key('pcm', 'abc', app_module.parse_options(values)) != default
+
+
+def test_cache_key_changes_with_kind_digest_and_model(app_module, monkeypatch):
+    options = app_module.parse_options({})
+    key = app_module.cache_key('pcm', 'abc', options)
+    assert app_module.cache_key('upload', 'abc', options) != key
+    assert app_module.cache_key('pcm', 'abd', options) != key
+    monkeypatch.setattr(app_module, 'MODEL_ID', 'openai/whisper-small')
+    assert app_module.cache_key('pcm', 'abc', options) != key
+
+
+def test_least_recently_used_entry_is_evicted(app_module, tmp_path):
+    from result_cache import ResultCache
+    entry = {'text': 'x' * 80}
+    cache = ResultCache(str(tmp_path), 250)
+    cache.put('a', entry)
+    cache.put('b', entry)
+    assert cache.get('a') == entry
+    cache.put('c', entry)
+    assert cache.get('b') is None
+    assert cache.get('a') == entry
+    assert not os.path.exists(tmp_path / 'b.json')
+    assert cache.stats()['evictions'] == 1
+
+    # 再起動後も残っているエントリを読み直す
+    reloaded = ResultCache(str(tmp_path), 250)
+    assert reloaded.get('c') == entry
+    assert reloaded.stats()['entries'] == 2
+
+
+def test_zero_budget_disables_the_cache(app_module, tmp_path):
+    from result_cache import ResultCache
+    cache = ResultCache(str(tmp_path), 0)
+    cache.put('a', {'text': 'x'})
+    assert cache.get('a') is None
+    assert os.listdir(tmp_path) == []
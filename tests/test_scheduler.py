@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def scheduler(app_module):
+    import scheduler
+    return scheduler
+
+
+def job(client, duration, waited=0.0):
+    return {'client': client, 'duration': duration, 'enqueued_at': time.perf_counter() - waited}
+
+
+def test_shorter_audio_goes_first(scheduler):
+    s = scheduler.Scheduler(aging=0.0)
+    long_job, short_job = job('a', 3600), job('b', 30)
+    assert s.order([long_job, short_job]) == [short_job, long_job]
+
+
+def test_fifo_keeps_arrival_order(scheduler):
+    s = scheduler.Scheduler(policy='fifo')
+    first, second = job('a', 3600, waited=20), job('b', 30, waited=10)
+    assert s.order([second, first]) == [first, second]
+
+
+def test_long_wait_overtakes_shorter_audio(scheduler):
+    # aging=10なら、100秒待った1000秒の音声は今来た60秒の音声より先になる
+    s = scheduler.Scheduler(aging=10.0)
+    waiting, fresh = job('a', 1000, waited=100), job('b', 60)
+    assert s.order([fresh, waiting]) == [waiting, fresh]
+
+
+def test_heavy_client_yields_to_others(scheduler):
+    s = scheduler.Scheduler(aging=0.0, fair_share_weight=1.0)
+    s.started(job('heavy', 600))
+    heavy, light = job('heavy', 60), job('light', 120)
+    assert s.order([heavy, light]) == [light, heavy]
+
+
+def test_usage_decays_with_half_life(scheduler, monkeypatch):
+    s = scheduler.Scheduler(half_life=600.0)
+    now = time.time()
+    monkeypatch.setattr(scheduler.time, 'time', lambda: now)
+    s.started(job('a', 100))
+    monkeypatch.setattr(scheduler.time, 'time', lambda: now + 600)
+    assert s._usage('a', now + 600) == pytest.approx(50.0)
+    # 十分に減衰した利用者は次に誰かが始めたときに忘れる
+    monkeypatch.setattr(scheduler.time, 'time', lambda: now + 600 * 10)
+    s.started(job('b', 10))
+    assert 'a' not in s.usage
+
+
+def test_duration_class(scheduler):
+    assert [scheduler.duration_class(seconds) for seconds in (None, 60, 600, 3600)] == \
+        ['unknown', 'short', 'medium', 'long']
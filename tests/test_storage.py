@@ -0,0 +1,25 @@
+import os
+import threading
+import time
+
+
+def test_sync_result_stays_tracked_by_the_janitor(app_module, monkeypatch):
+    # 同期エンドポイントで返した結果も、タスクがTTLで消えるまでは掃除で消さない
+    task_id = app_module.create_task('a.wav', 'cpu')
+    transcription_id = 'sync-result'
+    path = os.path.join('transcriptions', f'{transcription_id}.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('こんにちは')
+    app_module.update_task(task_id, status='completed', id=transcription_id)
+    done = threading.Event()
+    done.set()
+
+    task = app_module.wait_job({'task_id': task_id, 'done': done})
+    assert task['id'] == transcription_id
+    assert app_module.get_task(task_id) is not None
+
+    monkeypatch.setitem(app_module.storage.rules['transcriptions'], 'max_age', 1)
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+    app_module.storage.sweep()
+    assert os.path.exists(path)
@@ -0,0 +1,82 @@
+import io
+import threading
+
+
+class FakeDecoder:
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class SlowBody(io.BytesIO):
+    # 10バイトずつ返し、最初のブロックを返したあとはreleaseされるまで次のブロックを返さない
+    def __init__(self, data, release):
+        super().__init__(data)
+        self.release = release
+        self.started = threading.Event()
+
+    def read(self, size=-1):
+        if self.tell() > 0:
+            self.release.wait()
+        self.started.set()
+        return super().read(10)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def test_slow_chunk_does_not_hold_the_stream_lock(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'StreamDecoder', FakeDecoder)
+    monkeypatch.setattr(app_module, 'process_stream', lambda state: None)
+    job = app_module.start_stream('a.mp3', 'cpu', app_module.parse_options({}))
+    task_id = job['task_id']
+    state = app_module.streams[task_id]
+    client = app_module.app.test_client()
+
+    release = threading.Event()
+    body = SlowBody(b'a' * 10 + b'b' * 10, release)
+    responses = {}
+
+    def post(name, index, stream, length, last=False):
+        url = f'/transcribe_stream/{task_id}?chunkIndex={index}' + ('&last=true' if last else '')
+        responses[name] = client.post(url, input_stream=stream, content_length=length)
+
+    first = threading.Thread(target=post, args=('first', 0, body, 20))
+    first.start()
+    assert body.started.wait(5)
+
+    # 1つ目のチャンクの受信中でも、状態のロックは取れ、後続のチャンクは受け付けられる
+    assert state['lock'].acquire(timeout=1)
+    state['lock'].release()
+    second = threading.Thread(target=post, args=('second', 1, io.BytesIO(b'c' * 5), 5, True))
+    second.start()
+    second.join(0.5)
+    assert second.is_alive()
+
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert responses['first'].status_code == 202
+    assert responses['second'].status_code == 202
+    assert state['decoder'].data == b'a' * 10 + b'b' * 10 + b'c' * 5
+    assert state['closed'] and not state['aborted']
+
+
+def test_duplicate_chunk_in_flight_is_rejected(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'StreamDecoder', FakeDecoder)
+    monkeypatch.setattr(app_module, 'process_stream', lambda state: None)
+    job = app_module.start_stream('a.mp3', 'cpu', app_module.parse_options({}))
+    state = app_module.streams[job['task_id']]
+    state['receiving'].add(0)
+    response = app_module.app.test_client().post(f"/transcribe_stream/{job['task_id']}?chunkIndex=0", data=b'x')
+    assert response.status_code == 400
+    with state['lock']:
+        app_module.close_stream(state, aborted=True)
@@ -0,0 +1,49 @@
+def test_both_result_without_translation_is_not_cached(app_module, monkeypatch):
+    stored = []
+    monkeypatch.setattr(app_module.result_cache, 'put', lambda key, entry: stored.append(entry))
+    job = {**app_module.parse_options({'translate': 'both'}), 'pcm_digest': 'pcm', 'upload_digest': 'upload'}
+
+    app_module.store_result(job, {'text': 'hello', 'chunks': []})
+    assert stored == []
+
+    app_module.store_result(job, {'text': 'hello', 'chunks': [], 'translation': {'text': 'hi', 'chunks': []}})
+    assert [entry['translation']['text'] for entry in stored] == ['hi', 'hi']
+
+
+def test_empty_result_has_translation_in_both_mode(app_module):
+    assert app_module.empty_result(app_module.parse_options({'translate': 'both'}))['translation']['text'] == ''
+    assert 'translation' not in app_module.empty_result(app_module.parse_options({}))
+
+
+def test_encoder_cache_reuses_only_inside_sharing(app_module):
+    import numpy as np
+    from encoder_cache import EncoderCache
+
+    calls = []
+
+    class Encoder:
+        def forward(self, input_features):
+            calls.append(len(input_features))
+            return input_features * 2
+
+    class Pipe:
+        def __init__(self):
+            self.model = type('Model', (), {'get_encoder': lambda model: encoder})()
+
+    encoder = Encoder()
+    cache = EncoderCache.attach(Pipe())
+    assert 'forward' not in vars(encoder)
+
+    features = np.arange(12, dtype=np.float32).reshape(2, 6)
+    with cache.sharing() as stats:
+        first = encoder.forward(input_features=features)
+        second = encoder.forward(input_features=features.copy())
+        encoder.forward(input_features=features + 1)
+    assert second is first
+    assert stats == {'computed': 4, 'reused': 2}
+    assert calls == [2, 2]
+
+    # sharing()の外ではforwardは元に戻り、覚えた出力も使わない
+    assert 'forward' not in vars(encoder)
+    encoder.forward(input_features=features)
+    assert calls == [2, 2, 2]
@@ -0,0 +1,59 @@
+import pytest
+
+
+@pytest.fixture
+def audio(app_module):
+    import audio
+    return audio
+
+
+def signal(audio, parts):
+    # (秒, 発話か) の並びから、かすかな雑音と正弦波をつないだ音声を作る
+    import numpy as np
+    rng = np.random.default_rng(0)
+    pieces = []
+    for seconds, speech in parts:
+        n = int(seconds * audio.SAMPLE_RATE)
+        noise = rng.normal(0, 1e-4, n)
+        tone = 0.3 * np.sin(2 * np.pi * 220 * np.arange(n) / audio.SAMPLE_RATE) if speech else 0
+        pieces.append((noise + tone).astype(np.float32))
+    return np.concatenate(pieces)
+
+
+def test_detects_speech_regions_with_padding(audio):
+    pcm = signal(audio, [(2, False), (2, True), (3, False), (1.5, True), (1, False)])
+    regions = audio.detect_speech(pcm)
+    assert len(regions) == 2
+    sr = audio.SAMPLE_RATE
+    for (start, end), (expected_start, expected_end) in zip(regions, [(2, 4), (7, 8.5)]):
+        assert start / sr == pytest.approx(expected_start - 0.3, abs=0.05)
+        assert end / sr == pytest.approx(expected_end + 0.3, abs=0.05)
+
+
+def test_short_pauses_stay_inside_one_region(audio):
+    pcm = signal(audio, [(1, False), (1, True), (0.3, False), (1, True), (1, False)])
+    assert len(audio.detect_speech(pcm)) == 1
+
+
+def test_silence_only_is_dropped(audio):
+    pcm = signal(audio, [(3, False)])
+    compacted, timeline = audio.compact_speech(pcm, audio.detect_speech(pcm))
+    assert len(compacted) == 0
+    assert timeline == []
+
+
+def test_compacted_timestamps_map_back_to_the_original(audio):
+    pcm = signal(audio, [(10, True)])
+    sr = audio.SAMPLE_RATE
+    compacted, timeline = audio.compact_speech(pcm, [(1 * sr, 3 * sr), (6 * sr, 7 * sr)])
+    assert len(compacted) == 3 * sr
+    assert (compacted[2 * sr:] == pcm[6 * sr:7 * sr]).all()
+    assert timeline == [(0.0, 1.0), (2.0, 6.0)]
+
+    assert audio.restore_timestamp(0.5, timeline) == 1.5
+    assert audio.restore_timestamp(2.5, timeline) == 6.5
+    assert audio.restore_timestamp(None, timeline) is None
+    chunks = audio.restore_chunks([{'text': 'a', 'timestamp': (1.0, 2.5)}, {'text': 'b', 'timestamp': (2.5, None)}],
+                                  timeline)
+    assert [chunk['timestamp'] for chunk in chunks] == [(2.0, 6.5), (6.5, None)]
+    assert chunks[0]['text'] == 'a'